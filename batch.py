@@ -0,0 +1,214 @@
+"""Batch evaluation of a folder tree of pose sequence files.
+
+Files are found under folders named after their exercise, such as
+poses_compressed/bicep/*.npy, scored across a process pool, and written as one
+JSONL or CSV row per file, in sorted file order.
+"""
+
+import concurrent.futures
+import csv
+import glob
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+import numpy as np
+
+from cache import get_cache
+from evaluate import EXERCISES, RULES, check_metrics, register_exercise, score_pose
+from clean import clean_keypoints
+from parse import load_keypoints
+from pose import PoseSequence
+
+
+# Exercise name for each folder name, besides the exercise names themselves.
+EXERCISE_FOLDERS = {
+    'bicep': 'bicep_curl',
+    'frontraise': 'front_raise',
+    'shoulderpress': 'shoulder_press',
+    'shouldershrug': 'shoulder_shrug',
+}
+
+# Columns of the CSV results before and after those of the metrics.
+ROW_FIELDS = ['file', 'exercise', 'frames', 'side', 'correct', 'feedback', 'error']
+TIMING_FIELDS = ['cache', 'load_seconds', 'score_seconds', 'seconds']
+
+
+def result_fields():
+    """CSV columns of the result rows, with every metric of every exercise registered so far, in exercise order."""
+    metric_names = dict.fromkeys(metric.name for exercise in EXERCISES.values() for metric in exercise.metrics)
+    return ROW_FIELDS + list(metric_names) + TIMING_FIELDS
+
+
+def folder_exercise(path):
+    """Return the exercise name of a file from the name of its folder, or None."""
+    folder = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    if folder in RULES:
+        return folder
+    return EXERCISE_FOLDERS.get(folder)
+
+
+def find_files(root):
+    """Return the sorted .npy and .kps files anywhere under root."""
+    return sorted(glob.glob(os.path.join(root, '**', '*.npy'), recursive=True) +
+                  glob.glob(os.path.join(root, '**', '*.kps'), recursive=True))
+
+
+def evaluate_file(path, exercise=None, clean=False, cache_dir=None):
+    """Score one pose sequence file, catching any error.
+
+    Args:
+        path: path of a .npy or .kps keypoint file.
+        exercise: String name of the exercise, or None to infer it from the folder.
+        clean: clean the keypoints with clean.clean_keypoints first.
+        cache_dir: folder of the feature cache to reuse metric values from, or
+            None. Not used with clean.
+
+    Returns:
+        Result row dict with the result_fields that apply to the file.
+    """
+    start = time.perf_counter()
+    row = {'file': path, 'exercise': exercise or folder_exercise(path)}
+    try:
+        if row['exercise'] not in RULES:
+            raise ValueError('Unknown exercise for folder: {}'.format(os.path.dirname(path)))
+        if cache_dir and not clean:
+            cache = get_cache(cache_dir)
+            misses = cache.stats['misses']
+            loaded = time.perf_counter()
+            frames, side, metrics = cache.metrics(path, EXERCISES[row['exercise']])
+            (correct, feedback) = check_metrics(row['exercise'], metrics)
+            row['cache'] = 'miss' if cache.stats['misses'] > misses else 'hit'
+        else:
+            keypoints = load_keypoints(path)
+            pose_seq = PoseSequence(clean_keypoints(keypoints) if clean else keypoints)
+            loaded = time.perf_counter()
+            (correct, feedback, side, metrics) = score_pose(pose_seq, row['exercise'])
+            frames = len(pose_seq)
+        row.update(frames=frames, side=side, correct=correct, feedback=feedback)
+        row.update((metric, _json_float(value)) for metric, value in metrics.items())
+        row['load_seconds'] = loaded - start
+        row['score_seconds'] = time.perf_counter() - loaded
+    except Exception as e:
+        row['error'] = ''.join(traceback.format_exception_only(type(e), e)).strip()
+    row['seconds'] = time.perf_counter() - start
+    return row
+
+
+def _json_float(value):
+    value = float(value)
+    return None if math.isnan(value) else value
+
+
+def _evaluate_task(task):
+    return evaluate_file(*task)
+
+
+def _init_worker(exercises):
+    # exercises registered in the parent process, such as those of --exercise_file or --thresholds,
+    # which spawned workers would otherwise import afresh with the defaults
+    for exercise in exercises:
+        register_exercise(exercise)
+
+
+def batch_evaluate(paths, exercise=None, workers=None, clean=False, cache_dir=None, start_method=None):
+    """Score pose sequence files across a process pool.
+
+    Args:
+        paths: list of keypoint file paths.
+        exercise: String name of the exercise, or None to infer it per file.
+        workers: number of processes, None for one per CPU.
+        clean: clean the keypoints with clean.clean_keypoints first.
+        cache_dir: folder of the feature cache, or None, as passed to evaluate_file.
+        start_method: multiprocessing start method of the workers, None for
+            the platform default.
+
+    Yields:
+        Result rows from evaluate_file, in the order of paths.
+    """
+    tasks = [(path, exercise, clean, cache_dir) for path in paths]
+    workers = workers or os.cpu_count()
+    if workers == 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield _evaluate_task(task)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context(start_method),
+            initializer=_init_worker, initargs=(list(EXERCISES.values()),)) as executor:
+        chunksize = max(1, len(tasks) // (4 * workers))
+        for row in executor.map(_evaluate_task, tasks, chunksize=chunksize):
+            yield row
+
+
+class ResultWriter:
+    """Write result rows as JSONL, or as CSV with the result_fields columns of the exercises registered when created."""
+
+    def __init__(self, f, fmt='jsonl'):
+        if fmt not in ('jsonl', 'csv'):
+            raise ValueError('Unknown results format: {}'.format(fmt))
+        self.f = f
+        self.csv = csv.DictWriter(f, result_fields(), extrasaction='ignore') if fmt == 'csv' else None
+        if self.csv:
+            self.csv.writeheader()
+
+    def write(self, row):
+        if self.csv:
+            self.csv.writerow(row)
+        else:
+            self.f.write(json.dumps(row) + '\n')
+        self.f.flush()
+
+
+def summarize(rows, wall_seconds):
+    """Return a text summary of the throughput of a batch."""
+    if len(rows) == 0:
+        return 'No files evaluated.\n'
+    seconds = np.array([row['seconds'] for row in rows])
+    frames = sum(row.get('frames', 0) for row in rows)
+    errors = sum(1 for row in rows if 'error' in row)
+    correct = sum(1 for row in rows if row.get('correct'))
+    summary = ('{} files ({} correct, {} errors), {} frames in {:.2f} s: {:.1f} files/s, {:.0f} frames/s\n'
+               'per-file seconds: p50 {:.4f}, p99 {:.4f}, max {:.4f}\n').format(
+        len(rows), correct, errors, frames, wall_seconds, len(rows) / wall_seconds, frames / wall_seconds,
+        *np.percentile(seconds, [50, 99, 100]))
+    cached = [row['cache'] for row in rows if 'cache' in row]
+    if cached:
+        summary += 'feature cache: {} hits, {} misses ({:.1%} hit rate)\n'.format(
+            cached.count('hit'), cached.count('miss'), cached.count('hit') / len(cached))
+    return summary
+
+
+def run_batch(root, results='-', exercise=None, workers=None, clean=False, cache_dir=None):
+    """Evaluate every keypoint file under root and write one result row per file.
+
+    Args:
+        root: folder tree with exercise folders, such as poses_compressed.
+        results: output path, .csv for CSV and JSONL otherwise, or - for stdout.
+        exercise: String name of the exercise, or None to infer it per file.
+        workers: number of processes, None for one per CPU.
+        clean: clean the keypoints with clean.clean_keypoints first.
+        cache_dir: folder of the feature cache, or None, as passed to evaluate_file.
+
+    Returns:
+        List of result rows.
+    """
+    fmt = 'csv' if results.endswith('.csv') else 'jsonl'
+    out = sys.stdout if results == '-' else open(results, 'w', newline='')
+    rows = []
+    start = time.perf_counter()
+    try:
+        writer = ResultWriter(out, fmt)
+        for row in batch_evaluate(find_files(root), exercise, workers, clean, cache_dir):
+            writer.write(row)
+            rows.append(row)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    # keep stdout machine-readable when the results go there
+    print(summarize(rows, time.perf_counter() - start), end='', file=sys.stderr if results == '-' else sys.stdout)
+    return rows
@@ -0,0 +1,718 @@
+"""Pose trainer benchmarks.
+
+Every timing reported by a scenario is also collected as a result, which can be
+written as JSON with --json and compared with a stored baseline with --baseline:
+
+    py benchmark.py --json baseline.json
+    py benchmark.py --baseline baseline.json
+
+The comparison flags results whose time or peak memory grew by more than
+--tolerance, and exits with status 1 if there are any.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import glob
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import cache
+import dtw
+import instrument
+import utils
+
+from batch import batch_evaluate, find_files, folder_exercise
+from calibrate import calibrate, calibrate_folder, labelled_files, metric_matrix
+from chunked import evaluate_chunked
+from classifier import DTWClassifier, ExerciseClassifier, build_index, build_quality_classifier, descriptor
+from clean import StreamCleaner, clean_keypoints
+from evaluate import EXERCISES, evaluate_pose, score_pose
+from fake_openpose import fake_openpose_frames
+from features import extract
+from jobs import extract_video
+from parse import load_ps, parse_sequence
+from pipeline import run_pipeline
+from kinematics import present, segment_angles, select_side, side_parts
+from pose import Pose, Part, PoseSequence
+from reps import evaluate_reps
+from service import ScoringService, fixture_requests, format_load, load_test
+from synth import generate
+from track import Tracker, track_people
+
+SCENARIOS = {}
+
+# Results reported by the scenario being run, see report.
+RESULTS = []
+_current = {'scenario': None}
+
+# Time differences below this many seconds are never flagged as regressions.
+MIN_REGRESSION_SECONDS = 0.001
+
+
+def scenario(name):
+    """Register a benchmark function under the given scenario name."""
+    def register(func):
+        SCENARIOS[name] = func
+        return func
+    return register
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pose Trainer Benchmarks')
+    parser.add_argument('scenarios', nargs='*', help='Scenarios to run. Runs all of them by default.\n'
+            'One of: ' + ', '.join(sorted(SCENARIOS)))
+    parser.add_argument('--fixtures', type=str, default='poses_compressed', help='Folder of .npy pose fixtures.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed repetitions; the best one is reported.')
+    parser.add_argument('--minutes', type=float, nargs='+', default=[1, 10, 60], help='Lengths in minutes of the synthetic '
+            'sessions of the sessions scenario, at 30 frames/s.')
+    parser.add_argument('--clips', type=int, default=250, help='Clips per exercise generated by the synthetic scenario.')
+    parser.add_argument('--json', type=str, default=None, help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', type=str, default=None, help='Compare the results with a JSON file written by --json.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Relative growth in time or peak memory over the '
+            'baseline flagged as a regression.')
+
+    args = parser.parse_args()
+
+    for name in args.scenarios or sorted(SCENARIOS):
+        print('== {} =='.format(name))
+        _current['scenario'] = name
+        SCENARIOS[name](args)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'environment': environment(), 'results': RESULTS}, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        lines, regressions = compare(baseline['results'], RESULTS, args.tolerance)
+        print('== comparison with {} =='.format(args.baseline))
+        print('\n'.join(lines))
+        print('{} regressions'.format(len(regressions)))
+        return 1 if regressions else 0
+    return 0
+
+
+def environment():
+    """Versions and machine the results were measured with."""
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def compare(baseline, results, tolerance):
+    """Compare results with baseline results of the same scenarios and labels.
+
+    Returns:
+        lines: one line of text per result found in the baseline.
+        regressions: (scenario, label) of every result whose time or peak memory
+            grew by more than tolerance.
+    """
+    previous = {(result['scenario'], result['label']): result for result in baseline}
+    lines, regressions = [], []
+    for result in results:
+        key = (result['scenario'], result['label'])
+        if key not in previous:
+            continue
+        old = previous[key]
+        time_ratio = result['seconds'] / old['seconds'] if old['seconds'] else 1.0
+        peak_ratio = result['peak_bytes'] / old['peak_bytes'] if old['peak_bytes'] else 1.0
+        slower = time_ratio > 1 + tolerance and result['seconds'] - old['seconds'] > MIN_REGRESSION_SECONDS
+        bigger = peak_ratio > 1 + tolerance
+        if slower or bigger:
+            regressions.append(key)
+        lines.append('{:<16} {:<28} {:>10.2f} ms {:>+7.1%} {:>10.1f} KiB peak {:>+7.1%}{}'.format(
+            key[0], key[1], result['seconds'] * 1000, time_ratio - 1, result['peak_bytes'] / 1024, peak_ratio - 1,
+            '  REGRESSION' if slower or bigger else ''))
+    return lines, regressions
+
+
+def measure(func, repeat):
+    """Time a function and track its memory use.
+
+    Args:
+        func: function with no arguments to benchmark.
+        repeat: number of timed repetitions.
+
+    Returns:
+        best: best wall-clock time in seconds.
+        retained: bytes still allocated by the result of one call.
+        peak: peak bytes allocated during one call.
+
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    result = func()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return best, retained, peak
+
+
+def report(label, best, retained, peak):
+    """Print one measurement and collect it in RESULTS."""
+    RESULTS.append({'scenario': _current['scenario'], 'label': label, 'seconds': best, 'retained_bytes': retained,
+                    'peak_bytes': peak})
+    print('{:<28} {:>10.2f} ms {:>10.1f} KiB retained {:>10.1f} KiB peak'.format(
+        label, best * 1000, retained / 1024, peak / 1024))
+
+
+def load_fixtures(folder, exercise_folder='*'):
+    filenames = sorted(glob.glob(os.path.join(folder, exercise_folder, '*.npy')))
+    return [np.load(filename) for filename in filenames]
+
+
+# Fixture folder for each exercise name accepted by evaluate_pose.
+EXERCISE_FOLDERS = {
+    'bicep_curl': 'bicep',
+    'front_raise': 'frontraise',
+    'shoulder_press': 'shoulderpress',
+    'shoulder_shrug': 'shouldershrug',
+}
+
+
+def _object_pose_sequence(sequence):
+    # Reference implementation of the per-frame Pose/Part PoseSequence.
+    poses = [Pose(parts) for parts in sequence]
+    torso_lengths = np.array([Part.dist(pose.neck, pose.lhip) for pose in poses if pose.neck.exists and pose.lhip.exists] +
+                             [Part.dist(pose.neck, pose.rhip) for pose in poses if pose.neck.exists and pose.rhip.exists])
+    mean_torso = np.mean(torso_lengths)
+    for pose in poses:
+        for attr, part in pose:
+            setattr(pose, attr, part / mean_torso)
+    return poses
+
+
+@scenario('pose_sequence')
+def bench_pose_sequence(args):
+    sequences = load_fixtures(args.fixtures)
+    num_frames = sum(len(sequence) for sequence in sequences)
+    print('{} clips, {} frames'.format(len(sequences), num_frames))
+
+    report('Pose/Part objects', *measure(lambda: [_object_pose_sequence(s) for s in sequences], args.repeat))
+    report('PoseSequence', *measure(lambda: [PoseSequence(s) for s in sequences], args.repeat))
+    report('PoseSequence + .poses', *measure(lambda: [PoseSequence(s).poses for s in sequences], args.repeat))
+
+
+@scenario('evaluate')
+def bench_evaluate(args):
+    for exercise, exercise_folder in sorted(EXERCISE_FOLDERS.items()):
+        pose_seqs = [PoseSequence(s) for s in load_fixtures(args.fixtures, exercise_folder)]
+
+        def run():
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                return [evaluate_pose(pose_seq, exercise) for pose_seq in pose_seqs]
+
+        report('{} ({} clips)'.format(exercise, len(pose_seqs)), *measure(run, args.repeat))
+
+
+@scenario('batch')
+def bench_batch(args):
+    paths = find_files(args.fixtures)
+    print('{} files, {} CPUs'.format(len(paths), os.cpu_count()))
+    for workers in sorted({1, 2, os.cpu_count()}):
+        best, retained, peak = measure(lambda: list(batch_evaluate(paths, workers=workers)), args.repeat)
+        report('{} workers'.format(workers), best, retained, peak)
+        print('{:<28} {:>10.1f} files/s'.format('', len(paths) / best))
+
+
+@scenario('calibrate')
+def bench_calibrate(args):
+    # metric extraction, then the threshold sweeps with 5-fold cross-validation, on the labelled fixtures
+    paths, labels = labelled_files(args.fixtures, 'shoulder_press')
+    exercise = EXERCISES['shoulder_press']
+    report('shoulder_press metrics', *measure(lambda: metric_matrix(paths, exercise, workers=1), args.repeat))
+    values, _ = metric_matrix(paths, exercise, workers=1)
+    report('shoulder_press calibrate', *measure(lambda: calibrate(values, labels, exercise), args.repeat))
+    report('all, 5-fold', *measure(lambda: calibrate_folder(args.fixtures, folds=5, workers=1), args.repeat))
+
+
+@scenario('synthetic')
+def bench_synthetic(args):
+    # generation and batch scoring of thousands of synthetic clips, checking the verdicts against their labels
+    folder = tempfile.mkdtemp()
+    try:
+        num_clips = args.clips * len(EXERCISES)
+        report('generate {} clips'.format(num_clips),
+               *measure(lambda: generate(folder, args.clips, workers=1), args.repeat))
+        paths = find_files(folder)
+        best, retained, peak = measure(lambda: list(batch_evaluate(paths, workers=1)), args.repeat)
+        report('batch_evaluate', best, retained, peak)
+        print('{:<28} {:>10.1f} files/s'.format('', len(paths) / best))
+        rows = list(batch_evaluate(paths, workers=1))
+        agree = sum(row['correct'] == ('_good_' in os.path.basename(row['file'])) for row in rows)
+        print('{:<28} {:>10} of {} verdicts match the labels'.format('', agree, len(rows)))
+    finally:
+        shutil.rmtree(folder)
+
+
+@scenario('clean')
+def bench_clean(args):
+    sequences = load_fixtures(args.fixtures)
+    num_frames = sum(len(sequence) for sequence in sequences)
+    print('{} clips, {} frames'.format(len(sequences), num_frames))
+
+    variants = {
+        'raw': lambda s: s,
+        'clean median': lambda s: clean_keypoints(s),
+        'clean savgol': lambda s: clean_keypoints(s, smooth='savgol', window=7),
+        'stream cleaner': lambda s: np.array([cleaner.update(frame) for cleaner in [StreamCleaner()] for frame in s]),
+    }
+    for label, variant in variants.items():
+        if label != 'raw':
+            best, retained, peak = measure(lambda: [variant(s) for s in sequences], args.repeat)
+            report(label, best, retained, peak)
+            print('{:<28} {:>10.0f} frames/s'.format('', num_frames / best))
+
+    # verdicts on each fixture as its own exercise, against the good/bad label in its filename
+    print('{:<28} {:>10} {:>10}'.format('verdicts', 'changed', 'agree'))
+    verdicts = {}
+    for label, variant in variants.items():
+        verdicts[label] = []
+        agree = 0
+        for exercise, exercise_folder in sorted(EXERCISE_FOLDERS.items()):
+            for filename in sorted(glob.glob(os.path.join(args.fixtures, exercise_folder, '*.npy'))):
+                correct = score_pose(PoseSequence(variant(np.load(filename))), exercise)[0]
+                verdicts[label].append(correct)
+                agree += correct == ('good' in os.path.basename(filename))
+        changed = sum(a != b for a, b in zip(verdicts['raw'], verdicts[label]))
+        print('{:<28} {:>10} {:>10}'.format(label, changed, '{}/{}'.format(agree, len(verdicts[label]))))
+
+
+def write_json_frames(folder, sequence):
+    """Write a keypoint sequence as a folder of OpenPose JSON frames."""
+    os.makedirs(folder, exist_ok=True)
+    name = os.path.basename(folder)
+    for i, keypoints in enumerate(sequence):
+        with open(os.path.join(folder, '{}_{:012d}_keypoints.json'.format(name, i)), 'w') as f:
+            json.dump({'version': 1.3, 'people': [{'pose_keypoints_2d': keypoints.ravel().tolist()}]}, f)
+
+
+def _serial_parse_sequence(json_folder, output_folder):
+    # Reference implementation of the serial, fully in-memory parse_sequence.
+    json_files = sorted(glob.glob(os.path.join(json_folder, '*.json')))
+    all_keypoints = np.zeros((len(json_files), 18, 3))
+    for i in range(len(json_files)):
+        with open(json_files[i]) as f:
+            json_obj = json.load(f)
+            all_keypoints[i] = np.array(json_obj['people'][0]['pose_keypoints_2d']).reshape((18, 3))
+    np.save(os.path.join(output_folder, os.path.basename(json_folder)), all_keypoints)
+
+
+@scenario('ingest')
+def bench_ingest(args):
+    sequence = np.concatenate(load_fixtures(args.fixtures))
+    folder = tempfile.mkdtemp()
+    try:
+        json_folder = os.path.join(folder, 'session')
+        write_json_frames(json_folder, sequence)
+        print('{} JSON frames'.format(len(sequence)))
+
+        report('serial json.load', *measure(lambda: _serial_parse_sequence(json_folder, folder), args.repeat))
+        report('parse_sequence npy', *measure(lambda: parse_sequence(json_folder, folder), args.repeat))
+        report('parse_sequence kps', *measure(lambda: parse_sequence(json_folder, folder, fmt='kps'), args.repeat))
+        for fmt in ('npy', 'kps'):
+            filename = os.path.join(folder, 'session.' + fmt)
+            print('{:<28} {:>10.1f} KiB on disk'.format(fmt, os.path.getsize(filename) / 1024))
+            report('load_ps ' + fmt, *measure(lambda: load_ps(filename), args.repeat))
+    finally:
+        shutil.rmtree(folder)
+
+
+@scenario('pipeline')
+def bench_pipeline(args):
+    # fake_openpose.py playing back one long session, at about 100 frames/s of simulated inference
+    sequence = np.concatenate(load_fixtures(args.fixtures, EXERCISE_FOLDERS['bicep_curl'])[:4])
+    command = [sys.executable, os.path.abspath('fake_openpose.py'), '--video', '{video}', '--write_json', '{output}',
+               '--frame_delay', '0.01']
+    folder = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(folder, 'videos'))
+        video = os.path.join(folder, 'videos', 'session.npy')
+        np.save(video, sequence)
+        json_folder = os.path.join(folder, 'session')
+        print('{} frames'.format(len(fake_openpose_frames(video))))
+
+        def sequential():
+            extract_video(video, json_folder, command, None)
+            parse_sequence(json_folder, folder)
+            return evaluate_pose(load_ps(os.path.join(folder, 'session.npy')), 'bicep_curl')
+
+        def extract_only():
+            extract_video(video, json_folder, command, None)
+
+        def pipelined():
+            return run_pipeline(video, 'bicep_curl', json_folder, command, None, out=devnull)
+
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            timings = [(label, measure(func, 1)) for label, func in
+                       (('extractor alone', extract_only), ('sequential', sequential), ('pipelined', pipelined))]
+        for label, timing in timings:
+            report(label, *timing)
+    finally:
+        shutil.rmtree(folder)
+
+
+def crowded_frames(clips, num_people, num_frames, rng, drop=0.05):
+    """Synthetic crowd: fixture clips looped side by side, shuffled, with dropped detections.
+
+    Returns:
+        frames: list of (P, 18, 3) detections per frame.
+        labels: list of the true person index of each detection.
+    """
+    frames, labels = [], []
+    for t in range(num_frames):
+        people = []
+        for p in range(num_people):
+            keypoints = clips[p % len(clips)][t % len(clips[p % len(clips)])].copy()
+            keypoints[:, 0] += np.where(keypoints[:, 2] != 0, 400.0 * p, 0.0)
+            people.append(keypoints)
+        order = rng.permutation(num_people)
+        order = order[rng.random(num_people) > drop]
+        frames.append(np.array([people[p] for p in order]).reshape((-1, 18, 3)))
+        labels.append(order)
+    return frames, labels
+
+
+def track_purity(frames, labels, method):
+    """Fraction of detections whose track mostly holds detections of the same person."""
+    tracker = Tracker(method=method)
+    counts = {}
+    for people, people_labels in zip(frames, labels):
+        for track_id, label in zip(tracker.update(people), people_labels):
+            counts.setdefault(track_id, {}).setdefault(label, 0)
+            counts[track_id][label] += 1
+    return sum(max(c.values()) for c in counts.values()) / sum(sum(c.values()) for c in counts.values())
+
+
+@scenario('track')
+def bench_track(args):
+    clips = load_fixtures(args.fixtures, EXERCISE_FOLDERS['bicep_curl'])
+    rng = np.random.default_rng(0)
+    for num_people in (2, 5, 10):
+        frames, labels = crowded_frames(clips, num_people, 2000, rng)
+        for method in ('hungarian', 'greedy'):
+            best, retained, peak = measure(lambda: track_people(frames, method=method), args.repeat)
+            tracks = track_people(frames, method=method)
+            report('{} people, {}'.format(num_people, method), best, retained, peak)
+            print('{:<28} {:>10.2f} us per frame and person, {} tracks, {:.1%} purity'.format(
+                '', best / (len(frames) * num_people) * 1e6, len(tracks), track_purity(frames, labels, method)))
+
+
+@scenario('reps')
+def bench_reps(args):
+    # long sessions made of the bicep curl fixtures played back to back
+    clips = load_fixtures(args.fixtures, EXERCISE_FOLDERS['bicep_curl'])
+    for copies in (1, 10, 100):
+        pose_seq = PoseSequence(np.concatenate(clips * copies))
+        best, retained, peak = measure(lambda: evaluate_reps(pose_seq, 'bicep_curl'), args.repeat)
+        report('{} frames, {} reps'.format(len(pose_seq), len(evaluate_reps(pose_seq, 'bicep_curl'))), best, retained, peak)
+        print('{:<28} {:>10.0f} frames/s'.format('', len(pose_seq) / best))
+
+
+def _dict_dtw(s1, s2):
+    # Reference implementation of the dict-based utils.DTWDistance.
+    DTW = {}
+    for i in range(len(s1)):
+        DTW[(i, -1)] = float('inf')
+    for i in range(len(s2)):
+        DTW[(-1, i)] = float('inf')
+    DTW[(-1, -1)] = 0
+    for i in range(len(s1)):
+        for j in range(len(s2)):
+            dist = (s1[i] - s2[j])**2
+            DTW[(i, j)] = dist + min(DTW[(i-1, j)], DTW[(i, j-1)], DTW[(i-1, j-1)])
+    return np.sqrt(DTW[len(s1)-1, len(s2)-1])
+
+
+def elbow_angles(sequence):
+    """Upper arm and forearm angle series of the most visible arm."""
+    pose_seq = PoseSequence(sequence)
+    shoulder, elbow, wrist = side_parts(select_side(pose_seq.exists), 'shoulder', 'elbow', 'wrist')
+    keypoints = pose_seq.keypoints[present(pose_seq.exists, (shoulder, elbow, wrist))]
+    return segment_angles(keypoints, (shoulder, elbow), (wrist, elbow)).astype(np.float64)
+
+
+@scenario('dtw')
+def bench_dtw(args):
+    series = [elbow_angles(s) for s in load_fixtures(args.fixtures, EXERCISE_FOLDERS['bicep_curl'])]
+    pairs = [(a, b) for i, a in enumerate(series) for b in series[i + 1:]]
+    print('{} bicep curl angle series, {} pairs, mean length {:.0f}'.format(
+        len(series), len(pairs), np.mean([len(s) for s in series])))
+
+    reference = [_dict_dtw(a.tolist(), b.tolist()) for a, b in pairs]
+    assert [dtw.dtw(a, b) for a, b in pairs] == reference
+
+    report('dict DTWDistance', *measure(lambda: [_dict_dtw(a.tolist(), b.tolist()) for a, b in pairs], 1))
+    report('dtw full', *measure(lambda: [dtw.dtw(a, b) for a, b in pairs], args.repeat))
+    report('dtw sakoe_chiba', *measure(lambda: [dtw.dtw(a, b, 'sakoe_chiba') for a, b in pairs], args.repeat))
+    report('dtw itakura', *measure(lambda: [dtw.dtw(a, b, 'itakura') for a, b in pairs], args.repeat))
+
+    # leave-one-out nearest neighbour search with lower bound pruning
+    def search():
+        totals = {}
+        for i, query in enumerate(series):
+            _, _, stats = dtw.nearest(query, series[:i] + series[i + 1:], 'sakoe_chiba')
+            for key, count in stats.items():
+                totals[key] = totals.get(key, 0) + count
+        return totals
+
+    report('nearest sakoe_chiba', *measure(search, args.repeat))
+    print('candidates: {}'.format(search()))
+
+
+@scenario('classify')
+def bench_classify(args):
+    sequences = [load_ps(path) for path in find_files(args.fixtures)]
+    best, retained, peak = measure(lambda: build_index(args.fixtures), args.repeat)
+    report('build index, {} templates'.format(len(sequences)), best, retained, peak)
+
+    classifier = build_index(args.fixtures)
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'index.npz')
+        classifier.save(filename)
+        report('load index', *measure(lambda: ExerciseClassifier.load(filename), args.repeat))
+    report('classify {} clips'.format(len(sequences)),
+           *measure(lambda: [classifier.predict(descriptor(pose_seq)) for pose_seq in sequences], args.repeat))
+
+    for k in (1, 3, 5, 7):
+        classifier.k = k
+        labels, confidence = classifier.predict(classifier.descriptors * classifier.std + classifier.mean,
+                                                exclude_self=True)
+        print('k={}: leave-one-out accuracy {:.1%}, mean confidence {:.1%}'.format(
+            k, np.mean(labels == classifier.labels), np.mean(confidence)))
+
+
+def warped_copies(series, count, rng, noise=0.1):
+    """count copies of random (length, features) series with random time warps and noise."""
+    series = np.asarray(series)
+    length = series.shape[1]
+    scale = series.std(axis=(0, 1))
+    copies = []
+    for source in rng.integers(len(series), size=count):
+        steps = rng.uniform(0.5, 1.5, size=length - 1)
+        positions = np.concatenate([[0.0], np.cumsum(steps)]) * (length - 1) / np.sum(steps)
+        warped = np.stack([np.interp(positions, np.arange(length), column) for column in series[source].T], axis=1)
+        copies.append(warped + rng.normal(0.0, noise, size=warped.shape) * scale)
+    return np.array(copies)
+
+
+@scenario('dtw_classify')
+def bench_dtw_classify(args):
+    # leave-one-out accuracy of the good / bad classifier of each exercise
+    for exercise in EXERCISE_FOLDERS:
+        classifier = build_quality_classifier(args.fixtures, exercise)
+        series = classifier.templates * classifier.std + classifier.mean
+        for k in (1, 3):
+            correct = 0
+            for i in range(len(series)):
+                keep = np.arange(len(series)) != i
+                held_out = DTWClassifier(classifier.features, k).fit_series(series[keep], classifier.labels[keep])
+                correct += held_out.predict_series(series[i:i + 1])[0][0] == classifier.labels[i]
+            print('{:<16} k={}: leave-one-out accuracy {:.1%} of {}'.format(exercise, k, correct / len(series),
+                                                                           len(series)))
+
+    # query latency and pruning as the template set grows, with warped copies of
+    # the bicep curl clips as templates and fresh copies as queries
+    rng = np.random.default_rng(0)
+    clips = build_quality_classifier(args.fixtures, 'bicep_curl')
+    series = clips.templates * clips.std + clips.mean
+    queries = warped_copies(series, 20, rng)
+    for count in (30, 100, 300, 1000, 3000):
+        classifier = DTWClassifier(clips.features).fit_series(warped_copies(series, count, rng),
+                                                              np.zeros(count, dtype=int))
+        best, retained, peak = measure(lambda: [classifier.neighbours(query) for query in queries], args.repeat)
+        report('{} templates'.format(count), best, retained, peak)
+        stats = {key: 0 for key in classifier.stats}
+        for query in queries:
+            for key, value in classifier.neighbours(query)[2].items():
+                stats[key] += value
+        total = sum(stats.values())
+        print('{:<28} {:>10.2f} ms per query, pruned {:.1%} lb_kim, {:.1%} lb_keogh, {:.1%} abandoned, {:.1%} computed'.format(
+            '', best / len(queries) * 1e3, *(stats[key] / total for key in ('lb_kim', 'lb_keogh', 'abandoned', 'computed'))))
+        if count <= 300:
+            def brute_force():
+                return [min(dtw.dtw((query - classifier.mean) / classifier.std, template, classifier.constraint)
+                            for template in classifier.templates) for query in queries]
+            assert np.allclose(brute_force(), [classifier.neighbours(query)[1][0] for query in queries])
+            report('{} templates, brute force'.format(count), *measure(brute_force, 1))
+
+
+@scenario('cache')
+def bench_cache(args):
+    paths = find_files(args.fixtures)
+    with tempfile.TemporaryDirectory() as tmp:
+        def run(cache_dir):
+            return list(batch_evaluate(paths, workers=1, cache_dir=cache_dir))
+
+        report('{} files, no cache'.format(len(paths)), *measure(lambda: run(None), args.repeat))
+        uncached = run(None)
+        cache_dir = os.path.join(tmp, 'cache')
+        report('cold cache', *measure(lambda: run(cache_dir), 1))
+        # a fresh process only has the on-disk cache
+        cache._caches.clear()
+        report('disk cache', *measure(lambda: run(cache_dir), 1))
+        report('memory cache', *measure(lambda: run(cache_dir), args.repeat))
+        assert [{key: value for key, value in row.items() if key not in ('cache', 'load_seconds', 'score_seconds', 'seconds')}
+                for row in run(cache_dir)] == [{key: value for key, value in row.items()
+                                                if key not in ('load_seconds', 'score_seconds', 'seconds')}
+                                               for row in uncached]
+        print(cache.get_cache(cache_dir).format_stats())
+
+        names = ['upper_arm_torso_angle', 'upper_arm_forearm_angle']
+        report('extract features, no cache', *measure(lambda: [extract(load_ps(path), names, 5) for path in paths],
+                                                       args.repeat))
+        feature_cache = cache.FeatureCache(os.path.join(tmp, 'features'))
+        report('extract features, cold cache', *measure(lambda: [feature_cache.features(path, names, 5) for path in paths], 1))
+        feature_cache = cache.FeatureCache(os.path.join(tmp, 'features'))
+        report('extract features, disk cache', *measure(lambda: [feature_cache.features(path, names, 5) for path in paths], 1))
+        report('extract features, memory cache',
+               *measure(lambda: [feature_cache.features(path, names, 5) for path in paths], args.repeat))
+        print(feature_cache.format_stats())
+
+
+def synthetic_session(clips, num_frames, rng, jitter=2.0):
+    """A num_frames long keypoint session of random fixture clips played back to back, with pixel jitter."""
+    lengths = np.array([len(clip) for clip in clips])
+    order = rng.integers(len(clips), size=num_frames // lengths.min() + 1)
+    order = order[:np.searchsorted(np.cumsum(lengths[order]), num_frames) + 1]
+    session = np.concatenate([clips[i] for i in order])[:num_frames].astype(np.float64)
+    exists = session[:, :, 2] != 0.0
+    session[:, :, :2] += np.where(exists[:, :, np.newaxis], rng.normal(0.0, jitter, size=session[:, :, :2].shape), 0.0)
+    return session
+
+
+@scenario('sessions')
+def bench_sessions(args):
+    # sessions of each exercise at 30 frames/s, up to an hour long
+    rng = np.random.default_rng(0)
+    folder = tempfile.mkdtemp()
+    try:
+        for minutes in args.minutes:
+            num_frames = int(minutes * 60 * 30)
+            for exercise, exercise_folder in sorted(EXERCISE_FOLDERS.items()):
+                session = synthetic_session(load_fixtures(args.fixtures, exercise_folder), num_frames, rng)
+                filename = os.path.join(folder, 'session.npy')
+                np.save(filename, session)
+                label = '{:g} min {}'.format(minutes, exercise)
+                report(label + ' load_ps', *measure(lambda: load_ps(filename), args.repeat))
+                pose_seq = load_ps(filename)
+                best, retained, peak = measure(lambda: score_pose(pose_seq, exercise), args.repeat)
+                report(label + ' score', best, retained, peak)
+                print('{:<28} {:>10.0f} frames/s'.format('', num_frames / best))
+    finally:
+        shutil.rmtree(folder)
+
+
+@scenario('chunked')
+def bench_chunked(args):
+    # whole-sequence and out-of-core evaluation of bicep curl sessions, for the peak memory of each
+    rng = np.random.default_rng(0)
+    clips = load_fixtures(args.fixtures, 'bicep')
+    folder = tempfile.mkdtemp()
+    try:
+        for minutes in args.minutes:
+            num_frames = int(minutes * 60 * 30)
+            filename = os.path.join(folder, 'session.npy')
+            np.save(filename, synthetic_session(clips, num_frames, rng))
+            label = '{:g} min'.format(minutes)
+            report(label + ' in memory', *measure(lambda: score_pose(load_ps(filename), 'bicep_curl'), args.repeat))
+            report(label + ' chunked', *measure(lambda: evaluate_chunked(filename, 'bicep_curl', verbose=False),
+                                                args.repeat))
+    finally:
+        shutil.rmtree(folder)
+
+
+@scenario('ingest_sizes')
+def bench_ingest_sizes(args):
+    # parse_sequence on OpenPose JSON folders of synthetic sessions
+    rng = np.random.default_rng(0)
+    clips = load_fixtures(args.fixtures)
+    for num_frames in (100, 1000, 10000):
+        folder = tempfile.mkdtemp()
+        try:
+            json_folder = os.path.join(folder, 'session')
+            write_json_frames(json_folder, synthetic_session(clips, num_frames, rng))
+            best, retained, peak = measure(lambda: parse_sequence(json_folder, folder), args.repeat)
+            report('{} frames'.format(num_frames), best, retained, peak)
+            print('{:<28} {:>10.0f} frames/s'.format('', num_frames / best))
+        finally:
+            shutil.rmtree(folder)
+
+
+@scenario('dtw_length')
+def bench_dtw_length(args):
+    # utils.DTWDistance between bicep curl angle series tiled to each length
+    series = [elbow_angles(s) for s in load_fixtures(args.fixtures, EXERCISE_FOLDERS['bicep_curl'])]
+    for length in (50, 100, 200, 400, 800):
+        s1 = np.resize(series[0], length)
+        s2 = np.resize(series[1], length)
+        report('length {}'.format(length), *measure(lambda: utils.DTWDistance(s1, s2), args.repeat))
+
+
+@scenario('instrument')
+def bench_instrument(args):
+    paths = find_files(args.fixtures)
+    exercises = [folder_exercise(path) for path in paths]
+
+    def run():
+        return [score_pose(load_ps(path), exercise) for path, exercise in zip(paths, exercises)]
+
+    def spans():
+        for _ in range(100000):
+            with instrument.span('evaluate', exercise='bicep_curl'):
+                pass
+
+    for enabled in (False, True):
+        instrument.enable(enabled)
+        state = 'enabled' if enabled else 'disabled'
+        report('{} files, {}'.format(len(paths), state), *measure(run, args.repeat))
+        best, retained, peak = measure(spans, args.repeat)
+        report('100000 spans, {}'.format(state), best, retained, peak)
+        print('{:<28} {:>10.3f} us per span'.format('', best / 100000 * 1e6))
+    instrument.enable(False)
+    instrument.reset()
+
+
+@scenario('service')
+def bench_service(args):
+    requests = fixture_requests(args.fixtures)
+
+    async def run(max_batch, concurrency):
+        folder = tempfile.mkdtemp()
+        socket = os.path.join(folder, 'service.sock')
+        service = ScoringService(workers=1, max_batch=max_batch, template_folder=args.fixtures)
+        server = await service.start(unix_socket=socket)
+        try:
+            # warm up the worker process before timing
+            await load_test(requests, len(requests), 1, unix_socket=socket)
+            return await load_test(requests, 20 * len(requests), concurrency, unix_socket=socket)
+        finally:
+            server.close()
+            await server.wait_closed()
+            service.close()
+            shutil.rmtree(folder)
+
+    for max_batch in (1, 64):
+        for concurrency in (1, 16):
+            stats = asyncio.run(run(max_batch, concurrency))
+            label = 'batch {:>2}, {:>2} connections'.format(max_batch, concurrency)
+            print(format_load(label, stats))
+            report(label + ' p50', stats['p50'], 0, 0)
+            report(label + ' p99', stats['p99'], 0, 0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
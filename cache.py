@@ -0,0 +1,179 @@
+"""Cache of what is computed from keypoint files, for repeated evaluation runs.
+
+Entries are keyed by the content hash of the keypoint file and the
+features.FEATURE_VERSION, so they are recomputed whenever the file or the
+feature definitions change, and survive renames. They are held in memory with
+least recently used eviction, and on disk under one folder per file hash:
+
+- the normalized keypoints of its PoseSequence, memory-mapped when loaded,
+- named feature series, as returned by features.extract,
+- exercise metric values, keyed by the features and reductions of the
+  exercise, but not its thresholds, so rescoring with new thresholds needs
+  only the cached values.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from exercises import compute_metrics
+from features import FEATURE_VERSION, extract
+from parse import load_keypoints
+from pose import PoseSequence
+from utils import file_hash
+
+
+def exercise_key(exercise):
+    """Hash of everything in an Exercise that its metric values depend on."""
+    spec = (exercise.required, exercise.sided,
+            [(metric.name, metric.feature, metric.reduce, metric.combine) for metric in exercise.metrics])
+    return hashlib.sha1(repr(spec).encode()).hexdigest()[:16]
+
+
+class FeatureCache:
+    """In-memory LRU and on-disk cache of pose sequences, feature series and metrics.
+
+    Args:
+        cache_dir: folder for the on-disk cache, or None to keep entries in memory only.
+        max_items: largest number of entries held in memory.
+    """
+
+    def __init__(self, cache_dir='feature_cache', max_items=256):
+        self.folder = os.path.join(cache_dir, 'v{}'.format(FEATURE_VERSION)) if cache_dir else None
+        self.max_items = max_items
+        self.items = collections.OrderedDict()
+        # file hash of each path, with the size and modification time it was computed for
+        self.hashes = {}
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+
+    def key(self, path):
+        """Content hash of a keypoint file, rehashed only when its size or modification time change."""
+        stat = os.stat(path)
+        cached = self.hashes.get(path)
+        if cached is None or cached[:2] != (stat.st_size, stat.st_mtime_ns):
+            cached = (stat.st_size, stat.st_mtime_ns, file_hash(path))
+            self.hashes[path] = cached
+        return cached[2]
+
+    def pose_sequence(self, path):
+        """PoseSequence of a keypoint file."""
+        def compute():
+            return PoseSequence(load_keypoints(path))
+
+        def load(filename):
+            with open(filename + '.json') as f:
+                mean_torso = json.load(f)['mean_torso']
+            return PoseSequence.from_normalized(np.load(filename + '.npy', mmap_mode='r'), mean_torso)
+
+        def save(filename, pose_seq):
+            _save_array(filename + '.npy', pose_seq.keypoints)
+            _save_json(filename + '.json', {'mean_torso': float(pose_seq.mean_torso)})
+
+        return self._get(path, 'pose', compute, load, save, suffix='.json')
+
+    def features(self, path, names, smooth=0):
+        """Named feature series of a keypoint file, as returned by features.extract."""
+        output = []
+        for name in names:
+            def compute():
+                return extract(self.pose_sequence(path), [name], smooth)[0]
+
+            def load(filename):
+                return np.load(filename, mmap_mode='r')
+
+            output.append(self._get(path, '{}_s{}.npy'.format(name, smooth), compute, load, _save_array))
+        return output
+
+    def metrics(self, path, exercise):
+        """Metric values of an Exercise on a keypoint file.
+
+        Returns:
+            frames: number of frames in the file.
+            side, metrics: as returned by exercises.compute_metrics.
+        """
+        def compute():
+            pose_seq = self.pose_sequence(path)
+            return (len(pose_seq),) + compute_metrics(pose_seq, exercise)
+
+        def load(filename):
+            with open(filename) as f:
+                data = json.load(f)
+            # metric values keep their dtype, which matters when they are compared with thresholds
+            return data['frames'], data['side'], {name: np.dtype(dtype).type(value)
+                                                  for name, (value, dtype) in data['metrics'].items()}
+
+        def save(filename, result):
+            frames, side, metrics = result
+            _save_json(filename, {'frames': frames, 'side': side,
+                                  'metrics': {name: [float(value), np.asarray(value).dtype.str]
+                                              for name, value in metrics.items()}})
+
+        return self._get(path, 'metrics_{}.json'.format(exercise_key(exercise)), compute, load, save)
+
+    def _get(self, path, name, compute, load, save, suffix=''):
+        file_key = self.key(path)
+        item = (file_key, name)
+        if item in self.items:
+            self.items.move_to_end(item)
+            self.stats['memory_hits'] += 1
+            return self.items[item]
+
+        filename = os.path.join(self.folder, file_key, name) if self.folder else None
+        if filename and os.path.exists(filename + suffix):
+            value = load(filename)
+            self.stats['disk_hits'] += 1
+        else:
+            value = compute()
+            self.stats['misses'] += 1
+            if filename:
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                save(filename, value)
+
+        self.items[item] = value
+        if len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+            self.stats['evictions'] += 1
+        return value
+
+    def format_stats(self):
+        """Return a one line summary of the hit and miss counts."""
+        lookups = self.stats['memory_hits'] + self.stats['disk_hits'] + self.stats['misses']
+        hits = self.stats['memory_hits'] + self.stats['disk_hits']
+        return 'feature cache: {} lookups, {} memory hits, {} disk hits, {} misses ({:.1%} hit rate), {} evictions'.format(
+            lookups, self.stats['memory_hits'], self.stats['disk_hits'], self.stats['misses'],
+            hits / lookups if lookups else 0.0, self.stats['evictions'])
+
+
+def _write_atomically(filename, write, mode):
+    # a temporary file of its own, so that processes caching the same content do not collide
+    fd, temp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(filename) or '.')
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.replace(temp, filename)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+
+def _save_array(filename, array):
+    _write_atomically(filename, lambda f: np.save(f, np.asarray(array)), 'wb')
+
+
+def _save_json(filename, obj):
+    _write_atomically(filename, lambda f: json.dump(obj, f), 'w')
+
+
+# Caches used by the functions of this process, by cache folder.
+_caches = {}
+
+
+def get_cache(cache_dir):
+    """Return the FeatureCache of a folder shared within this process."""
+    if cache_dir not in _caches:
+        _caches[cache_dir] = FeatureCache(cache_dir)
+    return _caches[cache_dir]
@@ -0,0 +1,304 @@
+"""Calibration of the exercise thresholds from labelled clips.
+
+Clips are read from one folder per exercise in utils.files_in_order order, and
+labelled good or bad by their file names with utils.get_labels, as in the
+analysis notebooks. The metric values of every clip are computed once, across a
+process pool and through the feature cache if one is given, into a (clips,
+metrics) matrix, and every threshold search runs on that matrix alone.
+
+The search is a coordinate descent: the threshold of each metric in turn is
+set to the best of the candidates between consecutive values of that metric,
+with the other thresholds held fixed, until none changes. Each step scores
+every candidate at once as a (candidates, clips) array. Thresholds are scored
+by balanced accuracy, since good and bad clips are not equally common, and ties
+keep the threshold nearest the current one, so thresholds only move where that
+classifies more clips correctly.
+
+The accuracy of the calibrated thresholds on unseen clips is estimated by
+stratified k-fold cross-validation, with the folds calibrated in parallel.
+Thresholds are written as JSON of {exercise: {metric: threshold}}, which
+evaluate.load_thresholds and main.py --thresholds apply:
+
+    py calibrate.py --pose_folder poses_compressed --output thresholds.json
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from batch import batch_evaluate, folder_exercise
+from evaluate import EXERCISES
+from utils import files_in_order, get_labels
+
+# Metric values are float32, as the keypoints of a PoseSequence, and are
+# compared with thresholds in float32, so candidate thresholds are rounded to it.
+METRIC_DTYPE = np.float32
+
+# Largest number of candidate thresholds tried per metric.
+MAX_CANDIDATES = 256
+
+
+def labelled_files(root, exercise):
+    """Return the keypoint files of an exercise under root, in files_in_order order, and their labels."""
+    paths = []
+    for folder in sorted(os.listdir(root)):
+        folder = os.path.join(root, folder)
+        if os.path.isdir(folder) and folder_exercise(os.path.join(folder, 'clip.npy')) == exercise:
+            paths += [os.path.join(folder, name) for name in files_in_order(folder)
+                      if os.path.splitext(name)[1] in ('.npy', '.kps')]
+    return paths, get_labels([os.path.basename(path) for path in paths])
+
+
+def metric_matrix(paths, exercise, workers=None, cache_dir=None):
+    """Compute the metric values of an exercise for every file.
+
+    Args:
+        paths: list of keypoint file paths.
+        exercise: exercises.Exercise whose metrics to compute.
+        workers: number of processes, None for one per CPU.
+        cache_dir: folder of the feature cache, or None.
+
+    Returns:
+        values: (files, metrics) float64 array of the metric values, in the
+            order of exercise.metrics, NaN for files that failed to evaluate.
+        errors: error message of each file that failed, by path.
+    """
+    values = np.full((len(paths), len(exercise.metrics)), np.nan)
+    errors = {}
+    for i, row in enumerate(batch_evaluate(paths, exercise.name, workers, cache_dir=cache_dir)):
+        if 'error' in row:
+            errors[row['file']] = row['error']
+            continue
+        values[i] = [np.nan if row[metric.name] is None else row[metric.name] for metric in exercise.metrics]
+    return values, errors
+
+
+def balanced_accuracy(predicted, labels):
+    """Mean over the labels present of the fraction of clips with that label predicted correctly.
+
+    Args:
+        predicted: (..., clips) boolean predictions, True for good.
+        labels: (clips,) labels, 1 for good and 0 for bad.
+    """
+    rates = [np.mean(predicted[..., labels == label] == label, axis=-1) for label in (0, 1) if np.any(labels == label)]
+    return np.mean(rates, axis=0)
+
+
+def crossed(values, rules, thresholds):
+    """(clips, metrics) boolean array of the thresholds each clip crosses."""
+    above = values > thresholds
+    below = values < thresholds
+    return np.where(np.array([rule == '>' for rule in rules]), above, below)
+
+
+def predict(values, rules, thresholds):
+    """(clips,) boolean array, True where a clip crosses no threshold."""
+    return ~np.any(crossed(values, rules, thresholds), axis=1)
+
+
+def candidate_thresholds(values):
+    """Thresholds splitting the distinct finite values differently, rounded to METRIC_DTYPE.
+
+    These are the midpoints between consecutive distinct values, and values
+    just below the smallest and just above the largest. More than
+    MAX_CANDIDATES distinct values are first thinned out to that many quantiles.
+    """
+    distinct = np.unique(values[np.isfinite(values)]).astype(METRIC_DTYPE)
+    if len(distinct) == 0:
+        return np.zeros(0)
+    if len(distinct) > MAX_CANDIDATES:
+        distinct = np.unique(distinct[np.linspace(0, len(distinct) - 1, MAX_CANDIDATES).round().astype(int)])
+    midpoints = (distinct[:-1].astype(np.float64) + distinct[1:]) / 2
+    ends = [np.nextafter(distinct[0], METRIC_DTYPE(-np.inf)), np.nextafter(distinct[-1], METRIC_DTYPE(np.inf))]
+    return np.unique(np.concatenate([midpoints.astype(METRIC_DTYPE), ends])).astype(np.float64)
+
+
+def current_thresholds(exercise):
+    """(metrics,) float64 array of the thresholds of an exercise, rounded to METRIC_DTYPE as when compared."""
+    return np.array([metric.threshold for metric in exercise.metrics], dtype=METRIC_DTYPE).astype(np.float64)
+
+
+def calibrate(values, labels, exercise, max_rounds=20):
+    """Search the thresholds of an exercise that classify labelled clips best.
+
+    Args:
+        values: (clips, metrics) metric values, as returned by metric_matrix.
+        labels: (clips,) labels, 1 for good and 0 for bad.
+        exercise: exercises.Exercise, whose thresholds the search starts from.
+        max_rounds: largest number of passes over the metrics.
+
+    Returns:
+        (metrics,) float64 array of the thresholds, exactly representable in
+        METRIC_DTYPE.
+    """
+    rules = [metric.rule for metric in exercise.metrics]
+    thresholds = current_thresholds(exercise)
+    candidates = [candidate_thresholds(values[:, j]) for j in range(len(rules))]
+    for _ in range(max_rounds):
+        changed = False
+        for j, rule in enumerate(rules):
+            others = np.delete(crossed(values, rules, thresholds), j, axis=1).any(axis=1)
+            # the current threshold is a candidate too, and wins its ties
+            tried = np.append(candidates[j], thresholds[j])
+            if rule == '>':
+                crosses = values[:, j] > tried[:, np.newaxis]
+            else:
+                crosses = values[:, j] < tried[:, np.newaxis]
+            scores = balanced_accuracy(~(crosses | others), labels)
+            best = np.flatnonzero(scores == scores.max())
+            choice = tried[best[np.argmin(np.abs(tried[best] - thresholds[j]))]]
+            if choice != thresholds[j]:
+                thresholds[j] = choice
+                changed = True
+        if not changed:
+            break
+    return thresholds
+
+
+def _fold_task(task):
+    values, labels, exercise, test = task
+    thresholds = calibrate(values[~test], labels[~test], exercise)
+    current = current_thresholds(exercise)
+    rules = [metric.rule for metric in exercise.metrics]
+    return (balanced_accuracy(predict(values[test], rules, thresholds), labels[test]),
+            balanced_accuracy(predict(values[test], rules, current), labels[test]))
+
+
+def stratified_folds(labels, folds, seed=0):
+    """(clips,) fold index of each clip, with each label spread evenly over the folds."""
+    rng = np.random.default_rng(seed)
+    fold = np.empty(len(labels), dtype=int)
+    for label in np.unique(labels):
+        indices = rng.permutation(np.flatnonzero(labels == label))
+        fold[indices] = np.arange(len(indices)) % folds
+    return fold
+
+
+def cross_validate(data, folds=5, workers=None, seed=0):
+    """Estimate the accuracy of calibrated and current thresholds on unseen clips.
+
+    Args:
+        data: dict of (values, labels) by exercise name, as from metric_matrix
+            and labelled_files.
+        folds: number of cross-validation folds.
+        workers: number of processes, None for one per CPU.
+        seed: seed of the fold assignment.
+
+    Returns:
+        Dict of (calibrated, current) mean test balanced accuracy by exercise name.
+    """
+    tasks = []
+    for name, (values, labels) in data.items():
+        num_folds = min(folds, len(labels))
+        fold = stratified_folds(labels, num_folds, seed)
+        tasks += [(name, (values, labels, EXERCISES[name], fold == k)) for k in range(num_folds)]
+
+    workers = workers or os.cpu_count()
+    if workers == 1 or len(tasks) <= 1:
+        scores = [_fold_task(task) for _, task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            scores = list(executor.map(_fold_task, [task for _, task in tasks]))
+
+    results = {}
+    for name in data:
+        fold_scores = np.array([score for (task_name, _), score in zip(tasks, scores) if task_name == name])
+        results[name] = tuple(np.nanmean(fold_scores, axis=0))
+    return results
+
+
+def calibrate_folder(root, exercises=None, folds=5, workers=None, cache_dir=None, out=None):
+    """Calibrate the thresholds of exercises on the labelled clips under root.
+
+    Args:
+        root: folder tree with one folder of labelled clips per exercise.
+        exercises: names of the exercises to calibrate, or None for every
+            exercise with clips under root.
+        folds: number of cross-validation folds, or 0 to skip cross-validation.
+        workers: number of processes, None for one per CPU.
+        cache_dir: folder of the feature cache, or None.
+        out: file to print a summary per exercise to, or None.
+
+    Returns:
+        Dict of {metric: threshold} by exercise name. Exercises whose calibrated
+        thresholds do not cross-validate better than their current ones keep
+        the current ones.
+    """
+    start = time.perf_counter()
+    data = {}
+    for name in exercises or EXERCISES:
+        paths, labels = labelled_files(root, name)
+        if len(paths) == 0:
+            continue
+        values, errors = metric_matrix(paths, EXERCISES[name], workers, cache_dir)
+        for path, error in errors.items():
+            print('Skipping {}: {}'.format(path, error), file=out)
+        # clips that failed to evaluate have no metric values
+        valid = ~np.all(np.isnan(values), axis=1)
+        data[name] = (values[valid], labels[valid])
+    extracted = time.perf_counter()
+
+    thresholds = {}
+    scores = cross_validate(data, folds, workers) if folds else {}
+    for name, (values, labels) in data.items():
+        exercise = EXERCISES[name]
+        rules = [metric.rule for metric in exercise.metrics]
+        current = current_thresholds(exercise)
+        calibrated = calibrate(values, labels, exercise)
+        # thresholds fitted to the clips that do no better on unseen ones are not worth changing to
+        kept = name in scores and not scores[name][0] > scores[name][1]
+        chosen = current if kept else calibrated
+        # unchanged thresholds are written as given rather than rounded
+        thresholds[name] = {metric.name: metric.threshold if value == rounded else float(value)
+                            for metric, value, rounded in zip(exercise.metrics, chosen, current)}
+        if out is None:
+            continue
+        print('{}: {} clips ({} good), balanced accuracy {:.3f} with the current thresholds, {:.3f} calibrated'.format(
+            name, len(labels), int(np.sum(labels)), balanced_accuracy(predict(values, rules, current), labels),
+            balanced_accuracy(predict(values, rules, calibrated), labels)), file=out)
+        if name in scores:
+            print('  {}-fold cross-validated: {:.3f} current, {:.3f} calibrated'.format(
+                folds, scores[name][1], scores[name][0]), file=out)
+        if kept:
+            print('  calibrated thresholds do not cross-validate better, keeping the current ones', file=out)
+        for metric, value in zip(exercise.metrics, chosen):
+            print('  {:<24} {} {:<12g} (was {:g})'.format(metric.name, metric.rule, value, metric.threshold), file=out)
+    if out is not None:
+        print('metrics of {} clips in {:.2f} s, calibration in {:.2f} s'.format(
+            sum(len(labels) for _, labels in data.values()), extracted - start, time.perf_counter() - extracted),
+            file=out)
+    return thresholds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calibrate exercise thresholds from labelled clips')
+    parser.add_argument('--pose_folder', type=str, default='poses_compressed', help='Folder tree of labelled .npy or '
+            '.kps files, in one folder per exercise, with good or bad in their file names.')
+    parser.add_argument('--output', type=str, default='thresholds.json', help='JSON file to write the thresholds to, '
+            'for main.py --thresholds.')
+    parser.add_argument('--exercise', type=str, nargs='*', default=None, help='Exercises to calibrate. Defaults to '
+            'every exercise with clips in --pose_folder.')
+    parser.add_argument('--folds', type=int, default=5, help='Number of cross-validation folds, or 0 to skip it.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes. Defaults to one per CPU.')
+    parser.add_argument('--feature_cache', type=str, default=None, help='Folder to cache metric values in, so '
+            'recalibrating the same clips skips recomputing them.')
+    args = parser.parse_args()
+
+    thresholds = calibrate_folder(args.pose_folder, args.exercise, args.folds, args.workers, args.feature_cache,
+                                  out=sys.stderr if args.output == '-' else sys.stdout)
+    # keep stdout machine-readable when the thresholds go there
+    if args.output == '-':
+        print(json.dumps(thresholds, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(thresholds, f, indent=2)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
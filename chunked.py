@@ -0,0 +1,119 @@
+"""Out-of-core evaluation of long recordings, in fixed-size chunks of frames.
+
+A PoseSequence holds the normalized keypoints of a whole recording in memory,
+which hours of continuous recording do not fit in. evaluate_chunked reads a
+memory-mapped keypoint file a chunk of frames at a time instead, in two passes:
+
+1. The torso lengths and the frames each arm is seen in are summed over the
+   chunks, giving the mean torso length and the arm to evaluate.
+2. Each chunk is normalized by that mean torso length and reduced by the
+   compiled exercise Plan, carrying the running maxima and minima of the
+   features over to the next chunk.
+
+Smoothing looks window // 2 frames to either side of a frame, so each chunk is
+smoothed along with that many frames of its neighbours. Memory use depends on
+the chunk size but not on the length of the recording, and the metrics are
+identical to those of a PoseSequence of the whole recording.
+"""
+
+import math
+
+import numpy as np
+
+from clean import smooth_keypoints
+from evaluate import EXERCISES, check_metrics, report_metrics
+from exercises import compile_plan
+from kinematics import present, side_parts
+from parse import load_keypoints
+from pose import PoseSequence, torso_lengths
+
+# Frames read at a time: about 1.7 MB of float64 keypoints.
+CHUNK_FRAMES = 4096
+
+
+def iter_chunks(keypoints, chunk_frames=CHUNK_FRAMES, smooth='none', window=5):
+    """Yield consecutive chunks of a keypoint array, reading one chunk at a time.
+
+    Args:
+        keypoints: (N, 18, 3) keypoints in pixels, typically a memmap.
+        chunk_frames: frames per chunk.
+        smooth, window: smoothing, as passed to clean.smooth_keypoints.
+
+    Yields:
+        (chunk_frames, 18, 3) keypoints, the last chunk possibly shorter,
+        smoothed as the whole array would be.
+    """
+    halo = window // 2 if smooth != 'none' and window > 1 else 0
+    for start in range(0, len(keypoints), chunk_frames):
+        stop = min(start + chunk_frames, len(keypoints))
+        if not halo:
+            yield np.asarray(keypoints[start:stop])
+            continue
+        # frames near the chunk edges are smoothed with their neighbours in the next and previous chunks
+        first = max(start - halo, 0)
+        smoothed = smooth_keypoints(keypoints[first:min(stop + halo, len(keypoints))], smooth, window)
+        yield smoothed[start - first:stop - first]
+
+
+def chunked_metrics(keypoints, exercise, chunk_frames=CHUNK_FRAMES, smooth='none', window=5):
+    """Evaluate the metrics of an Exercise on a keypoint array, one chunk of frames at a time.
+
+    Args:
+        keypoints: (N, 18, 3) keypoints in pixels, typically a memmap.
+        exercise: exercises.Exercise to evaluate.
+        chunk_frames: frames per chunk.
+        smooth, window: smoothing, as passed to clean.smooth_keypoints.
+
+    Returns:
+        side, metrics: as returned by exercises.compute_metrics.
+
+    Raises:
+        ValueError: if no frame has every part required by the exercise.
+    """
+    arms = {side: side_parts(side, 'shoulder', 'elbow', 'wrist') for side in ('right', 'left')}
+    arm_counts = {'right': 0, 'left': 0}
+    num_lengths = 0
+
+    def lengths():
+        nonlocal num_lengths
+        for chunk in iter_chunks(keypoints, chunk_frames, smooth, window):
+            exists = chunk[:, :, 2] != 0.0
+            for side, parts in arms.items():
+                arm_counts[side] += int(np.count_nonzero(present(exists, parts)))
+            chunk_lengths = torso_lengths(chunk, exists)
+            num_lengths += len(chunk_lengths)
+            yield from chunk_lengths.tolist()
+
+    # fsum is exactly rounded whatever the chunks, as in PoseSequence
+    torso_sum = math.fsum(lengths())
+    mean_torso = np.float64(torso_sum / num_lengths) if num_lengths else np.float64(np.nan)
+    if exercise.sided:
+        side = 'right' if arm_counts['right'] > arm_counts['left'] else 'left'
+    else:
+        side = None
+
+    chunks = (PoseSequence(chunk, mean_torso) for chunk in iter_chunks(keypoints, chunk_frames, smooth, window))
+    return side, compile_plan(exercise, side).evaluate_chunks(chunks)
+
+
+def evaluate_chunked(filename, exercise, chunk_frames=CHUNK_FRAMES, smooth='none', window=5, verbose=True):
+    """Evaluate a numpy or compact keypoint file for a particular exercise, one chunk of frames at a time.
+
+    Args:
+        filename: path of the keypoint file.
+        exercise: String name of the exercise to evaluate.
+        chunk_frames: frames per chunk.
+        smooth, window: smoothing, as passed to clean.smooth_keypoints.
+        verbose: print the arm and metric values, as evaluate.evaluate_pose does.
+
+    Returns:
+        correct: Bool whether exercise was performed correctly.
+        feedback: Feedback string.
+
+    """
+    if exercise not in EXERCISES:
+        return (False, "Exercise string not recognized.")
+    side, metrics = chunked_metrics(load_keypoints(filename), EXERCISES[exercise], chunk_frames, smooth, window)
+    if verbose:
+        return report_metrics(exercise, side, metrics)
+    return check_metrics(exercise, metrics)
@@ -0,0 +1,394 @@
+"""Classifiers of pose sequences.
+
+ExerciseClassifier recognizes which exercise a clip shows from a compact
+descriptor of the clip, by nearest neighbours among the descriptors of labelled
+template clips, such as the poses_compressed/<exercise>/ fixtures.
+
+DTWClassifier labels clips, for instance as performed well or badly, by their
+nearest neighbours in DTW distance among the feature series of template clips,
+as in the DTW notebooks, pruning most templates with lower bounds.
+"""
+
+import hashlib
+import heapq
+import os
+
+import numpy as np
+
+import dtw
+import instrument
+from batch import find_files, folder_exercise
+from features import FEATURE_VERSION, extract
+from kinematics import part_index, present, segment_angles, segment_vecs, select_side, side_parts
+from parse import load_ps
+from utils import get_labels
+
+# Bump when the descriptor changes, so saved indexes are rebuilt.
+DESCRIPTOR_VERSION = 1
+
+HIST_BINS = 8
+TRAJECTORY_POINTS = 16
+
+# Default file of the saved template index.
+INDEX_PATH = 'exercise_index.npz'
+
+
+def _vote(neighbours):
+    # most common label among neighbours ordered by distance, ties going to the closest
+    names, first, counts = np.unique(neighbours, return_index=True, return_counts=True)
+    best = np.lexsort((first, -counts))[0]
+    return names[best], counts[best]
+
+
+def _histogram(values):
+    counts = np.histogram(values, bins=HIST_BINS, range=(0.0, 180.0))[0]
+    return counts / max(len(values), 1)
+
+
+def _resample(values, num_points):
+    # (N, ...) values linearly resampled to num_points frames
+    if len(values) == 0:
+        return np.zeros((num_points,) + values.shape[1:])
+    if len(values) == 1:
+        return np.repeat(values, num_points, axis=0)
+    positions = np.linspace(0, len(values) - 1, num_points)
+    flat = values.reshape((len(values), -1))
+    resampled = np.stack([np.interp(positions, np.arange(len(values)), column) for column in flat.T], axis=1)
+    return resampled.reshape((num_points,) + values.shape[1:])
+
+
+def descriptor(pose_seq):
+    """Fixed-length descriptor of the motion in a PoseSequence.
+
+    The descriptor is made of, for the arm seen most consistently:
+    histograms of the elbow, torso-arm and upper arm-torso angles; the motion
+    energy (standard deviation of x and y) of the neck and of both arms; and
+    the wrist position relative to the shoulder, resampled to a fixed number of
+    frames. x is mirrored for the left arm so both sides look alike.
+
+    Returns:
+        1-D float64 array.
+    """
+    exists = pose_seq.exists
+    keypoints = pose_seq.keypoints
+    side = select_side(exists)
+    other = 'left' if side == 'right' else 'right'
+    shoulder, elbow, wrist, hip = side_parts(side, 'shoulder', 'elbow', 'wrist', 'hip')
+    mirror = -1.0 if side == 'left' else 1.0
+
+    arm = keypoints[present(exists, (shoulder, elbow, wrist))]
+    torso = keypoints[present(exists, (shoulder, elbow, wrist, hip, 'neck'))]
+    histograms = [
+        _histogram(segment_angles(arm, (shoulder, elbow), (wrist, elbow))),
+        _histogram(segment_angles(torso, (shoulder, hip), (shoulder, wrist))),
+        _histogram(segment_angles(torso, (shoulder, elbow), ('neck', hip))),
+    ]
+
+    energy = []
+    for part in ['neck'] + side_parts(side, 'shoulder', 'elbow', 'wrist') + side_parts(other, 'shoulder', 'elbow', 'wrist'):
+        positions = keypoints[exists[:, part_index(part)], part_index(part), :2]
+        energy.append(np.std(positions, axis=0) if len(positions) > 1 else np.zeros(2))
+
+    trajectory = segment_vecs(arm, wrist, shoulder).astype(np.float64) * [mirror, 1.0]
+    return np.concatenate(histograms + energy + [_resample(trajectory, TRAJECTORY_POINTS).ravel()])
+
+
+class ExerciseClassifier:
+    """k nearest neighbour exercise classifier over standardized clip descriptors.
+
+    Args:
+        k: number of neighbours voting for the exercise.
+    """
+
+    def __init__(self, k=5):
+        self.k = k
+        self.descriptors = None
+        self.labels = None
+        self.mean = None
+        self.std = None
+        self.fingerprint = ''
+
+    def fit(self, descriptors, labels):
+        """Index (T, D) template descriptors with their exercise labels."""
+        descriptors = np.asarray(descriptors, dtype=np.float64)
+        self.labels = np.asarray(labels, dtype=str)
+        self.mean = descriptors.mean(axis=0)
+        self.std = descriptors.std(axis=0)
+        self.std[self.std == 0] = 1.0
+        self.descriptors = (descriptors - self.mean) / self.std
+        return self
+
+    def distances(self, descriptors):
+        """(Q, T) squared Euclidean distances from query descriptors to every template."""
+        queries = (np.atleast_2d(descriptors) - self.mean) / self.std
+        sq = (np.sum(queries ** 2, axis=1)[:, np.newaxis] + np.sum(self.descriptors ** 2, axis=1)[np.newaxis, :]
+              - 2.0 * queries @ self.descriptors.T)
+        return np.maximum(sq, 0.0)
+
+    def predict(self, descriptors, exclude_self=False):
+        """Classify query descriptors.
+
+        Args:
+            descriptors: (Q, D) or (D,) query descriptors.
+            exclude_self: ignore the template at distance zero, for leave-one-out tests
+                on the templates themselves.
+
+        Returns:
+            labels: (Q,) predicted exercise names.
+            confidence: (Q,) fraction of the k neighbours voting for the prediction.
+        """
+        distances = self.distances(descriptors)
+        if exclude_self:
+            distances[distances <= 1e-12] = np.inf
+        k = min(self.k, distances.shape[1])
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        # order neighbours so ties in the vote go to the closest exercise
+        order = np.argsort(np.take_along_axis(distances, nearest, axis=1), axis=1)
+        neighbours = self.labels[np.take_along_axis(nearest, order, axis=1)]
+
+        votes = [_vote(row) for row in neighbours]
+        return np.array([label for label, _ in votes]), np.array([count / k for _, count in votes])
+
+    def save(self, filename):
+        np.savez(filename, version=DESCRIPTOR_VERSION, k=self.k, descriptors=self.descriptors, labels=self.labels,
+                 mean=self.mean, std=self.std, fingerprint=self.fingerprint)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a saved classifier, or return None if it was saved with another DESCRIPTOR_VERSION."""
+        with np.load(filename) as data:
+            if int(data['version']) != DESCRIPTOR_VERSION:
+                return None
+            classifier = cls(int(data['k']))
+            classifier.descriptors = data['descriptors']
+            classifier.labels = data['labels']
+            classifier.mean = data['mean']
+            classifier.std = data['std']
+            classifier.fingerprint = str(data['fingerprint'])
+        return classifier
+
+
+def template_fingerprint(paths):
+    """Hash of the names, sizes and modification times of template files."""
+    h = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        h.update('{}:{}:{}\n'.format(path, stat.st_size, stat.st_mtime_ns).encode())
+    return h.hexdigest()
+
+
+def build_index(folder='poses_compressed', k=5):
+    """Fit an ExerciseClassifier to every template file under folder, labelled by its exercise folder."""
+    paths = [path for path in find_files(folder) if folder_exercise(path)]
+    if not paths:
+        raise ValueError('No template clips in exercise folders under: {}'.format(folder))
+    classifier = ExerciseClassifier(k).fit([descriptor(load_ps(path)) for path in paths],
+                                           [folder_exercise(path) for path in paths])
+    classifier.fingerprint = template_fingerprint(paths)
+    return classifier
+
+
+def load_index(folder='poses_compressed', filename=INDEX_PATH, k=5):
+    """Load the saved template index, rebuilding and saving it if templates have changed."""
+    paths = [path for path in find_files(folder) if folder_exercise(path)]
+    classifier = ExerciseClassifier.load(filename) if os.path.exists(filename) else None
+    if classifier is None or classifier.fingerprint != template_fingerprint(paths) or classifier.k != k:
+        classifier = build_index(folder, k)
+        classifier.save(filename)
+    return classifier
+
+
+def classify_exercise(pose_seq, classifier):
+    """Return the (exercise name, confidence) of a PoseSequence."""
+    labels, confidence = classifier.predict(descriptor(pose_seq))
+    return str(labels[0]), float(confidence[0])
+
+
+# Template indexes loaded by detect_exercise, by template folder and index file.
+_indexes = {}
+
+
+def detect_exercise(pose_seq, folder='poses_compressed', filename=INDEX_PATH):
+    """Return the (exercise name, confidence) of a PoseSequence, loading the template index once."""
+    with instrument.span('detect_exercise'):
+        if (folder, filename) not in _indexes:
+            _indexes[(folder, filename)] = load_index(folder, filename)
+        return classify_exercise(pose_seq, _indexes[(folder, filename)])
+
+
+# Feature series compared by the DTW notebooks of each exercise.
+DTW_FEATURES = {
+    'bicep_curl': ('upper_arm_torso_angle', 'upper_arm_forearm_angle'),
+    'front_raise': ('torso_arm_angle',),
+    'shoulder_press': ('back_vec_x', 'upper_arm_forearm_angle'),
+    'shoulder_shrug': ('shoulder_height', 'upper_arm_forearm_angle'),
+}
+
+
+class DTWClassifier:
+    """k nearest neighbour classifier of pose sequences in DTW distance.
+
+    Every clip is reduced to its feature series, each resampled to the same
+    number of frames and stacked into one multivariate series, z-normalized with
+    the mean and standard deviation of each feature over all templates. Per clip
+    normalization would hide the ranges of motion that tell good clips from bad.
+
+    As every series has the same length, the LB_Kim end points and LB_Keogh
+    envelopes of the templates are computed once in fit, and a query is bounded
+    against all templates with a few array operations, taking LB_Keogh both
+    ways round: the query against each template envelope, and each template
+    against the query envelope. Templates are then
+    visited in increasing order of their bound: they are pruned by LB_Kim, then
+    LB_Keogh, against the k-th best distance so far, and the DTW computations
+    left are abandoned early.
+
+    Args:
+        features: names from features.FEATURES.
+        k: number of neighbours voting for the label.
+        length: number of frames every feature series is resampled to.
+        constraint, window: as passed to dtw.dtw, with window in resampled frames.
+        smooth: median filter kernel size for the feature series, or 0.
+    """
+
+    def __init__(self, features=('upper_arm_forearm_angle',), k=1, length=64, constraint='sakoe_chiba', window=None,
+                 smooth=5):
+        self.features = tuple(features)
+        self.k = k
+        self.length = length
+        self.constraint = constraint
+        self.window = window
+        self.smooth = smooth
+        self.labels = None
+        self.mean = None
+        self.std = None
+        self.templates = None
+        self.first = None
+        self.last = None
+        self.lower = None
+        self.upper = None
+        self.stats = {'lb_kim': 0, 'lb_keogh': 0, 'abandoned': 0, 'computed': 0}
+
+    def series(self, pose_seq):
+        """(length, features) feature series of a PoseSequence, before normalization."""
+        return np.stack([_resample(series, self.length) for series in extract(pose_seq, self.features, self.smooth)],
+                        axis=1)
+
+    def fit(self, pose_seqs, labels):
+        """Index template PoseSequences with their labels."""
+        return self.fit_series([self.series(pose_seq) for pose_seq in pose_seqs], labels)
+
+    def fit_series(self, series, labels):
+        """Index (length, features) template series, as returned by series, with their labels."""
+        series = np.asarray(series, dtype=np.float64)
+        self.labels = np.asarray(labels)
+        self.mean = series.mean(axis=(0, 1))
+        self.std = series.std(axis=(0, 1))
+        self.std[self.std == 0] = 1.0
+        self.templates = (series - self.mean) / self.std
+        self.first = self.templates[:, 0]
+        self.last = self.templates[:, -1]
+        envelopes = [dtw.envelope(template, self.length, self.constraint, self.window) for template in self.templates]
+        self.lower = np.array([lower for lower, _ in envelopes])
+        self.upper = np.array([upper for _, upper in envelopes])
+        return self
+
+    def bounds(self, query):
+        """LB_Kim and LB_Keogh bounds of the DTW distances from a normalized query to every template."""
+        kim = np.sqrt(np.sum(np.square(query[0] - self.first), axis=1) +
+                      np.sum(np.square(query[-1] - self.last), axis=1))
+        excess = np.maximum(query - self.upper, 0.0) + np.maximum(self.lower - query, 0.0)
+        # the envelope of the query around each template bounds the distance too
+        lower, upper = dtw.envelope(query, self.length, self.constraint, self.window)
+        reverse = np.maximum(self.templates - upper, 0.0) + np.maximum(lower - self.templates, 0.0)
+        keogh = np.sqrt(np.maximum(np.sum(np.square(excess), axis=(1, 2)), np.sum(np.square(reverse), axis=(1, 2))))
+        return kim, keogh
+
+    def neighbours(self, series):
+        """Find the k templates nearest to a (length, features) series in DTW distance.
+
+        Returns:
+            indices: template indices, nearest first.
+            distances: their DTW distances.
+            stats: dict of template counts pruned by 'lb_kim', 'lb_keogh', and
+                'abandoned' or 'computed' by dtw, as in dtw.nearest.
+        """
+        query = (np.asarray(series, dtype=np.float64) - self.mean) / self.std
+        kim, keogh = self.bounds(query)
+        bound = np.maximum(kim, keogh)
+        stats = {'lb_kim': 0, 'lb_keogh': 0, 'abandoned': 0, 'computed': 0}
+        # max-heap of the k best (distance, index) so far, by negated distance
+        best = []
+        kth = np.inf
+
+        order = np.argsort(bound, kind='stable')
+        for position, index in enumerate(order):
+            if bound[index] >= kth:
+                # every template left has a bound at least as large
+                rest = order[position:]
+                stats['lb_kim'] += int(np.sum(kim[rest] >= kth))
+                stats['lb_keogh'] += int(np.sum(kim[rest] < kth))
+                break
+            dist = dtw.dtw(query, self.templates[index], self.constraint, self.window, max_dist=kth)
+            if np.isinf(dist) and np.isfinite(kth):
+                stats['abandoned'] += 1
+            else:
+                stats['computed'] += 1
+            if dist < kth:
+                heapq.heappush(best, (-dist, -index))
+                if len(best) > self.k:
+                    heapq.heappop(best)
+                if len(best) == self.k:
+                    kth = -best[0][0]
+
+        for key, count in stats.items():
+            self.stats[key] += count
+        best = sorted((-dist, -index) for dist, index in best)
+        return np.array([index for _, index in best], dtype=np.intp), np.array([dist for dist, _ in best]), stats
+
+    def predict(self, pose_seqs):
+        """Classify PoseSequences, see predict_series."""
+        return self.predict_series([self.series(pose_seq) for pose_seq in pose_seqs])
+
+    def predict_series(self, series):
+        """Classify (length, features) series.
+
+        Returns:
+            labels: predicted label of each series.
+            confidence: fraction of the k neighbours voting for the prediction.
+        """
+        votes = [_vote(self.labels[self.neighbours(query)[0]]) for query in series]
+        k = min(self.k, len(self.labels))
+        return np.array([label for label, _ in votes]), np.array([count / k for _, count in votes])
+
+    def save(self, filename):
+        np.savez(filename, version=FEATURE_VERSION, features=np.array(self.features), k=self.k, length=self.length,
+                 constraint=self.constraint, window=-1 if self.window is None else self.window, smooth=self.smooth,
+                 labels=self.labels, mean=self.mean, std=self.std, templates=self.templates, first=self.first,
+                 last=self.last, lower=self.lower, upper=self.upper)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a saved classifier, or return None if it was saved with another FEATURE_VERSION."""
+        with np.load(filename) as data:
+            if int(data['version']) != FEATURE_VERSION:
+                return None
+            window = int(data['window'])
+            classifier = cls([str(name) for name in data['features']], int(data['k']), int(data['length']),
+                             str(data['constraint']), None if window < 0 else window, int(data['smooth']))
+            for name in ('labels', 'mean', 'std', 'templates', 'first', 'last', 'lower', 'upper'):
+                setattr(classifier, name, data[name])
+        return classifier
+
+
+def build_quality_classifier(folder, exercise, **kwargs):
+    """Fit a DTWClassifier to the clips of one exercise under folder, labelled 1 if good and 0 if bad by name.
+
+    Keyword arguments are passed to DTWClassifier, with the DTW_FEATURES of the
+    exercise as the default features.
+    """
+    paths = [path for path in find_files(folder) if folder_exercise(path) == exercise]
+    if not paths:
+        raise ValueError('No {} clips under: {}'.format(exercise, folder))
+    kwargs.setdefault('features', DTW_FEATURES[exercise])
+    return DTWClassifier(**kwargs).fit([load_ps(path) for path in paths],
+                                       get_labels([os.path.basename(path) for path in paths]))
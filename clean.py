@@ -0,0 +1,331 @@
+"""Cleaning of raw OpenPose keypoints before a PoseSequence is built.
+
+Cleaning works on (N, 18, 3) arrays in pixels and runs in three steps, each
+vectorized across every joint and frame:
+
+1. Outlier rejection: parts that make a bone much longer than its typical length
+   are marked missing. Bones only get shorter from foreshortening, so only
+   stretched bones are rejected.
+2. Gap interpolation: runs of missing or low confidence frames no longer than
+   max_gap are filled by interpolation between the detections on either side,
+   weighted by their confidence.
+3. Smoothing: a median or Savitzky-Golay filter over time, weighting each frame
+   by its confidence.
+
+StreamCleaner does the same incrementally for streaming input, one frame at a
+time, holding the last position across short gaps and smoothing with a One-Euro
+filter whose step towards each detection shrinks with its confidence, since
+neither interpolation nor a centered filter can see ahead.
+"""
+
+import warnings
+
+import numpy as np
+
+from kinematics import part_index
+
+# Bones of the COCO skeleton, as (parent, child) pairs of the tree rooted at the neck.
+BONES = [
+    ('neck', 'rshoulder'), ('rshoulder', 'relbow'), ('relbow', 'rwrist'),
+    ('neck', 'lshoulder'), ('lshoulder', 'lelbow'), ('lelbow', 'lwrist'),
+    ('neck', 'rhip'), ('rhip', 'rknee'), ('rknee', 'rankle'),
+    ('neck', 'lhip'), ('lhip', 'lknee'), ('lknee', 'lankle'),
+    ('neck', 'nose'), ('nose', 'reye'), ('reye', 'rear'), ('nose', 'leye'), ('leye', 'lear'),
+]
+_PARENTS = np.array([part_index(parent) for parent, _ in BONES])
+_CHILDREN = np.array([part_index(child) for _, child in BONES])
+
+# (bones, parts) matrices of the parts at either end of each bone, and at its child end.
+_INCIDENCE = np.zeros((len(BONES), 18), dtype=np.int64)
+_INCIDENCE[np.arange(len(BONES)), _PARENTS] = 1
+_INCIDENCE[np.arange(len(BONES)), _CHILDREN] = 1
+_CHILD_INCIDENCE = np.zeros((len(BONES), 18), dtype=np.int64)
+_CHILD_INCIDENCE[np.arange(len(BONES)), _CHILDREN] = 1
+
+
+def bone_lengths(keypoints):
+    """(N, bones) lengths of the BONES, NaN where either end is missing."""
+    exists = keypoints[..., 2] != 0.0
+    diff = keypoints[..., _PARENTS, :2] - keypoints[..., _CHILDREN, :2]
+    lengths = np.hypot(diff[..., 0], diff[..., 1])
+    return np.where(exists[..., _PARENTS] & exists[..., _CHILDREN], lengths, np.nan)
+
+
+def reference_lengths(keypoints):
+    """Median length of each bone over the frames where it exists, NaN if it never does."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(bone_lengths(keypoints).reshape((-1, len(BONES))), axis=0)
+
+
+def reject_outliers(keypoints, tolerance=0.6, reference=None):
+    """Mark parts missing where they stretch a bone beyond (1 + tolerance) times its reference length.
+
+    A part with two or more bones is rejected if all of its bones are stretched.
+    Bones still stretched after that are blamed on their child part.
+
+    Args:
+        keypoints: (N, 18, 3) keypoints in pixels.
+        tolerance: allowed stretch as a fraction of the reference length.
+        reference: reference length of each bone, or None for reference_lengths.
+
+    Returns:
+        (N, 18, 3) copy of the keypoints with rejected parts set to zero.
+    """
+    keypoints = np.array(keypoints, dtype=np.float64)
+    if reference is None:
+        reference = reference_lengths(keypoints)
+
+    def stretched(keypoints):
+        lengths = bone_lengths(keypoints)
+        with np.errstate(invalid='ignore'):
+            return lengths > (1.0 + tolerance) * reference, ~np.isnan(lengths)
+
+    bad, existing = stretched(keypoints)
+    num_bad = bad.astype(np.int64) @ _INCIDENCE
+    num_existing = existing.astype(np.int64) @ _INCIDENCE
+    keypoints[(num_bad >= 2) & (num_bad == num_existing)] = 0.0
+
+    bad, _ = stretched(keypoints)
+    keypoints[(bad.astype(np.int64) @ _CHILD_INCIDENCE) > 0] = 0.0
+    return keypoints
+
+
+def interpolate_gaps(keypoints, max_gap=5):
+    """Fill runs of at most max_gap missing frames of each part by confidence-weighted interpolation.
+
+    Positions are interpolated between the detections on either side with
+    weights of their linear interpolation weights times their confidence, so
+    a filled part leans towards the more confident of its neighbours.
+    Confidence is interpolated linearly, so filled parts exist with the
+    confidence of their neighbours. Gaps at the start or end of the sequence
+    are left missing.
+    """
+    keypoints = np.array(keypoints, dtype=np.float64)
+    n = len(keypoints)
+    valid = keypoints[:, :, 2] != 0.0
+    frames = np.arange(n)[:, np.newaxis]
+
+    # last valid frame at or before, and first valid frame at or after, each frame
+    prev = np.maximum.accumulate(np.where(valid, frames, -1), axis=0)
+    following = np.minimum.accumulate(np.where(valid, frames, n)[::-1], axis=0)[::-1]
+    fill = ~valid & (prev >= 0) & (following < n) & (following - prev - 1 <= max_gap)
+    if not fill.any():
+        return keypoints
+
+    parts = np.arange(18)[np.newaxis, :]
+    before = keypoints[np.clip(prev, 0, n - 1), parts]
+    after = keypoints[np.clip(following, 0, n - 1), parts]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = (frames - prev) / (following - prev)
+        weight_after = t * after[:, :, 2]
+        weight_after = weight_after / (weight_after + (1.0 - t) * before[:, :, 2])
+    filled = before + t[:, :, np.newaxis] * (after - before)
+    filled[:, :, :2] = before[:, :, :2] + weight_after[:, :, np.newaxis] * (after[:, :, :2] - before[:, :, :2])
+    keypoints[fill] = filled[fill]
+    return keypoints
+
+
+def weighted_median(values, weights):
+    """Weighted median along the last axis, ignoring NaN values and the weights of them.
+
+    Where the weights below and above a value are exactly equal, the two values
+    around it are averaged, so that equal weights give the usual median.
+    """
+    weights = np.where(np.isnan(values), 0.0, weights)
+    order = np.argsort(values, axis=-1)
+    values = np.take_along_axis(values, order, axis=-1)
+    cumulative = np.cumsum(np.take_along_axis(weights, order, axis=-1), axis=-1)
+    half = cumulative[..., -1:] / 2.0
+    at_half = np.isclose(cumulative, half)
+    lower = np.take_along_axis(values, np.argmax((cumulative > half) | at_half, axis=-1)[..., np.newaxis], axis=-1)
+    upper = np.take_along_axis(values, np.argmax((cumulative > half) & ~at_half, axis=-1)[..., np.newaxis], axis=-1)
+    median = (lower[..., 0] + upper[..., 0]) / 2.0
+    return np.where(half[..., 0] > 0.0, median, np.nan)
+
+
+def weighted_savgol(windows, weights, polyorder):
+    """Savitzky-Golay smoothing of the centers of windows, as a weighted least squares fit.
+
+    Args:
+        windows: (..., 2, window) x and y positions over odd windows.
+        weights: (..., window) weight of each frame of the windows.
+        polyorder: polynomial order.
+
+    Returns:
+        (..., 2) smoothed positions, NaN where a window has a NaN position.
+    """
+    window = windows.shape[-1]
+    # the result is NaN there anyway, but the normal equations must stay solvable
+    weights = np.where(np.isnan(windows).any(axis=-2), 1.0, weights)
+    vander = np.vander(np.arange(window) - window // 2, polyorder + 1, increasing=True)
+    # normal equations (V^T W V) a = V^T W y of every window, the center being a[0]
+    normal = np.einsum('wi,...w,wj->...ij', vander, weights, vander)
+    rhs = np.einsum('wi,...w,...cw->...ic', vander, weights, windows)
+    return np.linalg.solve(normal, rhs)[..., 0, :]
+
+
+def smooth_keypoints(keypoints, method='median', window=5, polyorder=2):
+    """Smooth the positions of every part over time, ignoring missing frames.
+
+    Frames are weighted by the confidence of each part: the median is a
+    weighted median, and the Savitzky-Golay filter a weighted least squares
+    fit of the polynomial, so uncertain detections pull the result less.
+
+    Args:
+        keypoints: (N, 18, 3) keypoints.
+        method: 'median', 'savgol' or 'none'.
+        window: odd filter length in frames.
+        polyorder: polynomial order of the Savitzky-Golay filter.
+
+    Returns:
+        (N, 18, 3) copy of the keypoints; missing parts stay missing, and parts
+        whose Savitzky-Golay window reaches a missing frame are not smoothed.
+    """
+    keypoints = np.array(keypoints, dtype=np.float64)
+    if method == 'none' or window <= 1 or len(keypoints) == 0:
+        return keypoints
+    valid = keypoints[:, :, 2] != 0.0
+    positions = np.where(valid[:, :, np.newaxis], keypoints[:, :, :2], np.nan)
+    pad = ((window // 2, window // 2), (0, 0), (0, 0))
+    windows = np.lib.stride_tricks.sliding_window_view(np.pad(positions, pad, mode='edge'), window, axis=0)
+    # (N, 18, 1, window) confidences, shared by x and y
+    weights = np.lib.stride_tricks.sliding_window_view(
+        np.pad(keypoints[:, :, 2:], pad, mode='edge'), window, axis=0)
+
+    if method == 'median':
+        smoothed = weighted_median(windows, weights)
+    elif method == 'savgol':
+        smoothed = weighted_savgol(windows, weights[:, :, 0], polyorder)
+    else:
+        raise ValueError('Unknown smoothing method: {}'.format(method))
+
+    keep = valid[:, :, np.newaxis] & ~np.isnan(smoothed)
+    keypoints[:, :, :2] = np.where(keep, smoothed, keypoints[:, :, :2])
+    return keypoints
+
+
+def clean_keypoints(keypoints, min_confidence=0.0, tolerance=0.6, max_gap=5, smooth='median', window=5):
+    """Clean a whole (N, 18, 3) keypoint sequence in pixels, as given to PoseSequence.
+
+    Args:
+        keypoints: (N, 18, 3) raw keypoints.
+        min_confidence: parts detected with lower confidence are treated as missing.
+        tolerance: allowed bone stretch, as passed to reject_outliers.
+        max_gap: longest run of missing frames to interpolate.
+        smooth: smoothing method, as passed to smooth_keypoints.
+        window: smoothing filter length in frames.
+
+    Returns:
+        (N, 18, 3) cleaned float64 keypoints.
+    """
+    keypoints = np.array(keypoints, dtype=np.float64)
+    keypoints[keypoints[:, :, 2] < min_confidence] = 0.0
+    keypoints = reject_outliers(keypoints, tolerance)
+    keypoints = interpolate_gaps(keypoints, max_gap)
+    return smooth_keypoints(keypoints, smooth, window)
+
+
+class OneEuroFilter:
+    """One-Euro low-pass filter of an array of positions, with one state per element.
+
+    The cutoff frequency rises with speed, so slow motion is smoothed strongly
+    and fast motion lags little.
+
+    Args:
+        fps: frame rate of the input.
+        min_cutoff: cutoff frequency in Hz at zero speed.
+        beta: increase of the cutoff frequency per pixel per second of speed.
+        d_cutoff: cutoff frequency in Hz of the speed estimate.
+    """
+
+    def __init__(self, fps=30.0, min_cutoff=1.5, beta=0.01, d_cutoff=1.0):
+        self.dt = 1.0 / fps
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.value = None
+        self.speed = None
+
+    def _alpha(self, cutoff):
+        return 1.0 / (1.0 + 1.0 / (2 * np.pi * cutoff * self.dt))
+
+    def __call__(self, value, reset, weight=1.0):
+        """Filter the next value, restarting the elements where reset is True.
+
+        weight, between 0 and 1 per element, scales the step towards the value,
+        so that a value of weight 0 leaves the filtered value where it was.
+        """
+        if self.value is None:
+            self.value = np.array(value, dtype=np.float64)
+            self.speed = np.zeros_like(self.value)
+            return self.value.copy()
+
+        speed = (value - self.value) / self.dt
+        speed = self.speed + self._alpha(self.d_cutoff) * (speed - self.speed)
+        alpha = weight * self._alpha(self.min_cutoff + self.beta * np.abs(speed))
+        filtered = self.value + alpha * (value - self.value)
+
+        self.value = np.where(reset, value, filtered)
+        self.speed = np.where(reset, 0.0, speed)
+        return self.value.copy()
+
+
+class StreamCleaner:
+    """Clean keypoints one frame at a time, as they arrive.
+
+    Bone reference lengths are the running means of the bones accepted so far,
+    and are only used once a bone has been seen in min_frames frames. Parts
+    missing for at most max_gap frames keep their last position. The One-Euro
+    filter steps towards each detection in proportion to its confidence.
+
+    Args:
+        fps: frame rate of the input, for the One-Euro filter.
+        min_confidence, tolerance, max_gap: as passed to clean_keypoints.
+        min_frames: frames a bone must be seen in before outliers are rejected.
+        min_cutoff, beta: as passed to OneEuroFilter.
+    """
+
+    def __init__(self, fps=30.0, min_confidence=0.0, tolerance=0.6, max_gap=5, min_frames=10,
+                 min_cutoff=1.5, beta=0.01):
+        self.min_confidence = min_confidence
+        self.tolerance = tolerance
+        self.max_gap = max_gap
+        self.min_frames = min_frames
+        self.length_sums = np.zeros(len(BONES))
+        self.length_counts = np.zeros(len(BONES))
+        self.last = np.zeros((18, 3))
+        self.missed = np.full(18, max_gap + 1)
+        self.filter = OneEuroFilter(fps, min_cutoff, beta)
+
+    def update(self, keypoints):
+        """Return the cleaned 18 * 3 keypoints of the next frame."""
+        keypoints = np.array(keypoints, dtype=np.float64)
+        keypoints[keypoints[:, 2] < self.min_confidence] = 0.0
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            reference = np.where(self.length_counts >= self.min_frames, self.length_sums / self.length_counts, np.nan)
+        keypoints = reject_outliers(keypoints[np.newaxis], self.tolerance, reference)[0]
+        lengths = bone_lengths(keypoints)
+        seen = ~np.isnan(lengths)
+        self.length_sums[seen] += lengths[seen]
+        self.length_counts[seen] += 1
+
+        valid = keypoints[:, 2] != 0.0
+        restarted = valid & (self.missed > 0)
+        self.missed = np.where(valid, 0, self.missed + 1)
+        held = ~valid & (self.missed <= self.max_gap) & (self.last[:, 2] != 0.0)
+        keypoints[held] = self.last[held]
+
+        confidence = np.clip(keypoints[:, 2:], 0.0, 1.0)
+        keypoints[:, :2] = self.filter(keypoints[:, :2], restarted[:, np.newaxis], confidence)
+        keypoints[~(valid | held)] = 0.0
+        self.last = keypoints
+        return keypoints
+
+
+def clean_stream(frames, cleaner=None):
+    """Clean the keypoints of a stream of (arrival time, keypoints) frames."""
+    cleaner = cleaner or StreamCleaner()
+    for arrival, keypoints in frames:
+        yield arrival, cleaner.update(keypoints)
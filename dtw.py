@@ -0,0 +1,244 @@
+"""Dynamic time warping with path constraints, early abandoning and lower bounds.
+
+Sequences are array-likes of shape (n,) or (n, dims). The cost of matching two
+elements is their squared euclidean distance, and distances are the square root
+of the cheapest warping path cost, as in utils.DTWDistance.
+"""
+
+import numpy as np
+
+CONSTRAINTS = ('full', 'sakoe_chiba', 'itakura')
+
+
+def as_sequence(s):
+    """Return a sequence as a float64 (n, dims) array."""
+    s = np.asarray(s, dtype=np.float64)
+    if s.ndim == 1:
+        s = s[:, np.newaxis]
+    return s
+
+
+def band_width(n, m, window):
+    """Effective Sakoe-Chiba band radius for sequences of lengths n and m."""
+    return max(window, abs(n - m))
+
+
+def dtw(s1, s2, constraint='full', window=None, slope=2.0, max_dist=np.inf):
+    """Compute the DTW distance between two sequences.
+
+    The cost matrix is filled one anti-diagonal at a time, keeping only the last
+    three anti-diagonals, so memory is O(min(n, m)).
+
+    Args:
+        s1, s2: sequences of shape (n,) or (n, dims).
+        constraint: one of 'full', 'sakoe_chiba' or 'itakura'.
+        window: Sakoe-Chiba band radius. Widened to the length difference of the
+            sequences if necessary. Defaults to a tenth of the longer sequence.
+        slope: maximum Itakura parallelogram slope, greater than 1. No warping
+            path is allowed between sequences whose lengths, less one, differ
+            by a larger factor.
+        max_dist: abandon the computation and return inf as soon as the distance
+            is known to exceed this value.
+
+    Returns:
+        DTW distance, or inf if abandoned or no warping path is allowed.
+
+    """
+    if constraint not in CONSTRAINTS:
+        raise ValueError('Unknown DTW constraint: {}'.format(constraint))
+
+    s1 = as_sequence(s1)
+    s2 = as_sequence(s2)
+    # index the anti-diagonals by position in the shorter sequence
+    if len(s1) > len(s2):
+        s1, s2 = s2, s1
+    n, m = len(s1), len(s2)
+    if n == 0:
+        return 0.0 if m == 0 else np.inf
+    # every warping path has the mean slope of the diagonal, steeper than the parallelogram allows
+    if constraint == 'itakura' and m - 1 > slope * (n - 1):
+        return np.inf
+
+    if constraint == 'sakoe_chiba':
+        if window is None:
+            window = m // 10
+        radius = band_width(n, m, window)
+    else:
+        radius = n + m
+    use_itakura = constraint == 'itakura' and n > 1
+
+    # univariate sequences skip the sum over dimensions
+    if s1.shape[1] == 1:
+        s1 = s1[:, 0]
+        s2 = s2[:, 0]
+    s2_reversed = np.ascontiguousarray(s2[::-1])
+    abandon = np.isfinite(max_dist)
+    # cell (i, j) of the 1-indexed cost matrix lives at index i of anti-diagonal i + j
+    prev2 = np.full(n + 1, np.inf)
+    prev1 = np.full(n + 1, np.inf)
+    cur = np.full(n + 1, np.inf)
+    prev2[0] = 0.0
+    prev1_min = np.inf
+    # index ranges written to each anti-diagonal, which must be reset before reuse
+    prev2_range, prev1_range, cur_range = (0, 0), (0, -1), (0, -1)
+
+    for d in range(2, n + m + 1):
+        lo = max(1, d - m, -((radius - d) // 2))
+        hi = min(n, d - 1, (d + radius) // 2)
+        if use_itakura:
+            lo, hi = _itakura_bounds(d, n, m, slope, lo, hi)
+
+        cur[cur_range[0]:cur_range[1] + 1] = np.inf
+        cur_range = (lo, hi)
+
+        if lo <= hi:
+            diff = s1[lo - 1:hi] - s2_reversed[m - d + lo:m - d + hi + 1]
+            cost = np.square(diff) if diff.ndim == 1 else np.einsum('ij,ij->i', diff, diff)
+            out = cur[lo:hi + 1]
+            np.minimum(prev1[lo - 1:hi], prev1[lo:hi + 1], out=out)
+            np.minimum(out, prev2[lo - 1:hi], out=out)
+            np.add(cost, out, out=out)
+            cur_min = out.min() if abandon else np.inf
+        else:
+            cur_min = np.inf
+
+        # every warping path passes through one of two consecutive anti-diagonals. Compared as a
+        # distance rather than a cost, so that the distance itself as max_dist is not abandoned to rounding
+        if abandon and np.sqrt(min(cur_min, prev1_min)) > max_dist:
+            return np.inf
+
+        prev2, prev1, cur = prev1, cur, prev2
+        prev2_range, prev1_range, cur_range = prev1_range, cur_range, prev2_range
+        prev1_min = cur_min
+
+    return np.sqrt(prev1[n])
+
+
+def _itakura_allowed(i, d, n, m, slope):
+    # Itakura parallelogram in coordinates scaled to [0, 1], with one cell of slack
+    x = (i - 1) / (n - 1)
+    y = (d - i - 1) / (m - 1)
+    slack = 1.0 / (n - 1)
+    return ((y <= slope * x + slack) and (x <= slope * y + slack) and
+            (1 - y <= slope * (1 - x) + slack) and (1 - x <= slope * (1 - y) + slack))
+
+
+def _itakura_bounds(d, n, m, slope, lo, hi):
+    # The allowed cells of an anti-diagonal are contiguous. Solve the parallelogram
+    # inequalities for i, then correct rounding at the ends with the exact test.
+    row, col, slack = 1.0 / (n - 1), 1.0 / (m - 1), 1.0 / (n - 1)
+    lower = max(((d - 1) * col + slope * row - slack) / (col + slope * row),
+                (1 + row - slope + slope * (d - 1) * col - slack) / (row + slope * col))
+    upper = min((slope * (d - 1) * col + slack + row) / (row + slope * col),
+                (slope + slope * row + slack - 1 + (d - 1) * col) / (col + slope * row))
+    first = max(lo, int(np.ceil(lower)))
+    last = min(hi, int(np.floor(upper)))
+    while first > lo and _itakura_allowed(first - 1, d, n, m, slope):
+        first -= 1
+    while first <= last and not _itakura_allowed(first, d, n, m, slope):
+        first += 1
+    while last < hi and _itakura_allowed(last + 1, d, n, m, slope):
+        last += 1
+    while last >= first and not _itakura_allowed(last, d, n, m, slope):
+        last -= 1
+    return first, last
+
+
+def lb_kim(s1, s2):
+    """Lower bound of the DTW distance from the first and last elements.
+
+    Valid for every constraint, since all warping paths match the first elements
+    with each other and the last elements with each other.
+    """
+    s1 = as_sequence(s1)
+    s2 = as_sequence(s2)
+    cost = np.sum(np.square(s1[0] - s2[0]))
+    if len(s1) > 1 or len(s2) > 1:
+        cost += np.sum(np.square(s1[-1] - s2[-1]))
+    return np.sqrt(cost)
+
+
+def envelope(s, length, constraint='full', window=None):
+    """Lower and upper envelope of a sequence for matching against another one.
+
+    Args:
+        s: sequence of shape (m,) or (m, dims).
+        length: length n of the sequence s will be matched against.
+        constraint, window: as passed to dtw.
+
+    Returns:
+        lower, upper: (n, dims) arrays bounding the elements of s that element i
+            of the other sequence can be matched with.
+
+    """
+    s = as_sequence(s)
+    m = len(s)
+    if constraint != 'sakoe_chiba':
+        return np.repeat(s.min(axis=0, keepdims=True), length, axis=0), np.repeat(s.max(axis=0, keepdims=True), length, axis=0)
+
+    if window is None:
+        window = max(length, m) // 10
+    radius = band_width(length, m, window)
+    padded_lower = np.full((length + 2 * radius, s.shape[1]), np.inf)
+    padded_upper = np.full((length + 2 * radius, s.shape[1]), -np.inf)
+    overlap = min(m, length + radius)
+    padded_lower[radius:radius + overlap] = s[:overlap]
+    padded_upper[radius:radius + overlap] = s[:overlap]
+    windows = 2 * radius + 1
+    lower = np.lib.stride_tricks.sliding_window_view(padded_lower, windows, axis=0).min(axis=-1)
+    upper = np.lib.stride_tricks.sliding_window_view(padded_upper, windows, axis=0).max(axis=-1)
+    return lower, upper
+
+
+def lb_keogh(s, lower, upper):
+    """Lower bound of the DTW distance from the envelope of the other sequence."""
+    s = as_sequence(s)
+    excess = np.maximum(s - upper, 0.0) + np.maximum(lower - s, 0.0)
+    return np.sqrt(np.sum(np.square(excess)))
+
+
+def nearest(query, candidates, constraint='full', window=None, slope=2.0):
+    """Find the candidate sequence closest to the query in DTW distance.
+
+    Candidates are pruned with LB_Kim and then LB_Keogh against the best distance
+    so far, and the remaining DTW computations are abandoned early.
+
+    Args:
+        query: sequence of shape (n,) or (n, dims).
+        candidates: list of sequences.
+        constraint, window, slope: as passed to dtw.
+
+    Returns:
+        index: index of the nearest candidate, or -1 if there are none.
+        distance: DTW distance to the nearest candidate.
+        stats: dict of candidate counts pruned by 'lb_kim', 'lb_keogh', and
+            'abandoned' or 'computed' by dtw.
+
+    """
+    query = as_sequence(query)
+    stats = {'lb_kim': 0, 'lb_keogh': 0, 'abandoned': 0, 'computed': 0}
+    best_index, best_dist = -1, np.inf
+    envelopes = {}
+
+    for index, candidate in enumerate(candidates):
+        candidate = as_sequence(candidate)
+        if lb_kim(query, candidate) >= best_dist:
+            stats['lb_kim'] += 1
+            continue
+
+        # envelope of the query for the length of the candidate
+        if len(candidate) not in envelopes:
+            envelopes[len(candidate)] = envelope(query, len(candidate), constraint, window)
+        if lb_keogh(candidate, *envelopes[len(candidate)]) >= best_dist:
+            stats['lb_keogh'] += 1
+            continue
+
+        dist = dtw(query, candidate, constraint, window, slope, max_dist=best_dist)
+        if np.isinf(dist) and np.isfinite(best_dist):
+            stats['abandoned'] += 1
+        else:
+            stats['computed'] += 1
+        if dist < best_dist:
+            best_index, best_dist = index, dist
+
+    return best_index, best_dist, stats
@@ -0,0 +1,385 @@
+"""Declarative exercise specifications and their compiled evaluation plans.
+
+An Exercise is a list of Metrics, each reducing one per-frame Feature of the
+keypoints (the angle between two segments, a component of a segment vector, or
+coordinates of parts) to a number and checking it against a threshold. Parts
+are given by name; the generic names 'shoulder', 'elbow', 'wrist' and 'hip'
+refer to the arm evaluated in sided exercises.
+
+compile_plan turns an exercise into a Plan for one side, which computes every
+distinct segment vector once, every feature once however many metrics use it,
+and all the reductions as single array operations over the stacked features.
+"""
+
+import functools
+import json
+from dataclasses import dataclass, replace
+
+import numpy as np
+
+import instrument
+from kinematics import angles, normalize, part_index, present, select_side, side_parts
+
+
+@dataclass(frozen=True)
+class Feature:
+    """Per-frame series computed from keypoints.
+
+    Attributes:
+        kind: 'angle' for the angle in degrees between the segments
+            (parts[0], parts[1]) and (parts[2], parts[3]); 'vector' for the
+            component along axis of the vector from parts[1] to parts[0]; or
+            'coordinate' for the axis coordinate of each part, one column each.
+        parts: part names.
+        axis: 0 for x or 1 for y, for vector and coordinate features.
+        mirror: negate the series when the left side is evaluated.
+    """
+    kind: str
+    parts: tuple
+    axis: int = 0
+    mirror: bool = False
+
+
+@dataclass(frozen=True)
+class Metric:
+    """A feature reduction checked against a threshold.
+
+    Attributes:
+        name: metric name.
+        feature: Feature to reduce.
+        reduce: 'min', 'max' or 'range' over the frames.
+        rule: '>' if the metric fails above the threshold, '<' if it fails below it.
+        threshold: threshold value.
+        feedback: feedback given when the threshold is crossed.
+        report: format string printing the metric value in evaluate_pose, or
+            None to print the metric name and value.
+        combine: 'mean' to average a feature with several columns, or None.
+    """
+    name: str
+    feature: Feature
+    reduce: str
+    rule: str
+    threshold: float
+    feedback: str
+    report: str = None
+    combine: str = None
+
+
+@dataclass(frozen=True)
+class Exercise:
+    """Everything needed to evaluate one exercise.
+
+    Attributes:
+        name: exercise name, as passed to evaluate_pose.
+        metrics: Metrics, checked and reported in this order.
+        required: parts that must all exist in a frame for it to be evaluated.
+        success: feedback given when no threshold is crossed.
+        sided: evaluate the arm that is seen most consistently.
+        rep_signal: (metric name, 'min' or 'max') for repetition counting: the
+            feature of that metric is the signal repetitions are segmented
+            on, reaching that end at the top of each repetition. None to use
+            the first metric reduced by 'min' or 'max', and that end.
+    """
+    name: str
+    metrics: tuple
+    required: tuple
+    success: str
+    sided: bool = True
+    rep_signal: tuple = None
+
+
+def angle(start1, end1, start2, end2):
+    return Feature('angle', (start1, end1, start2, end2))
+
+
+def vector(start, end, axis=0, mirror=False):
+    return Feature('vector', (start, end), axis, mirror)
+
+
+def coordinate(*parts, axis=1):
+    return Feature('coordinate', parts, axis)
+
+
+UPPER_ARM_FOREARM = angle('shoulder', 'elbow', 'wrist', 'elbow')
+BACK_X = vector('neck', 'hip')
+
+EXERCISES = {exercise.name: exercise for exercise in [
+    Exercise('bicep_curl', (
+        Metric('upper_arm_torso_range', angle('shoulder', 'elbow', 'neck', 'hip'), 'range', '>', 35.0,
+               'Your upper arm shows significant rotation around the shoulder when curling. Try holding your upper arm still, parallel to your chest, ' +
+               'and concentrate on rotating around your elbow only.\n',
+               'Upper arm and torso angle range: {}'),
+        Metric('upper_arm_forearm_min', UPPER_ARM_FOREARM, 'min', '>', 70.0,
+               'You are not curling the weight all the way to the top, up to your shoulders. Try to curl your arm completely so that your forearm is parallel with your torso. It may help to use lighter weight.\n',
+               'Upper arm and forearm minimum angle: {}'),
+    ), ('shoulder', 'elbow', 'wrist', 'hip', 'neck'),
+        'Exercise performed correctly! Weight was lifted fully up, and upper arm did not move significantly.',
+        rep_signal=('upper_arm_forearm_min', 'min')),
+
+    Exercise('front_raise', (
+        Metric('back_vec_range', BACK_X, 'range', '>', 0.3,
+               'Your back shows significant movement. Try keeping your back straight and still when you lift the weight. Consider using lighter weight.\n',
+               'Horizontal range of motion for back: {}'),
+        Metric('max_angle', angle('shoulder', 'hip', 'shoulder', 'wrist'), 'max', '<', 90.0,
+               'You are not lifting the weight all the way up. Finish with wrists at or slightly above shoulder level.\n',
+               'Max angle between torso and arm when lifting:  {}'),
+    ), ('shoulder', 'elbow', 'wrist', 'hip', 'neck'),
+        'Exercise performed correctly! Weight was lifted fully up, and no significant back movement was detected.',
+        rep_signal=('max_angle', 'max')),
+
+    Exercise('shoulder_shrug', (
+        Metric('shoulder_range', coordinate('lshoulder', 'rshoulder'), 'range', '<', 0.1,
+               'Your shoulders do not go through enough motion. Squeeze and raise your shoulders more through the exercise.\n',
+               'Range of motion for shoulders: {}', combine='mean'),
+        Metric('upper_forearm_angle', angle('lshoulder', 'lelbow', 'lelbow', 'lwrist'), 'max', '>', 30.0,
+               'Your arms are bending when lifting. Keep your arms straight and still, and focus on moving only the shoulders.\n',
+               'Max upper arm and forearm angle:  {}'),
+    ), ('lshoulder', 'rshoulder', 'lelbow', 'relbow', 'lwrist', 'rwrist'),
+        'Exercise performed correctly! Shoulders went through full range of motion, and arms remained straight.',
+        # image y grows downwards, so raised shoulders are a minimum
+        sided=False, rep_signal=('shoulder_range', 'min')),
+
+    Exercise('shoulder_press', (
+        Metric('back_vec_range', BACK_X, 'range', '>', 0.16,
+               'Your back shows significant movement while pressing. Try keeping your back straight and still when you lift the weight.\n',
+               'Range of motion for back: {}'),
+        # rolling shoulder too much
+        Metric('elbow_neck_dist', vector('elbow', 'neck', mirror=True), 'min', '<', -0.12,
+               'You are rolling your shoulders when you lift the weights. Try to steady your shoulders and keep them parallel.\n',
+               'Minimum distance between elbow and neck:  {}'),
+        Metric('upper_forearm_angle', UPPER_ARM_FOREARM, 'max', '<', 178,
+               'You are not lifting the weight all the way up. Extend your arms through the full range of motion. Lower the weight if necessary.\n',
+               'Max upper arm and forearm angle:  {}'),
+    ), ('shoulder', 'elbow', 'wrist', 'hip', 'neck'),
+        'Exercise performed correctly! Weight was lifted fully up, shoulders remained parallel, and no significant back movement was detected.',
+        rep_signal=('upper_forearm_angle', 'max')),
+]}
+
+
+def exercise_from_dict(spec):
+    """Build an Exercise from a JSON-style dict with the same fields.
+
+    Features are dicts of the Feature fields, and parts and rep_signal are lists.
+    """
+    metrics = []
+    for metric in spec['metrics']:
+        feature = dict(metric['feature'], parts=tuple(metric['feature']['parts']))
+        metrics.append(Metric(**dict(metric, feature=Feature(**feature))))
+    spec = dict(spec, metrics=tuple(metrics), required=tuple(spec['required']))
+    if spec.get('rep_signal') is not None:
+        spec['rep_signal'] = tuple(spec['rep_signal'])
+    return Exercise(**spec)
+
+
+def with_thresholds(exercise, thresholds):
+    """Return a copy of an Exercise with the thresholds of some of its metrics replaced.
+
+    Args:
+        exercise: Exercise to copy.
+        thresholds: dict of threshold by metric name.
+    """
+    names = set(metric.name for metric in exercise.metrics)
+    unknown = set(thresholds) - names
+    if unknown:
+        raise ValueError('Unknown metrics of {}: {}'.format(exercise.name, ', '.join(sorted(unknown))))
+    metrics = tuple(replace(metric, threshold=thresholds[metric.name]) if metric.name in thresholds
+                    else metric for metric in exercise.metrics)
+    return replace(exercise, metrics=metrics)
+
+
+def load_exercises(filename):
+    """Load a JSON file holding a list of exercise dicts, see exercise_from_dict."""
+    with open(filename) as f:
+        return [exercise_from_dict(spec) for spec in json.load(f)]
+
+
+class Plan:
+    """Fused evaluation of the metrics of one exercise on one side."""
+
+    def __init__(self, exercise, side):
+        self.exercise = exercise
+        self.side = side
+
+        def resolve(parts):
+            parts = side_parts(side, *parts) if exercise.sided else parts
+            return [part_index(part) for part in parts]
+
+        self.required = resolve(exercise.required)
+
+        # distinct features, then the distinct segment vectors they need
+        features = list(dict.fromkeys(metric.feature for metric in exercise.metrics))
+        vectors = {}
+        for feature in features:
+            parts = resolve(feature.parts)
+            if feature.kind in ('angle', 'vector'):
+                for pair in zip(parts[0::2], parts[1::2]):
+                    vectors.setdefault(tuple(pair), len(vectors))
+        self.starts = np.array([start for start, _ in vectors], dtype=np.intp)
+        self.ends = np.array([end for _, end in vectors], dtype=np.intp)
+
+        # column range of each feature in the stacked feature matrix
+        self.steps = []
+        self.columns = {}
+        width = 0
+        for feature in features:
+            parts = resolve(feature.parts)
+            sign = -1 if feature.mirror and side == 'left' else 1
+            if feature.kind == 'angle':
+                step = ('angle', (vectors[tuple(parts[0:2])], vectors[tuple(parts[2:4])]), sign)
+            elif feature.kind == 'vector':
+                step = ('vector', (vectors[tuple(parts)], feature.axis), sign)
+            elif feature.kind == 'coordinate':
+                step = ('coordinate', (parts, feature.axis), sign)
+            else:
+                raise ValueError('Unknown feature kind: {}'.format(feature.kind))
+            count = len(parts) if feature.kind == 'coordinate' else 1
+            self.steps.append(step)
+            self.columns[feature] = slice(width, width + count)
+            width += count
+
+        reductions = set(metric.reduce for metric in exercise.metrics)
+        self.need_max = bool(reductions & {'max', 'range'})
+        self.need_min = bool(reductions & {'min', 'range'})
+
+    def features(self, keypoints):
+        """Return the (N, columns) stacked features of the frames in keypoints."""
+        vecs = keypoints[:, self.starts, :2] - keypoints[:, self.ends, :2]
+        units = None
+        columns = []
+        for kind, args, sign in self.steps:
+            if kind == 'angle':
+                if units is None:
+                    units = normalize(vecs)
+                series = angles(units[:, args[0]], units[:, args[1]])[:, np.newaxis]
+            elif kind == 'vector':
+                series = vecs[:, args[0], args[1]][:, np.newaxis]
+            else:
+                series = keypoints[:, args[0], args[1]]
+            columns.append(series if sign == 1 else -series)
+        return np.concatenate(columns, axis=1)
+
+    def evaluate(self, pose_seq):
+        """Return the value of every metric of the exercise for a PoseSequence."""
+        # filter out data points where a part does not exist
+        mask = present(pose_seq.exists, self.required)
+        if instrument.ENABLED:
+            instrument.count('frames_evaluated', len(mask), exercise=self.exercise.name)
+            instrument.count('frames_dropped', len(mask) - int(np.count_nonzero(mask)), exercise=self.exercise.name)
+        keypoints = pose_seq.keypoints[mask]
+        features = self.features(keypoints)
+        maxs = np.max(features, axis=0) if self.need_max else None
+        mins = np.min(features, axis=0) if self.need_min else None
+
+        return self.reduce(maxs, mins)
+
+    def evaluate_batch(self, pose_seqs):
+        """Evaluate several PoseSequences in one pass over their concatenated frames.
+
+        Returns:
+            List of the metrics dict of each PoseSequence, as returned by
+            evaluate, or None for sequences without a frame where every
+            required part exists.
+        """
+        masks = [present(pose_seq.exists, self.required) for pose_seq in pose_seqs]
+        counts = np.array([np.count_nonzero(mask) for mask in masks])
+        if instrument.ENABLED:
+            for mask, num_valid in zip(masks, counts):
+                instrument.count('frames_evaluated', len(mask), exercise=self.exercise.name)
+                instrument.count('frames_dropped', len(mask) - int(num_valid), exercise=self.exercise.name)
+        results = [None] * len(pose_seqs)
+        nonempty = np.flatnonzero(counts)
+        if len(nonempty) == 0:
+            return results
+
+        keypoints = np.concatenate([pose_seqs[i].keypoints[masks[i]] for i in nonempty])
+        features = self.features(keypoints)
+        # start of each nonempty sequence in the concatenated frames
+        starts = np.concatenate([[0], np.cumsum(counts[nonempty])[:-1]])
+        maxs = np.maximum.reduceat(features, starts, axis=0) if self.need_max else None
+        mins = np.minimum.reduceat(features, starts, axis=0) if self.need_min else None
+        for row, i in enumerate(nonempty):
+            results[i] = self.reduce(None if maxs is None else maxs[row], None if mins is None else mins[row])
+        return results
+
+    def evaluate_chunks(self, pose_seqs):
+        """Evaluate consecutive chunks of one sequence, given as an iterable of PoseSequences.
+
+        Only the running maxima and minima of the features are carried from one
+        chunk to the next, so the chunks can be read one at a time. The metrics
+        equal those of evaluate on the whole sequence, if every chunk is
+        normalized by its mean torso length.
+
+        Raises:
+            ValueError: if no frame has every required part.
+        """
+        maxs = mins = None
+        seen = False
+        for pose_seq in pose_seqs:
+            mask = present(pose_seq.exists, self.required)
+            if instrument.ENABLED:
+                instrument.count('frames_evaluated', len(mask), exercise=self.exercise.name)
+                instrument.count('frames_dropped', len(mask) - int(np.count_nonzero(mask)), exercise=self.exercise.name)
+            if not mask.any():
+                continue
+            features = self.features(pose_seq.keypoints[mask])
+            if self.need_max:
+                chunk_maxs = np.max(features, axis=0)
+                maxs = chunk_maxs if maxs is None else np.maximum(maxs, chunk_maxs)
+            if self.need_min:
+                chunk_mins = np.min(features, axis=0)
+                mins = chunk_mins if mins is None else np.minimum(mins, chunk_mins)
+            seen = True
+        if not seen:
+            raise ValueError('No frame has every part required by {}.'.format(self.exercise.name))
+
+        return self.reduce(maxs, mins)
+
+    def reduce(self, maxs, mins):
+        """Return the value of every metric from the per-column maxima and minima of the features."""
+        metrics = {}
+        for metric in self.exercise.metrics:
+            columns = self.columns[metric.feature]
+            if metric.reduce == 'max':
+                value = maxs[columns]
+            elif metric.reduce == 'min':
+                value = mins[columns]
+            elif metric.reduce == 'range':
+                value = maxs[columns] - mins[columns]
+            else:
+                raise ValueError('Unknown reduction: {}'.format(metric.reduce))
+            metrics[metric.name] = np.average(value) if metric.combine == 'mean' else value[0]
+        return metrics
+
+
+@functools.lru_cache(maxsize=None)
+def compile_plan(exercise, side=None):
+    """Compile an Exercise into a Plan for one side, or None for unsided exercises."""
+    return Plan(exercise, side)
+
+
+def compute_metrics(pose_seq, exercise):
+    """Evaluate the metrics of an Exercise on a PoseSequence.
+
+    Returns:
+        side: 'left' or 'right' for the arm evaluated, or None if the exercise is not sided.
+        metrics: dict of the value of every metric.
+    """
+    side = select_side(pose_seq.exists) if exercise.sided else None
+    return side, compile_plan(exercise, side).evaluate(pose_seq)
+
+
+def compute_metrics_batch(pose_seqs, exercise):
+    """Evaluate the metrics of an Exercise on several PoseSequences, in one pass per side.
+
+    Returns:
+        List of (side, metrics) of each PoseSequence, as returned by
+        compute_metrics, with metrics None for sequences without a frame where
+        every required part exists.
+    """
+    sides = [select_side(pose_seq.exists) if exercise.sided else None for pose_seq in pose_seqs]
+    results = [None] * len(pose_seqs)
+    for side in dict.fromkeys(sides):
+        indices = [i for i, s in enumerate(sides) if s == side]
+        for i, metrics in zip(indices, compile_plan(exercise, side).evaluate_batch([pose_seqs[i] for i in indices])):
+            results[i] = (side, metrics)
+    return results
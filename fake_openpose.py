@@ -0,0 +1,66 @@
+"""Stand-in for OpenPoseDemo.exe, for running pose extraction jobs without OpenPose.
+
+Accepts the OpenPose options pose trainer uses and writes one keypoint JSON file
+per frame to the --write_json folder, as OpenPose does. Keypoints come from
+fake_openpose_frames: a .npy keypoint file given as --video is played back,
+and any other file gives a synthetic figure.
+
+Sample command:
+`py main.py --mode batch_json --input_folder videos --extractor "py fake_openpose.py --video {video} --write_json {output}"`
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+
+def fake_openpose_frames(video, num_frames=60):
+    """Keypoints a stand-in extractor writes for a video.
+
+    A .npy keypoint file is played back as is. Any other file gives a synthetic
+    figure standing still with small jitter, seeded by the file name.
+    """
+    if os.path.splitext(video)[1] == '.npy':
+        return np.load(video)
+    rng = np.random.default_rng(sum(os.path.basename(video).encode()))
+    # COCO standing figure, in pixels
+    base = np.array([[320, 100], [320, 150], [280, 150], [270, 220], [265, 290], [360, 150], [370, 220],
+                     [375, 290], [295, 290], [295, 390], [295, 480], [345, 290], [345, 390], [345, 480],
+                     [310, 90], [330, 90], [300, 95], [340, 95]], dtype=np.float64)
+    keypoints = np.empty((num_frames, 18, 3))
+    keypoints[:, :, :2] = base + rng.normal(0.0, 2.0, size=(num_frames, 18, 2))
+    keypoints[:, :, 2] = rng.uniform(0.6, 0.95, size=(num_frames, 18))
+    return keypoints
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OpenPose stand-in')
+    parser.add_argument('--video', type=str, required=True, help='input video, or .npy keypoint file to play back')
+    parser.add_argument('--write_json', type=str, required=True, help='output folder for JSON frames')
+    parser.add_argument('--model_pose', type=str, default='COCO', help='ignored, only COCO keypoints are written')
+    parser.add_argument('--net_resolution', type=str, default=None, help='ignored')
+    parser.add_argument('--frames', type=int, default=60, help='number of frames written for a video that is not .npy')
+    parser.add_argument('--frame_delay', type=float, default=0.0, help='seconds to sleep per frame, to simulate inference')
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.video):
+        print('Video not found: {}'.format(args.video), file=sys.stderr)
+        return 1
+
+    os.makedirs(args.write_json, exist_ok=True)
+    name = os.path.splitext(os.path.basename(args.video))[0]
+    for i, keypoints in enumerate(fake_openpose_frames(args.video, args.frames)):
+        time.sleep(args.frame_delay)
+        people = [{'pose_keypoints_2d': keypoints.ravel().tolist()}] if keypoints[:, 2].any() else []
+        with open(os.path.join(args.write_json, '{}_{:012d}_keypoints.json'.format(name, i)), 'w') as f:
+            json.dump({'version': 1.3, 'people': people}, f)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"""Per-frame feature series of pose sequences, as compared with DTW in the notebooks."""
+
+import numpy as np
+
+from kinematics import part_index, present, segment_angles, segment_vecs, select_side, side_parts
+
+# Bump when a feature definition changes, so cached results are recomputed.
+FEATURE_VERSION = 2
+
+
+def _arm_keypoints(pose_seq):
+    # keypoints of the frames where the most visible arm, hip and neck all exist
+    side = select_side(pose_seq.exists)
+    parts = side_parts(side, 'shoulder', 'elbow', 'wrist', 'hip', 'neck')
+    return side, parts, pose_seq.keypoints[present(pose_seq.exists, parts)]
+
+
+def upper_arm_torso_angle(pose_seq):
+    side, (shoulder, elbow, wrist, hip, neck), keypoints = _arm_keypoints(pose_seq)
+    return segment_angles(keypoints, (shoulder, elbow), (neck, hip))
+
+
+def upper_arm_forearm_angle(pose_seq):
+    side, (shoulder, elbow, wrist, hip, neck), keypoints = _arm_keypoints(pose_seq)
+    return segment_angles(keypoints, (shoulder, elbow), (wrist, elbow))
+
+
+def torso_arm_angle(pose_seq):
+    side, (shoulder, elbow, wrist, hip, neck), keypoints = _arm_keypoints(pose_seq)
+    return segment_angles(keypoints, (shoulder, hip), (shoulder, wrist))
+
+
+def back_vec_x(pose_seq):
+    side, (shoulder, elbow, wrist, hip, neck), keypoints = _arm_keypoints(pose_seq)
+    return segment_vecs(keypoints, neck, hip)[:, 0]
+
+
+def elbow_neck_x(pose_seq):
+    side, (shoulder, elbow, wrist, hip, neck), keypoints = _arm_keypoints(pose_seq)
+    elbow_neck = keypoints[:, part_index(elbow), 0] - keypoints[:, part_index(neck), 0]
+    return elbow_neck if side == 'right' else -elbow_neck
+
+
+def shoulder_height(pose_seq):
+    keypoints = pose_seq.keypoints[present(pose_seq.exists, ('lshoulder', 'rshoulder'))]
+    return np.mean(keypoints[:, [part_index('lshoulder'), part_index('rshoulder')], 1], axis=1)
+
+
+FEATURES = {
+    'upper_arm_torso_angle': upper_arm_torso_angle,
+    'upper_arm_forearm_angle': upper_arm_forearm_angle,
+    'torso_arm_angle': torso_arm_angle,
+    'back_vec_x': back_vec_x,
+    'elbow_neck_x': elbow_neck_x,
+    'shoulder_height': shoulder_height,
+}
+
+
+def medfilt(series, kernel_size):
+    """Median filter with zero padding at the ends, like scipy.signal.medfilt."""
+    padded = np.pad(series, kernel_size // 2)
+    return np.median(np.lib.stride_tricks.sliding_window_view(padded, kernel_size), axis=-1)
+
+
+def extract(pose_seq, names, smooth=0):
+    """Compute named feature series of a pose sequence.
+
+    Args:
+        pose_seq: PoseSequence object.
+        names: list of names from FEATURES.
+        smooth: odd median filter kernel size applied to every series, or 0.
+
+    Returns:
+        List of float64 feature series, one per name.
+    """
+    output = []
+    for name in names:
+        if not name in FEATURES:
+            raise NameError(name)
+        series = FEATURES[name](pose_seq).astype(np.float64)
+        if smooth:
+            series = medfilt(series, smooth)
+        output.append(series)
+    return output
@@ -0,0 +1,192 @@
+"""Timing spans and counters for the hot paths of pose trainer.
+
+Instrumentation is off by default, and then span returns a shared object doing
+nothing and count returns at once, so instrumented code costs a function call.
+Once enabled, spans record the number of calls and the total and longest time
+of every (name, labels) pair, and counters sum values by (name, labels). Both
+cover the current process only, not the workers of process pools.
+
+    with instrument.span('evaluate', exercise='bicep_curl'):
+        ...
+    instrument.count('frames_dropped', 3, exercise='bicep_curl')
+
+profile additionally captures cProfile and tracemalloc statistics.
+"""
+
+import contextlib
+import cProfile
+import functools
+import io
+import json
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+ENABLED = False
+
+# [calls, total seconds, max seconds] by (name, labels).
+SPANS = {}
+# Value by (name, labels).
+COUNTERS = {}
+
+_lock = threading.Lock()
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('key', 'start')
+
+    def __init__(self, key):
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        with _lock:
+            stats = SPANS.get(self.key)
+            if stats is None:
+                SPANS[self.key] = [1, elapsed, elapsed]
+            else:
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = max(stats[2], elapsed)
+        return False
+
+
+def enable(enabled=True):
+    global ENABLED
+    ENABLED = enabled
+
+
+def reset():
+    """Forget every span and counter recorded so far."""
+    with _lock:
+        SPANS.clear()
+        COUNTERS.clear()
+
+
+def span(name, **labels):
+    """Context manager timing its block under a name and labels, if instrumentation is enabled."""
+    if not ENABLED:
+        return _NULL_SPAN
+    return _Span((name, tuple(sorted(labels.items()))))
+
+
+def timed(name):
+    """Decorator timing every call of a function as a span."""
+    def decorate(func):
+        key = (name, ())
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            with _Span(key):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, value=1, **labels):
+    """Add value to a counter, if instrumentation is enabled."""
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        COUNTERS[key] = COUNTERS.get(key, 0) + value
+
+
+def snapshot():
+    """Return the spans and counters recorded so far as a JSON-serializable dict."""
+    with _lock:
+        spans = [{'name': name, 'labels': dict(labels), 'calls': calls, 'seconds': total, 'max_seconds': longest}
+                 for (name, labels), (calls, total, longest) in sorted(SPANS.items())]
+        counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(COUNTERS.items())]
+    return {'spans': spans, 'counters': counters}
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in sorted(labels.items())) + '}'
+
+
+def to_prometheus(prefix='posetrainer'):
+    """Return the spans and counters in the Prometheus text exposition format."""
+    data = snapshot()
+    lines = []
+    if data['spans']:
+        lines += ['# HELP {}_span_seconds Time spent in instrumented spans.'.format(prefix),
+                  '# TYPE {}_span_seconds summary'.format(prefix)]
+        for span_stats in data['spans']:
+            labels = _prometheus_labels(dict(span_stats['labels'], span=span_stats['name']))
+            lines.append('{}_span_seconds_sum{} {!r}'.format(prefix, labels, span_stats['seconds']))
+            lines.append('{}_span_seconds_count{} {}'.format(prefix, labels, span_stats['calls']))
+        lines += ['# HELP {}_span_max_seconds Longest call of instrumented spans.'.format(prefix),
+                  '# TYPE {}_span_max_seconds gauge'.format(prefix)]
+        for span_stats in data['spans']:
+            labels = _prometheus_labels(dict(span_stats['labels'], span=span_stats['name']))
+            lines.append('{}_span_max_seconds{} {!r}'.format(prefix, labels, span_stats['max_seconds']))
+    for name in sorted(set(counter['name'] for counter in data['counters'])):
+        lines.append('# TYPE {}_{}_total counter'.format(prefix, name))
+        for counter in data['counters']:
+            if counter['name'] == name:
+                lines.append('{}_{}_total{} {}'.format(prefix, name, _prometheus_labels(counter['labels']),
+                                                       counter['value']))
+    return '\n'.join(lines) + '\n'
+
+
+def write(filename):
+    """Write the spans and counters to a file, as Prometheus text if it ends in .prom and JSON otherwise.
+
+    A filename of - writes JSON to stderr, keeping stdout for the output of the program.
+    """
+    if filename.endswith('.prom'):
+        text = to_prometheus()
+    else:
+        text = json.dumps(snapshot(), indent=1) + '\n'
+    if filename == '-':
+        sys.stderr.write(text)
+    else:
+        with open(filename, 'w') as f:
+            f.write(text)
+
+
+@contextlib.contextmanager
+def profile(out=sys.stderr, top=20):
+    """Enable instrumentation, cProfile and tracemalloc for a block, then print their top entries to out."""
+    enable()
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        current, peak = tracemalloc.get_traced_memory()
+        allocations = tracemalloc.take_snapshot().statistics('lineno')[:top]
+        tracemalloc.stop()
+
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(top)
+        print(text.getvalue(), file=out)
+        print('tracemalloc: {:.1f} KiB allocated, {:.1f} KiB peak'.format(current / 1024, peak / 1024), file=out)
+        for allocation in allocations:
+            print('  {}'.format(allocation), file=out)
@@ -0,0 +1,237 @@
+"""Concurrent pose extraction jobs.
+
+Each video is extracted to a folder of OpenPose JSON frames by one subprocess of
+a pluggable extractor command. A fixed number of worker threads take videos from
+a bounded queue, so several extractors run at once without changing the working
+directory of this process. Finished folders get a completion marker, and videos
+whose folder already has one are skipped, so an interrupted batch can resume.
+"""
+
+import glob
+import json
+import os
+import queue
+import subprocess
+import threading
+import time
+import traceback
+
+import instrument
+
+# Command running OpenPose on one video. {video} and {output} are replaced by the
+# absolute video path and output folder. It runs in OPENPOSE_CWD, where OpenPose
+# expects to find its models.
+OPENPOSE_COMMAND = [
+    os.path.abspath(os.path.join('openpose', 'bin', 'OpenPoseDemo.exe')),
+    # Use the COCO model since it outputs the keypoint format pose trainer is expecting.
+    '--model_pose', 'COCO',
+    # Use lower resolution for CPU only machines.
+    # If you're running the GPU version of OpenPose, or want to wait longer
+    # for higher quality, you can remove these two items.
+    '--net_resolution', '-1x176',
+    '--video', '{video}',
+    '--write_json', '{output}',
+]
+OPENPOSE_CWD = 'openpose'
+
+# File written to an output folder once its extraction has finished.
+COMPLETE_MARKER = '.complete'
+
+# Files the extractor writes to an output folder, one per frame.
+FRAME_GLOB = '*_keypoints.json'
+
+
+def extractor_command(command, video, output):
+    """Fill the {video} and {output} placeholders of an extractor command."""
+    return [arg.format(video=os.path.abspath(video), output=os.path.abspath(output)) for arg in command]
+
+
+def is_complete(output):
+    """Whether an output folder holds a finished extraction."""
+    return os.path.exists(os.path.join(output, COMPLETE_MARKER))
+
+
+def clear_frames(output):
+    """Create an output folder, or remove the frames and completion marker of an earlier extraction from it.
+
+    Nothing else in the folder is touched.
+
+    Returns:
+        Sorted names of the other entries left in the folder.
+    """
+    os.makedirs(output, exist_ok=True)
+    for path in glob.glob(os.path.join(output, FRAME_GLOB)):
+        os.remove(path)
+    for marker in (COMPLETE_MARKER, COMPLETE_MARKER + '.tmp'):
+        if os.path.exists(os.path.join(output, marker)):
+            os.remove(os.path.join(output, marker))
+    return sorted(os.listdir(output))
+
+
+def extract_video(video, output, command=OPENPOSE_COMMAND, cwd=OPENPOSE_CWD, timeout=None):
+    """Run the extractor on one video and mark its output folder complete.
+
+    The frames of an earlier attempt are removed first, with clear_frames.
+
+    Args:
+        video: path of the input video.
+        output: folder to write the JSON frames to.
+        command: extractor command with {video} and {output} placeholders.
+        cwd: working directory of the extractor, or None for the current one.
+        timeout: seconds after which the extractor is killed, or None.
+
+    Returns:
+        Number of JSON frames written.
+
+    Raises:
+        subprocess.TimeoutExpired if the extractor timed out, and
+        subprocess.CalledProcessError if it failed.
+    """
+    clear_frames(output)
+    with instrument.span('extract'):
+        result = subprocess.run(extractor_command(command, video, output), cwd=cwd, timeout=timeout,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    result.check_returncode()
+
+    num_frames = len(glob.glob(os.path.join(output, FRAME_GLOB)))
+    with open(os.path.join(output, COMPLETE_MARKER + '.tmp'), 'w') as f:
+        json.dump({'video': os.path.basename(video), 'frames': num_frames}, f)
+    os.replace(os.path.join(output, COMPLETE_MARKER + '.tmp'), os.path.join(output, COMPLETE_MARKER))
+    return num_frames
+
+
+class JobScheduler:
+    """Run extraction jobs on a fixed number of worker threads.
+
+    Args:
+        command: extractor command with {video} and {output} placeholders.
+        cwd: working directory of the extractor, or None for the current one.
+        workers: number of extractors running at once.
+        queue_size: largest number of videos waiting for a worker.
+        timeout: seconds after which an extractor is killed, or None.
+        retries: number of times a failed or timed out video is tried again.
+        resume: skip videos whose output folder is already complete.
+        log: function called with each progress line, or None.
+    """
+
+    def __init__(self, command=OPENPOSE_COMMAND, cwd=OPENPOSE_CWD, workers=2, queue_size=None, timeout=None,
+                 retries=1, resume=True, log=print):
+        self.command = command
+        self.cwd = cwd
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size or 2 * workers)
+        self.timeout = timeout
+        self.retries = retries
+        self.resume = resume
+        self.log = log
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.results = []
+
+    def run(self, jobs):
+        """Run (video, output folder) jobs and return one result dict per job, in job order.
+
+        Each result has the 'video', 'output', 'status' (done, skipped or failed),
+        'attempts', 'frames', 'seconds' and, for failed jobs, the 'error'.
+        """
+        self.results = []
+        threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for index, (video, output) in enumerate(jobs):
+            with self.lock:
+                self.waiting += 1
+            # blocks while the queue is full
+            self.queue.put((index, video, output))
+        for _ in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
+        return sorted(self.results, key=lambda result: result['index'])
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            with self.lock:
+                self.waiting -= 1
+            result = self._run_job(*job)
+            with self.lock:
+                self.results.append(result)
+                if self.log:
+                    # videos handed to the queue that no worker has started yet
+                    self.log(format_result(result, self.waiting))
+
+    def _run_job(self, index, video, output):
+        result = {'index': index, 'video': video, 'output': output, 'attempts': 0, 'frames': 0, 'seconds': 0.0}
+        if self.resume and is_complete(output):
+            result['status'] = 'skipped'
+            return result
+
+        start = time.perf_counter()
+        while result['attempts'] <= self.retries:
+            result['attempts'] += 1
+            try:
+                result['frames'] = extract_video(video, output, self.command, self.cwd, self.timeout)
+                result['status'] = 'done'
+                result.pop('error', None)
+                break
+            except subprocess.TimeoutExpired:
+                result['error'] = 'timed out after {} s'.format(self.timeout)
+            except subprocess.CalledProcessError as e:
+                stderr = e.stderr.decode(errors='replace').strip().splitlines()
+                result['error'] = 'exit code {}{}'.format(e.returncode, ': ' + stderr[-1] if stderr else '')
+            except OSError as e:
+                result['error'] = str(e)
+            except Exception as e:
+                # such as a KeyError from a placeholder in the command other than {video} and {output};
+                # a worker that died on it would leave run() waiting for the queue forever
+                result['error'] = ''.join(traceback.format_exception_only(type(e), e)).strip()
+            result['status'] = 'failed'
+        result['seconds'] = time.perf_counter() - start
+        return result
+
+
+def format_result(result, queue_depth):
+    """Format the result of one job as a progress line."""
+    line = '[{}] {}'.format(result['status'], os.path.basename(result['video']))
+    if result['status'] == 'done':
+        line += ': {} frames in {:.2f} s ({:.1f} frames/s)'.format(
+            result['frames'], result['seconds'], result['frames'] / result['seconds'] if result['seconds'] else 0.0)
+    elif result['status'] == 'failed':
+        line += ' after {} attempts: {}'.format(result['attempts'], result['error'])
+    return line + ', queue depth {}'.format(queue_depth)
+
+
+def summarize(results, wall_seconds):
+    """Return a text summary of the throughput of a batch of jobs."""
+    counts = {status: sum(1 for result in results if result['status'] == status)
+              for status in ('done', 'skipped', 'failed')}
+    frames = sum(result['frames'] for result in results)
+    return '{} videos ({} done, {} skipped, {} failed), {} frames in {:.2f} s: {:.1f} frames/s, {:.2f} videos/min\n'.format(
+        len(results), counts['done'], counts['skipped'], counts['failed'], frames, wall_seconds,
+        frames / wall_seconds if wall_seconds else 0.0,
+        counts['done'] * 60 / wall_seconds if wall_seconds else 0.0)
+
+
+def batch_extract(input_folder, output_folder, command=OPENPOSE_COMMAND, cwd=OPENPOSE_CWD, workers=2,
+                  timeout=None, retries=1, resume=True):
+    """Extract pose JSON for every video in a folder, to one subfolder of output_folder per video.
+
+    Args:
+        input_folder: folder of input videos.
+        output_folder: folder for the JSON frame folders.
+        command, cwd, workers, timeout, retries, resume: as passed to JobScheduler.
+
+    Returns:
+        List of job result dicts, in sorted video order.
+    """
+    videos = sorted(os.path.join(input_folder, video) for video in os.listdir(input_folder)
+                    if os.path.isfile(os.path.join(input_folder, video)))
+    jobs = [(video, os.path.join(output_folder, os.path.splitext(os.path.basename(video))[0])) for video in videos]
+    scheduler = JobScheduler(command, cwd, workers, timeout=timeout, retries=retries, resume=resume)
+    start = time.perf_counter()
+    results = scheduler.run(jobs)
+    print(summarize(results, time.perf_counter() - start), end='')
+    return results
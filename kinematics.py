@@ -0,0 +1,100 @@
+"""Batched joint geometry kernels that work directly on keypoint arrays.
+
+Keypoint arrays have shape (..., 18, 3) with x, y, confidence values in the last
+axis, as stored in PoseSequence.keypoints. Parts can be given by name or index.
+"""
+
+import numpy as np
+
+from pose import Pose
+
+
+SIDE_PARTS = {
+    'right': {'shoulder': 'rshoulder', 'elbow': 'relbow', 'wrist': 'rwrist', 'hip': 'rhip'},
+    'left': {'shoulder': 'lshoulder', 'elbow': 'lelbow', 'wrist': 'lwrist', 'hip': 'lhip'},
+}
+
+
+def part_index(part):
+    """Return the keypoint index of a part name, or the index itself."""
+    if isinstance(part, str):
+        if not part in Pose.PART_INDEX:
+            raise NameError(part)
+        return Pose.PART_INDEX[part]
+    return part
+
+
+def present(exists, parts):
+    """Mask of frames in which every one of the given parts exists.
+
+    Args:
+        exists: (N, 18) boolean presence mask.
+        parts: iterable of part names or indices.
+
+    Returns:
+        (N,) boolean mask.
+    """
+    return np.all(exists[:, [part_index(part) for part in parts]], axis=1)
+
+
+def select_side(exists):
+    """Find the arm that is seen most consistently.
+
+    Args:
+        exists: (N, 18) boolean presence mask.
+
+    Returns:
+        'right' or 'left'.
+    """
+    right_count = np.count_nonzero(present(exists, ('rshoulder', 'relbow', 'rwrist')))
+    left_count = np.count_nonzero(present(exists, ('lshoulder', 'lelbow', 'lwrist')))
+    return 'right' if right_count > left_count else 'left'
+
+
+def side_parts(side, *names):
+    """Return the part names of one side for generic names such as 'elbow'."""
+    return [SIDE_PARTS[side].get(name, name) for name in names]
+
+
+def segment_vecs(keypoints, start, end):
+    """Vectors pointing from the end part to the start part, in every frame.
+
+    Args:
+        keypoints: (..., 18, 3) keypoint array.
+        start: part name or index the vectors point to.
+        end: part name or index the vectors point from.
+
+    Returns:
+        (..., 2) array of x, y vectors.
+    """
+    return keypoints[..., part_index(start), :2] - keypoints[..., part_index(end), :2]
+
+
+def normalize(vecs):
+    """Scale vectors in the last axis to unit length."""
+    return vecs / np.expand_dims(np.linalg.norm(vecs, axis=-1), axis=-1)
+
+
+def angles(vecs1, vecs2):
+    """Angles in degrees between pairs of unit vectors in the last axis."""
+    return np.degrees(np.arccos(np.clip(np.sum(np.multiply(vecs1, vecs2), axis=-1), -1.0, 1.0)))
+
+
+def segment_angles(keypoints, segment1, segment2):
+    """Angles in degrees between two segments, each given as a (start, end) part pair."""
+    return angles(normalize(segment_vecs(keypoints, *segment1)), normalize(segment_vecs(keypoints, *segment2)))
+
+
+def valid_max(values, mask=None):
+    """Maximum over the frames (first axis) selected by mask."""
+    return np.max(values if mask is None else values[mask], axis=0)
+
+
+def valid_min(values, mask=None):
+    """Minimum over the frames (first axis) selected by mask."""
+    return np.min(values if mask is None else values[mask], axis=0)
+
+
+def valid_range(values, mask=None):
+    """Range of motion over the frames (first axis) selected by mask."""
+    return valid_max(values, mask) - valid_min(values, mask)
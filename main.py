@@ -1,14 +1,27 @@
 """Pose trainer main script."""
 
 import argparse
+import contextlib
 import os
+import shlex
 import sys
-import subprocess
 import numpy as np
 import matplotlib.pyplot as plt
 
-from parse import parse_sequence, load_ps
-from evaluate import evaluate_pose
+import instrument
+from clean import clean_keypoints, clean_stream
+from parse import load_keypoints
+from pose import PoseSequence
+from classifier import detect_exercise
+from evaluate import evaluate_pose, load_thresholds, register_exercise
+from exercises import load_exercises
+from reps import evaluate_reps, format_reps
+from batch import run_batch
+from chunked import evaluate_chunked
+from jobs import OPENPOSE_COMMAND, OPENPOSE_CWD, batch_extract
+from pipeline import run_pipeline
+from service import serve
+from stream import evaluate_stream, read_ndjson, tail_folder
 
 # ** Important setup notes: **
 # 
@@ -28,91 +41,181 @@ from evaluate import evaluate_pose
 def main():
     parser = argparse.ArgumentParser(description='Pose Trainer')
     parser.add_argument('--mode', type=str, default='evaluate', help='Pose Trainer application mode.\n'
-            'One of evaluate, batch_json, evaluate_npy. See the code for more info.')
+            'One of evaluate, batch_json, evaluate_npy, batch_evaluate, stream, serve. See the code for more info.')
     parser.add_argument('--input_folder', type=str, default='videos', help='(Used by the batch_json mode only)\n'
             'Input folder for videos.\n'
             'Defaults to the videos folder in this repository folder.')
     parser.add_argument('--output_folder', type=str, default='poses', help='(Used by the batch_json mode only)\n'
             'Folder for pose JSON files.\n'
             'Defaults to the poses folder in this repository folder.')
+    parser.add_argument('--jobs', type=int, default=2, help='(Used by the batch_json mode only)\n'
+            'Number of pose extraction processes running at once.')
+    parser.add_argument('--retries', type=int, default=1, help='(Used by the batch_json mode only)\n'
+            'Number of times a video whose extraction failed or timed out is tried again.')
+    parser.add_argument('--no_resume', action='store_true', help='(Used by the batch_json mode only)\n'
+            'Extract every video again, even if its JSON folder is already complete.')
+    parser.add_argument('--timeout', type=float, default=None, help='(Used by the evaluate and batch_json modes only)\n'
+            'Seconds after which pose extraction of one video is stopped. No limit by default.')
+    parser.add_argument('--extractor', type=str, default=None, help='(Used by the evaluate and batch_json modes only)\n'
+            'Pose extraction command, with {video} and {output} placeholders for the video and JSON folder.\n'
+            'Defaults to OpenPose. fake_openpose.py is a stand-in for running without OpenPose.')
     parser.add_argument('--video', type=str, help='(Used by the evaluate mode only)\n'
             'Input video filepath for evaluation. Looks for it in the root folder of the repository.')
     parser.add_argument('--file', type=str, help='(Used by the evaluate_npy mode only)\n'
             'Full path to the input .npy file for evaluation.')
-    parser.add_argument('--exercise', type=str, default='bicep_curl', help='Exercise type to evaluate.')
+    parser.add_argument('--chunk_frames', type=int, default=None, help='(Used by the evaluate_npy mode only)\n'
+            'Evaluate the file this many frames at a time, with memory use independent of its length, for long recordings.\n'
+            'Needs an --exercise, and cannot be combined with --clean or --reps.')
+    parser.add_argument('--pose_folder', type=str, default='poses_compressed', help='(Used by the batch_evaluate mode only)\n'
+            'Folder tree of .npy or .kps files, in one folder per exercise such as bicep or shoulder_press.')
+    parser.add_argument('--results', type=str, default='-', help='(Used by the batch_evaluate mode only)\n'
+            'Output file for one result row per input file, CSV if it ends in .csv and JSONL otherwise, or - for stdout.')
+    parser.add_argument('--workers', type=int, default=None, help='(Used by the batch_evaluate and serve modes only)\n'
+            'Number of evaluation processes. Defaults to one per CPU. 0 scores on a thread of the service in the serve mode.')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='(Used by the serve mode only)\n'
+            'Address the scoring service listens on.')
+    parser.add_argument('--port', type=int, default=8000, help='(Used by the serve mode only)\n'
+            'Port the scoring service listens on.')
+    parser.add_argument('--socket', type=str, default=None, help='(Used by the serve mode only)\n'
+            'Unix socket path to listen on instead of --host and --port.')
+    parser.add_argument('--max_batch', type=int, default=64, help='(Used by the serve mode only)\n'
+            'Largest number of requests scored together.')
+    parser.add_argument('--batch_window', type=float, default=2.0, help='(Used by the serve mode only)\n'
+            'Milliseconds to wait for more requests to score with the first one.')
+    parser.add_argument('--feature_cache', type=str, default=None, help='(Used by the batch_evaluate mode only)\n'
+            'Folder to cache pose sequences and metric values in, keyed by file content, so later runs skip recomputing them.')
+    parser.add_argument('--json_folder', type=str, default='-', help='(Used by the stream mode only)\n'
+            'Folder OpenPose writes JSON frames to with --write_json, or - to read NDJSON keypoints from stdin.')
+    parser.add_argument('--idle_timeout', type=float, default=5.0, help='(Used by the stream mode only)\n'
+            'Seconds without a new JSON frame before the stream is considered finished.')
+    parser.add_argument('--exercise', type=str, default='auto', help='Exercise type to evaluate, such as bicep_curl.\n'
+            'Defaults to auto, which detects it from the templates in --template_folder (not in the stream mode).')
+    parser.add_argument('--template_folder', type=str, default='poses_compressed', help='(Used with --exercise auto only)\n'
+            'Folder of labelled template clips, in one folder per exercise. Their index is saved to exercise_index.npz.')
+    parser.add_argument('--exercise_file', type=str, default=None, help='JSON file of additional exercise specifications.\n'
+            'See exercises.exercise_from_dict for the format.')
+    parser.add_argument('--thresholds', type=str, default=None, help='JSON file of thresholds by exercise and metric,\n'
+            'such as tuned on labelled clips by calibrate.py, replacing those in exercises.py.')
+    parser.add_argument('--clean', action='store_true', help='(Used by the evaluate_npy, batch_evaluate and stream modes only)\n'
+            'Reject outlier keypoints, interpolate short gaps and smooth the keypoints before evaluating them.')
+    parser.add_argument('--profile', action='store_true', help='Time the pipeline stages, and profile the run with cProfile\n'
+            'and tracemalloc, printing the results to stderr.')
+    parser.add_argument('--metrics', type=str, default=None, help='File to write the stage timings and frame counters to,\n'
+            'as Prometheus text if it ends in .prom and JSON otherwise, or - for stderr.')
+    parser.add_argument('--reps', action='store_true', help='(Used by the evaluate and evaluate_npy modes only)\n'
+            'Also segment the sequence into repetitions and print a verdict for each one.')
 
     args = parser.parse_args()
 
+    if args.exercise_file:
+        for exercise in load_exercises(args.exercise_file):
+            register_exercise(exercise)
+    if args.thresholds:
+        load_thresholds(args.thresholds)
+
+    if args.metrics:
+        instrument.enable()
+    with instrument.profile() if args.profile else contextlib.nullcontext():
+        run_mode(args)
+    if args.metrics or args.profile:
+        instrument.write(args.metrics or '-')
+
+
+def run_mode(args):
+    # Pose extractor for the evaluate and batch_json modes.
+    if args.extractor:
+        command, cwd = shlex.split(args.extractor, posix=os.name != 'nt'), None
+    else:
+        command, cwd = OPENPOSE_COMMAND, OPENPOSE_CWD
+
     if args.mode == 'evaluate':
         if args.video:
             print('processing video file...')
             video = os.path.basename(args.video)
             
-            # Run OpenPose on the video, and write a folder of JSON pose keypoints to a folder in
-            # the repository root folder with the same name as the input video.
-            output_path = os.path.join('..', os.path.splitext(video)[0])
-            openpose_path = os.path.join('bin', 'OpenPoseDemo.exe')
-            os.chdir('openpose')
-            subprocess.call([openpose_path, 
-                            # Use the COCO model since it outputs the keypoint format pose trainer is expecting.
-                            '--model_pose', 'COCO', 
-                            # Use lower resolution for CPU only machines.
-                            # If you're running the GPU version of OpenPose, or want to wait longer
-                            # for higher quality, you can remove this line.
-                            '--net_resolution', '-1x176', 
-                            '--video', os.path.join('..', args.video), 
-                            '--write_json', output_path])
-
-            # Parse the pose JSON in the output path, and write it as a .npy file to the repository root folder.
-            parse_sequence(output_path, '..')
-            # Load the .npy pose sequence and evaluate the pose as the specified exercise.
-            pose_seq = load_ps(os.path.join('..', os.path.splitext(video)[0] + '.npy'))
-            (correct, feedback) = evaluate_pose(pose_seq, args.exercise)
+            # Run OpenPose on the video, writing a folder of JSON pose keypoints to a folder in the
+            # repository root folder with the same name as the input video. Frames are parsed and
+            # evaluated as the specified exercise while OpenPose is still writing them.
+            output_path = os.path.splitext(video)[0]
+            (correct, feedback, pose_seq, exercise) = run_pipeline(args.video, args.exercise, output_path, command,
+                                                                   cwd, args.timeout,
+                                                                   template_folder=args.template_folder)
             if correct:
                 print('Exercise performed correctly!')
             else:
                 print('Exercise could be improved:')
             print(feedback)
+            if args.reps:
+                print(format_reps(evaluate_reps(pose_seq, exercise)), end='')
         else:
             print('No video file specified.')
             return
   
     # Extract pose JSON files for every video in the input folder.
     elif args.mode == 'batch_json':
-        # read filenames from the videos directory
-        videos = os.listdir(args.input_folder)
-
-        os.chdir('openpose')
-
-        for video in videos:
-            print('processing video file:' + video)
-            video_path = os.path.join('..', args.input_folder, video)
-            output_path = os.path.join('..', args.output_folder, os.path.splitext(video)[0])
-            openpose_path = os.path.join('bin', 'OpenPoseDemo.exe')
-            subprocess.call([openpose_path,
-                            # Use the COCO model since it outputs the keypoint format pose trainer is expecting.
-                            '--model_pose', 'COCO', 
-                            # Use lower resolution for CPU only machines.
-                            # If you're running the GPU version of OpenPose, or want to wait longer
-                            # for higher quality, you can remove this line.
-                            '--net_resolution', '-1x176', 
-                            '--video', video_path, 
-                            '--write_json', output_path])
+        # Run several extractors at once, skipping videos whose JSON folder is already complete.
+        batch_extract(args.input_folder, args.output_folder, command, cwd, args.jobs, args.timeout, args.retries,
+                      resume=not args.no_resume)
 
     # Evaluate the .npy file as a pose sequence for the specified exercise.
     elif args.mode == 'evaluate_npy':
-        if args.file:
-            pose_seq = load_ps(args.file)
-            (correct, feedback) = evaluate_pose(pose_seq, args.exercise)
+        if args.file and args.chunk_frames:
+            if args.exercise == 'auto' or args.clean or args.reps:
+                print('--chunk_frames needs an --exercise, and --clean and --reps need the whole sequence in memory.')
+                return
+            (correct, feedback) = evaluate_chunked(args.file, args.exercise, args.chunk_frames)
+            if correct:
+                print('Exercise performed correctly:')
+            else:
+                print('Exercise could be improved:')
+            print(feedback)
+        elif args.file:
+            keypoints = load_keypoints(args.file)
+            pose_seq = PoseSequence(clean_keypoints(keypoints) if args.clean else keypoints)
+            exercise = args.exercise
+            if exercise == 'auto':
+                exercise, confidence = detect_exercise(pose_seq, args.template_folder)
+                print('Exercise detected as: {} ({:.0%} of the nearest templates agree).'.format(exercise, confidence))
+            (correct, feedback) = evaluate_pose(pose_seq, exercise)
             if correct:
                 print('Exercise performed correctly:')
             else:
                 print('Exercise could be improved:')
             print(feedback)
+            if args.reps:
+                print(format_reps(evaluate_reps(pose_seq, exercise)), end='')
         else:
             print('No npy file specified.')
             return
     
+    # Evaluate every .npy file in a folder tree, inferring the exercise from the folder names.
+    elif args.mode == 'batch_evaluate':
+        run_batch(args.pose_folder, args.results, workers=args.workers, clean=args.clean,
+                  cache_dir=args.feature_cache)
+
+    # Evaluate frames as OpenPose writes them, giving feedback as soon as it is available.
+    elif args.mode == 'stream':
+        if args.exercise == 'auto':
+            print('The stream mode needs an --exercise to give feedback before the whole sequence is in.')
+            return
+        if args.json_folder == '-':
+            frames = read_ndjson(sys.stdin)
+        else:
+            frames = tail_folder(args.json_folder, idle_timeout=args.idle_timeout)
+        if args.clean:
+            frames = clean_stream(frames)
+        (correct, feedback, _) = evaluate_stream(frames, args.exercise)
+        if correct:
+            print('Exercise performed correctly:')
+        else:
+            print('Exercise could be improved:')
+        print(feedback)
+
+    # Score keypoint sequences posted to a local HTTP service, see service.py.
+    elif args.mode == 'serve':
+        serve(args.host, args.port, args.socket, args.workers, args.max_batch, args.batch_window / 1000,
+              args.template_folder)
+
     else:
         print('Unrecognized mode option.')
         return
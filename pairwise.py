@@ -0,0 +1,165 @@
+"""Pairwise DTW distance matrices between pose sequence files."""
+
+import concurrent.futures
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from dtw import dtw
+from cache import _save_json, get_cache
+from features import FEATURE_VERSION, extract
+from parse import load_ps
+from utils import file_hash
+
+
+def pairwise_dtw(seqs_a, seqs_b=None, features=('upper_arm_forearm_angle',), n_jobs=1,
+                 constraint='full', window=None, slope=2.0, smooth=0, cache_dir='dtw_cache', feature_cache=None):
+    """Compute DTW distances between every pair of pose sequence files.
+
+    Pairs are identified by the content hashes of their files, so each distinct
+    pair is computed once: the symmetric half of the matrix is reused, and
+    distances already in the cache are not recomputed.
+
+    Args:
+        seqs_a: list of .npy keypoint file paths for the rows.
+        seqs_b: list of .npy keypoint file paths for the columns, or None to
+            compare seqs_a with itself.
+        features: list of feature names from features.FEATURES.
+        n_jobs: number of worker processes, or None for one per CPU.
+        constraint, window, slope: as passed to dtw.dtw.
+        smooth: median filter kernel size for the feature series, or 0.
+        cache_dir: folder for cached distances, or None to disable the cache.
+        feature_cache: folder of the feature cache to reuse feature series from, or None.
+
+    Returns:
+        (len(seqs_a), len(seqs_b), len(features)) array of DTW distances.
+
+    """
+    if seqs_b is None:
+        seqs_b = seqs_a
+    features = list(features)
+    hashes_a = [file_hash(path) for path in seqs_a]
+    hashes_b = [file_hash(path) for path in seqs_b]
+    paths = dict(zip(hashes_a + hashes_b, list(seqs_a) + list(seqs_b)))
+
+    params = {'constraint': constraint, 'window': window, 'slope': slope, 'smooth': smooth,
+              'feature_version': FEATURE_VERSION}
+    cache = DTWCache(cache_dir, params)
+
+    # cells waiting on each distinct pair, in (smaller hash, larger hash) order
+    distances = np.zeros((len(seqs_a), len(seqs_b), len(features)))
+    pending = {}
+    for i, hash_a in enumerate(hashes_a):
+        for j, hash_b in enumerate(hashes_b):
+            if hash_a == hash_b:
+                continue
+            pair = (min(hash_a, hash_b), max(hash_a, hash_b))
+            for k, feature in enumerate(features):
+                dist = cache.get(pair[0], pair[1], feature)
+                if dist is None:
+                    pending.setdefault(pair, []).append((i, j, k))
+                else:
+                    distances[i, j, k] = dist
+
+    # group the missing pairs into one task per row
+    rows = {}
+    for hash_a, hash_b in pending:
+        rows.setdefault(hash_a, []).append(hash_b)
+    needed = set(rows) | set(hash_b for row in rows.values() for hash_b in row)
+    if feature_cache:
+        series = {h: get_cache(feature_cache).features(paths[h], features, smooth) for h in needed}
+    else:
+        series = {h: extract(load_ps(paths[h]), features, smooth) for h in needed}
+
+    tasks = [(hash_a, row) for hash_a, row in rows.items()]
+    for hash_a, row, row_distances in _map_rows(tasks, series, (constraint, window, slope), n_jobs):
+        for hash_b, pair_distances in zip(row, row_distances):
+            for k, feature in enumerate(features):
+                cache.put(hash_a, hash_b, feature, pair_distances[k])
+            for i, j, k in pending[(hash_a, hash_b)]:
+                distances[i, j, k] = pair_distances[k]
+
+    cache.save()
+    return distances
+
+
+def _map_rows(tasks, series, dtw_args, n_jobs):
+    if n_jobs == 1 or len(tasks) <= 1:
+        _init_worker(series, dtw_args)
+        for task in tasks:
+            yield _row_distances(task)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                                initargs=(series, dtw_args)) as executor:
+        for result in executor.map(_row_distances, tasks):
+            yield result
+
+
+# Feature series and DTW arguments shared by the rows computed in one process.
+_worker_state = {}
+
+
+def _init_worker(series, dtw_args):
+    _worker_state['series'] = series
+    _worker_state['dtw_args'] = dtw_args
+
+
+def _row_distances(task):
+    hash_a, row = task
+    series = _worker_state['series']
+    dtw_args = _worker_state['dtw_args']
+    row_distances = [[dtw(s_a, s_b, *dtw_args) for s_a, s_b in zip(series[hash_a], series[hash_b])]
+                     for hash_b in row]
+    return hash_a, row, row_distances
+
+
+class DTWCache:
+    """DTW distances stored on disk as one JSON file per row of file hashes.
+
+    Rows live in a subfolder named after a hash of the DTW parameters, so
+    changing any parameter starts a fresh cache. Saving a row merges it with
+    the distances other runs saved to it, and replaces the file atomically.
+    """
+
+    def __init__(self, cache_dir, params):
+        key = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+        self.folder = os.path.join(cache_dir, key) if cache_dir else None
+        self.rows = {}
+        self.modified = set()
+
+    def _row(self, hash_a):
+        if hash_a not in self.rows:
+            self.rows[hash_a] = {}
+            if self.folder:
+                path = os.path.join(self.folder, hash_a + '.json')
+                if os.path.exists(path):
+                    with open(path) as f:
+                        self.rows[hash_a] = json.load(f)
+        return self.rows[hash_a]
+
+    def get(self, hash_a, hash_b, feature):
+        return self._row(hash_a).get(hash_b, {}).get(feature)
+
+    def put(self, hash_a, hash_b, feature, dist):
+        self._row(hash_a).setdefault(hash_b, {})[feature] = float(dist)
+        self.modified.add(hash_a)
+
+    def save(self):
+        if not self.folder:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        for hash_a in self.modified:
+            path = os.path.join(self.folder, hash_a + '.json')
+            # keep the distances other runs saved to the row since it was read
+            row = {}
+            if os.path.exists(path):
+                with open(path) as f:
+                    row = json.load(f)
+            for hash_b, dists in self.rows[hash_a].items():
+                row.setdefault(hash_b, {}).update(dists)
+            self.rows[hash_a] = row
+            _save_json(path, row)
+        self.modified = set()
@@ -1,11 +1,29 @@
 import argparse
+import concurrent.futures
 import glob
 import json
 import numpy as np
 import os
 
+import instrument
 from pose import Pose, Part, PoseSequence
 from pprint import pprint
+from track import MIN_TRACK_FRAMES, Tracker
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Compact keypoint files (.kps) start with this magic string, a little-endian
+# uint32 header length and a JSON header, padded so the keypoints that follow are
+# aligned for np.memmap.
+KPS_MAGIC = b'POSEKPS1'
+KPS_ALIGNMENT = 64
+
+# Number of JSON frames parsed by one worker task.
+CHUNK_SIZE = 256
 
 
 def main():
@@ -13,7 +31,15 @@ def main():
     parser = argparse.ArgumentParser(description='Pose Trainer Parser')
     parser.add_argument('--input_folder', type=str, default='poses', help='input folder for json files')
     parser.add_argument('--output_folder', type=str, default='poses_compressed', help='output folder for npy files')
-    
+    parser.add_argument('--format', type=str, default='npy', help='output file format, npy or kps (compact keypoint file)')
+    parser.add_argument('--dtype', type=str, default=None, help='output keypoint dtype, defaults to float64 for npy and float32 for kps')
+    parser.add_argument('--fps', type=float, default=0.0, help='video frame rate stored in kps headers, 0 if unknown')
+    parser.add_argument('--workers', type=int, default=None, help='number of parsing processes, defaults to one per CPU')
+    parser.add_argument('--people', type=str, default='first', help='first to keep the first detected person of each frame, '
+            'or all to track every person and write one file per track')
+    parser.add_argument('--min_frames', type=int, default=MIN_TRACK_FRAMES, help='with --people all, drop tracks '
+            'detected in fewer frames than this')
+
     args = parser.parse_args()
 
     video_paths = glob.glob(os.path.join(args.input_folder, '*'))
@@ -22,44 +48,228 @@ def main():
     # Get all the json sequences for each video
     all_ps = []
     for video_path in video_paths:
-        all_ps.append(parse_sequence(video_path, args.output_folder))
+        all_ps.append(parse_sequence(video_path, args.output_folder, fmt=args.format, dtype=args.dtype,
+                                     fps=args.fps, workers=args.workers, people=args.people,
+                                     min_frames=args.min_frames))
     return video_paths, all_ps
 
 
-def parse_sequence(json_folder, output_folder):
+@instrument.timed('parse_sequence')
+def parse_sequence(json_folder, output_folder, fmt='npy', dtype=None, fps=0.0, workers=None, people='first',
+                   min_frames=MIN_TRACK_FRAMES):
     """Parse a sequence of OpenPose JSON frames and saves a corresponding numpy file.
 
+    Frames are parsed in chunks across a process pool and written straight into
+    a memory-mapped output file, so only a few chunks are held in memory at once.
+
     Args:
         json_folder: path to the folder containing OpenPose JSON for one video.
         output_folder: path to save the numpy array files of keypoints.
+        fmt: 'npy' for a numpy file, or 'kps' for a compact keypoint file.
+        dtype: keypoint dtype, defaults to float64 for npy and float32 for kps.
+        fps: video frame rate stored in the kps header, 0 if unknown.
+        workers: number of parsing processes, None for one per CPU.
+        people: 'first' to keep the first detected person of each frame, or 'all'
+            to track every person and write one file per track, holding the
+            frames from its first detection to its last. The first frame of
+            each track is listed in <name>_tracks.json, and in kps headers.
+        min_frames: with people='all', drop tracks detected in fewer frames than this.
+
+    Returns:
+        Path of the written file, or a list of paths with people='all'.
 
     """
     json_files = glob.glob(os.path.join(json_folder, '*.json'))
     json_files = sorted(json_files)
+    name = os.path.basename(json_folder)
+
+    if people == 'all':
+        return _parse_tracks(json_files, output_folder, name, fmt, dtype, fps, workers, min_frames)
+    elif people != 'first':
+        raise ValueError('Unknown people option: {}'.format(people))
 
     num_frames = len(json_files)
-    all_keypoints = np.zeros((num_frames, 18, 3))
-    for i in range(num_frames):
-        with open(json_files[i]) as f:
-            json_obj = json.load(f)
-            keypoints = np.array(json_obj['people'][0]['pose_keypoints_2d'])
-            all_keypoints[i] = keypoints.reshape((18, 3))
-    
-    output_dir = os.path.join(output_folder, os.path.basename(json_folder))
-    np.save(output_dir, all_keypoints)
+    instrument.count('frames_parsed', num_frames)
+    output_path = os.path.join(output_folder, name + '.' + fmt)
+    all_keypoints = _create_output(output_path, fmt, num_frames, dtype, {'fps': fps, 'source': name, 'person': 0})
+    for start, keypoints in parse_frames(json_files, workers):
+        all_keypoints[start:start + len(keypoints)] = keypoints
+    if isinstance(all_keypoints, np.memmap):
+        all_keypoints.flush()
+    del all_keypoints
+    return output_path
+
+
+def _parse_tracks(json_files, output_folder, name, fmt, dtype, fps, workers, min_frames):
+    # feed the frames to the tracker in order as their chunks complete
+    tracker = Tracker()
+    parsed = {}
+    next_start = 0
+    for start, chunk_people in parse_frames(json_files, workers, all_people=True):
+        parsed[start] = chunk_people
+        while next_start in parsed:
+            chunk_people = parsed.pop(next_start)
+            for frame_people in chunk_people:
+                tracker.update(frame_people)
+            next_start += len(chunk_people)
+
+    output_paths = []
+    tracks = []
+    for track_id, (start, sequence) in sorted(tracker.sequences(min_frames).items()):
+        output_path = os.path.join(output_folder, '{}_person{}.{}'.format(name, track_id, fmt))
+        header = {'fps': fps, 'source': name, 'person': track_id, 'start': start}
+        keypoints = _create_output(output_path, fmt, len(sequence), dtype, header)
+        keypoints[:] = sequence
+        if isinstance(keypoints, np.memmap):
+            keypoints.flush()
+        del keypoints
+        output_paths.append(output_path)
+        tracks.append({'file': os.path.basename(output_path), 'person': track_id, 'start': start,
+                       'frames': len(sequence)})
+    with open(os.path.join(output_folder, name + '_tracks.json'), 'w') as f:
+        json.dump(tracks, f, indent=1)
+    return output_paths
+
+
+def _create_output(output_path, fmt, num_frames, dtype, header):
+    if fmt == 'npy':
+        return np.lib.format.open_memmap(output_path, mode='w+', dtype=dtype or np.float64, shape=(num_frames, 18, 3))
+    elif fmt == 'kps':
+        return create_kps(output_path, num_frames, dtype or np.float32, header)
+    raise ValueError('Unknown keypoint file format: {}'.format(fmt))
+
+
+def parse_frames(json_files, workers=None, all_people=False):
+    """Parse OpenPose JSON frames in chunks, in parallel.
+
+    Args:
+        json_files: list of JSON frame paths, in frame order.
+        workers: number of parsing processes, None for one per CPU.
+        all_people: parse every detected person instead of the first one.
+
+    Yields:
+        (index of the first frame, keypoints of the chunk) in completion order.
+        With all_people, the keypoints are a list of (P, 18, 3) arrays per frame.
+    """
+    chunks = [(start, json_files[start:start + CHUNK_SIZE], all_people)
+              for start in range(0, len(json_files), CHUNK_SIZE)]
+    workers = workers or os.cpu_count()
+    if workers == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            yield _parse_chunk(chunk)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        # keep a bounded number of chunks in flight
+        max_pending = 2 * workers
+        pending = set()
+        for chunk in chunks:
+            if len(pending) >= max_pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(_parse_chunk, chunk))
+        for future in concurrent.futures.as_completed(pending):
+            yield future.result()
+
+
+def _parse_chunk(chunk):
+    start, json_files, all_people = chunk
+    if all_people:
+        return start, [frame_people(read_json(json_file)) for json_file in json_files]
+    keypoints = np.empty((len(json_files), 18, 3))
+    for i, json_file in enumerate(json_files):
+        keypoints[i] = frame_keypoints(read_json(json_file))
+    return start, keypoints
 
 
+def read_json(filename):
+    """Read a JSON file, with orjson if it is installed."""
+    if orjson is not None:
+        with open(filename, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(filename) as f:
+        return json.load(f)
+
+
+def frame_keypoints(json_obj):
+    """Return the 18 * 3 keypoints of the first person in one OpenPose JSON frame.
+
+    Frames with no detected person have all keypoints set to zero, which marks
+    every part as missing.
+    """
+    if not json_obj['people']:
+        return np.zeros((18, 3))
+    return np.array(json_obj['people'][0]['pose_keypoints_2d']).reshape((18, 3))
+
+
+def frame_people(json_obj):
+    """Return the (P, 18, 3) keypoints of every person detected in one OpenPose JSON frame."""
+    return np.array([person['pose_keypoints_2d'] for person in json_obj['people']], dtype=np.float64).reshape((-1, 18, 3))
+
+
+def create_kps(filename, num_frames, dtype, header):
+    """Create a compact keypoint file and return its keypoints as a writable memmap.
+
+    Args:
+        filename: path of the file to create.
+        num_frames: number of frames in the file.
+        dtype: keypoint dtype, float32 or float16.
+        header: dict of metadata, such as fps, source and person index.
+
+    Returns:
+        (num_frames, 18, 3) np.memmap of the keypoints.
+    """
+    header = dict(header, dtype=np.dtype(dtype).name, frames=num_frames, shape=[num_frames, 18, 3])
+    header_bytes = json.dumps(header).encode()
+    header_bytes += b' ' * (-(len(KPS_MAGIC) + 4 + len(header_bytes)) % KPS_ALIGNMENT)
+    offset = len(KPS_MAGIC) + 4 + len(header_bytes)
+    with open(filename, 'wb') as f:
+        f.write(KPS_MAGIC)
+        f.write(np.array(len(header_bytes), dtype='<u4').tobytes())
+        f.write(header_bytes)
+    if num_frames == 0:
+        return np.zeros((0, 18, 3), dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r+', offset=offset, shape=(num_frames, 18, 3))
+
+
+def open_kps(filename):
+    """Open a compact keypoint file without reading its keypoints.
+
+    Returns:
+        keypoints: (frames, 18, 3) read-only np.memmap of the keypoints.
+        header: dict of metadata from the file header.
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(KPS_MAGIC)) != KPS_MAGIC:
+            raise ValueError('Not a compact keypoint file: {}'.format(filename))
+        header_length = int(np.frombuffer(f.read(4), dtype='<u4')[0])
+        header = json.loads(f.read(header_length))
+    offset = len(KPS_MAGIC) + 4 + header_length
+    if header['frames'] == 0:
+        return np.zeros((0, 18, 3), dtype=header['dtype']), header
+    keypoints = np.memmap(filename, dtype=header['dtype'], mode='r', offset=offset, shape=tuple(header['shape']))
+    return keypoints, header
+
+
+def load_keypoints(filename):
+    """Open the keypoints of a numpy or compact keypoint file as a read-only memmap."""
+    if os.path.splitext(filename)[1] == '.kps':
+        return open_kps(filename)[0]
+    return np.load(filename, mmap_mode='r')
+
+
+@instrument.timed('load_ps')
 def load_ps(filename):
-    """Load a PoseSequence object from a given numpy file.
+    """Load a PoseSequence object from a given numpy or compact keypoint file.
 
     Args:
         filename: file name of the numpy file containing keypoints.
-    
+
     Returns:
         PoseSequence object with normalized joint keypoints.
     """
-    all_keypoints = np.load(filename)
-    return PoseSequence(all_keypoints)
+    return PoseSequence(load_keypoints(filename))
 
 
 if __name__ == '__main__':
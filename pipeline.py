@@ -0,0 +1,173 @@
+"""Pipelined evaluation of a video, overlapping pose extraction, parsing and scoring.
+
+The extractor runs as a subprocess writing JSON frames to a folder. A parser
+thread reads each frame as soon as it is written and passes its keypoints
+through a bounded queue to the scorer, which gives streaming feedback on the
+partial sequence and evaluates the whole sequence, kept in memory, once the
+extractor has finished. A full queue blocks the parser until the scorer catches
+up; the extractor itself is only limited by the frames it writes to disk.
+"""
+
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+import instrument
+from classifier import detect_exercise
+from evaluate import evaluate_pose
+from jobs import OPENPOSE_COMMAND, OPENPOSE_CWD, clear_frames, extractor_command
+from pose import PoseSequence
+from stream import evaluate_stream, tail_folder
+
+
+class _Stage:
+    """Timing of one pipeline stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.end = None
+        self.busy = 0.0
+        self.blocked = 0.0
+        self.items = 0
+
+    def format(self, t0):
+        return '{:<10} {:>8.3f} s to {:>8.3f} s, {:>8.3f} s busy, {:>8.3f} s blocked, {} frames'.format(
+            self.name, self.start - t0, self.end - t0, self.busy, self.blocked, self.items)
+
+
+def run_pipeline(video, exercise, json_folder, command=OPENPOSE_COMMAND, cwd=OPENPOSE_CWD, timeout=None,
+                 queue_size=64, poll_interval=0.01, out=sys.stdout, template_folder='poses_compressed'):
+    """Extract, parse and evaluate a video as a pipeline of concurrent stages.
+
+    Args:
+        video: path of the input video.
+        exercise: String name of the exercise to evaluate, or 'auto' to detect it
+            once every frame is in, without streaming feedback.
+        json_folder: folder the extractor writes JSON frames to. Frames of an
+            earlier run are removed from it first.
+        command: extractor command with {video} and {output} placeholders.
+        cwd: working directory of the extractor, or None for the current one.
+        timeout: seconds after which the extractor is killed, or None.
+        queue_size: largest number of parsed frames waiting for the scorer.
+        poll_interval: seconds between checks of the JSON folder for new frames.
+        out: file to print streaming feedback and the stage timings to.
+        template_folder: labelled template clips for detecting the exercise.
+
+    Returns:
+        correct: Bool whether exercise was performed correctly.
+        feedback: Feedback string.
+        pose_seq: PoseSequence of every frame.
+        exercise: String name of the exercise evaluated.
+
+    Raises:
+        ValueError: if json_folder holds anything besides the frames of an earlier run.
+        RuntimeError: if the extractor failed or timed out.
+        Any error reading a frame, such as a malformed one, is raised as well,
+        after the extractor is killed.
+
+    """
+    # frames left from an earlier run would be read as part of this one
+    others = clear_frames(json_folder)
+    if others:
+        raise ValueError('Folder {} for the pose frames holds other files, such as {}; '
+                         'move them or run from another folder.'.format(json_folder, others[0]))
+    stages = {name: _Stage(name) for name in ('extract', 'parse', 'score')}
+    frames = queue.Queue(maxsize=queue_size)
+    errors = []
+
+    t0 = time.perf_counter()
+    stages['extract'].start = t0
+    process = subprocess.Popen(extractor_command(command, video, json_folder), cwd=cwd,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    extracted = threading.Event()
+
+    def extract():
+        try:
+            with instrument.span('extract'):
+                _, stderr = process.communicate(timeout=timeout)
+            if process.returncode:
+                errors.append('Pose extraction failed with exit code {}: {}'.format(
+                    process.returncode, stderr.decode(errors='replace').strip()))
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            errors.append('Pose extraction timed out after {} s.'.format(timeout))
+        stages['extract'].end = time.perf_counter()
+        stages['extract'].busy = stages['extract'].end - stages['extract'].start
+        extracted.set()
+
+    def parse():
+        stage = stages['parse']
+        stage.start = time.perf_counter()
+        error = None
+        try:
+            for arrival, keypoints in tail_folder(json_folder, poll_interval, float('inf'), done=extracted.is_set):
+                parsed = time.perf_counter()
+                stage.busy += parsed - arrival
+                stage.items += 1
+                instrument.count('frames_parsed')
+                # blocks while the scorer is behind
+                frames.put((arrival, keypoints))
+                stage.blocked += time.perf_counter() - parsed
+        except Exception as e:
+            # raised again by the scorer, which would otherwise score the frames read so far as a whole video
+            error = e
+        finally:
+            stage.end = time.perf_counter()
+            frames.put(error)
+
+    threads = [threading.Thread(target=extract, daemon=True), threading.Thread(target=parse, daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    # score frames on this thread as they arrive, keeping them for the final evaluation
+    stage = stages['score']
+    stage.start = time.perf_counter()
+    sequence = []
+
+    def scored_frames():
+        while True:
+            waiting = time.perf_counter()
+            item = frames.get()
+            stage.blocked += time.perf_counter() - waiting
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            sequence.append(item[1])
+            yield item
+
+    try:
+        if exercise == 'auto':
+            for _ in scored_frames():
+                pass
+        else:
+            evaluate_stream(scored_frames(), exercise, out)
+    except Exception:
+        process.kill()
+        raise
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise RuntimeError(' '.join(errors))
+
+    pose_seq = PoseSequence(np.array(sequence).reshape((-1, 18, 3)))
+    if exercise == 'auto':
+        exercise, confidence = detect_exercise(pose_seq, template_folder)
+        print('Exercise detected as: {} ({:.0%} of the nearest templates agree).'.format(exercise, confidence))
+    (correct, feedback) = evaluate_pose(pose_seq, exercise)
+    stage.end = time.perf_counter()
+    stage.items = len(sequence)
+    stage.busy = stage.end - stage.start - stage.blocked
+    stages['extract'].items = stages['parse'].items
+
+    for timing in stages.values():
+        print(timing.format(t0), file=out)
+    print('end to end {:.3f} s, {:.3f} s after extraction finished'.format(
+        stage.end - t0, stage.end - stages['extract'].end), file=out)
+    return correct, feedback, pose_seq, exercise
@@ -1,24 +1,89 @@
+import math
+from collections import namedtuple
+
 import numpy as np
 
+import instrument
+
+# Column views of one named joint across every frame of a PoseSequence.
+Joint = namedtuple('Joint', ['x', 'y', 'c', 'exists'])
+
+
 class PoseSequence:
-    def __init__(self, sequence):
-        self.poses = []
-        for parts in sequence:
-            self.poses.append(Pose(parts))
-        
-        # normalize poses based on the average torso pixel length
-        torso_lengths = np.array([Part.dist(pose.neck, pose.lhip) for pose in self.poses if pose.neck.exists and pose.lhip.exists] +
-                                 [Part.dist(pose.neck, pose.rhip) for pose in self.poses if pose.neck.exists and pose.rhip.exists])
-        mean_torso = np.mean(torso_lengths)
+    def __init__(self, sequence, mean_torso=None):
+        """Construct a pose sequence backed by a single keypoint array.
+
+        Arguments:
+            sequence - N * 18 * 3 array-like of x, y, confidence values
+            mean_torso - torso pixel length to normalize by, instead of the mean over the sequence,
+                such as that of the whole recording the sequence is a chunk of
+        """
+        with instrument.span('normalize'):
+            raw = np.asarray(sequence)
+
+            # presence mask, one entry per frame and part
+            self.exists = raw[:, :, 2] != 0.0
+
+            # normalize poses based on the average torso pixel length
+            self.mean_torso = _mean_torso(raw, self.exists) if mean_torso is None else mean_torso
+
+            self.keypoints = np.empty(raw.shape, dtype=np.float32)
+            np.divide(raw[:, :, :2], self.mean_torso, out=self.keypoints[:, :, :2], casting='unsafe')
+            self.keypoints[:, :, 2] = raw[:, :, 2]
+
+        self._poses = None
+
+    @classmethod
+    def from_normalized(cls, keypoints, mean_torso):
+        """Construct a pose sequence from the keypoints and mean_torso of another one, without copying."""
+        pose_seq = cls.__new__(cls)
+        pose_seq.keypoints = keypoints
+        pose_seq.exists = keypoints[:, :, 2] != 0.0
+        pose_seq.mean_torso = mean_torso
+        pose_seq._poses = None
+        return pose_seq
+
+    def __len__(self):
+        return self.keypoints.shape[0]
+
+    @property
+    def poses(self):
+        """List of per-frame Pose objects, built on first access."""
+        if self._poses is None:
+            self._poses = [Pose(parts) for parts in self.keypoints]
+        return self._poses
+
+    def joint(self, name):
+        """Return zero-copy x, y, c and exists column views for one named part."""
+        if not name in Pose.PART_INDEX:
+            raise NameError(name)
+        i = Pose.PART_INDEX[name]
+        return Joint(self.keypoints[:, i, 0], self.keypoints[:, i, 1], self.keypoints[:, i, 2], self.exists[:, i])
+
+
+def torso_lengths(keypoints, exists):
+    """Float64 lengths of the neck to left hip, then neck to right hip segments, where both ends exist."""
+    neck = keypoints[:, Pose.PART_INDEX['neck'], :2]
+    lengths = []
+    for hip_name in ('lhip', 'rhip'):
+        hip = keypoints[:, Pose.PART_INDEX[hip_name], :2]
+        both = exists[:, Pose.PART_INDEX['neck']] & exists[:, Pose.PART_INDEX[hip_name]]
+        diff = neck[both].astype(np.float64) - hip[both]
+        lengths.append(np.sqrt(np.square(diff[:, 0]) + np.square(diff[:, 1])))
+    return np.concatenate(lengths)
 
-        for pose in self.poses:
-            for attr, part in pose:
-                setattr(pose, attr, part / mean_torso)
 
+def _mean_torso(keypoints, exists):
+    lengths = torso_lengths(keypoints, exists)
+    if len(lengths) == 0:
+        return np.float64(np.nan)
+    # exactly rounded sum, so that summing chunks of the sequence gives the same mean, see chunked.py
+    return np.float64(math.fsum(lengths.tolist()) / len(lengths))
 
 
 class Pose:
     PART_NAMES = ['nose', 'neck',  'rshoulder', 'relbow', 'rwrist', 'lshoulder', 'lelbow', 'lwrist', 'rhip', 'rknee', 'rankle', 'lhip', 'lknee', 'lankle', 'reye', 'leye', 'rear', 'lear']
+    PART_INDEX = {name: i for i, name in enumerate(PART_NAMES)}
 
     def __init__(self, parts):
         """Construct a pose for one frame, given an array of parts
@@ -0,0 +1,198 @@
+"""Repetition segmentation and per-repetition evaluation.
+
+Repetitions are found in one pass over a smoothed primary joint signal, the
+feature of the metric named by the exercise's rep_signal (the elbow angle for
+curls and presses, the arm angle for front raises and shoulder height for
+shrugs). Every alternating peak and valley that differs from the
+previous one by more than a fraction of the signal's range is a turning point,
+and each turning point at the active end of the motion is one repetition,
+bounded by the turning points at the rest end on either side.
+
+The features of the exercise's compiled Plan are then reduced separately within
+each repetition, using NumPy reduceat over the repetition boundaries.
+"""
+
+import numpy as np
+
+from evaluate import EXERCISES
+from exercises import compile_plan
+from kinematics import present, select_side
+
+
+def exercise_series(pose_seq, exercise):
+    """Per-frame features behind the metrics of an exercise.
+
+    Args:
+        pose_seq: PoseSequence object.
+        exercise: String name of the exercise.
+
+    Returns:
+        frames: indices of the frames in which every part the exercise uses exists.
+        plan: exercises.Plan compiled for the arm evaluated.
+        features: (frames, columns) stacked features over those frames, see Plan.features.
+
+    Raises:
+        ValueError: if the exercise is not registered.
+    """
+    if exercise not in EXERCISES:
+        raise ValueError('Unknown exercise: {}'.format(exercise))
+    spec = EXERCISES[exercise]
+    plan = compile_plan(spec, select_side(pose_seq.exists) if spec.sided else None)
+    mask = present(pose_seq.exists, plan.required)
+    return np.flatnonzero(mask), plan, plan.features(pose_seq.keypoints[mask])
+
+
+def rep_signal(exercise):
+    """Return the Metric whose feature segments the repetitions of an Exercise, and its active end.
+
+    Raises:
+        ValueError: if the exercise has no rep_signal and no metric reduced by 'min' or 'max'.
+    """
+    metrics = {metric.name: metric for metric in exercise.metrics}
+    if exercise.rep_signal is not None:
+        name, active = exercise.rep_signal
+        if name not in metrics or active not in ('min', 'max'):
+            raise ValueError('Invalid rep_signal of {}: {}'.format(exercise.name, exercise.rep_signal))
+        return metrics[name], active
+    for metric in exercise.metrics:
+        if metric.reduce in ('min', 'max'):
+            return metric, metric.reduce
+    raise ValueError('Cannot segment the repetitions of {}: give its rep_signal.'.format(exercise.name))
+
+
+def smooth(signal, window=5):
+    """Centered moving average, repeating the end values as padding."""
+    if window <= 1 or len(signal) == 0:
+        return signal
+    padded = np.pad(signal, (window // 2, window - 1 - window // 2), mode='edge')
+    cumsum = np.cumsum(np.insert(padded, 0, 0.0))
+    return (cumsum[window:] - cumsum[:-window]) / window
+
+
+def turning_points(signal, min_change):
+    """Alternating peaks and valleys of a signal that differ by more than min_change.
+
+    Returns:
+        indices: frame indices of the turning points.
+        is_max: boolean array, True for peaks and False for valleys.
+    """
+    n = len(signal)
+    if n == 0:
+        return np.array([], dtype=int), np.array([], dtype=bool)
+
+    # only local extrema and the two ends can be turning points
+    slope = np.sign(np.diff(signal))
+    nonzero = np.flatnonzero(slope)
+    changes = nonzero[1:][slope[nonzero[1:]] != slope[nonzero[:-1]]]
+    candidates = np.concatenate(([0], changes, [n - 1]))
+    values = signal[candidates]
+
+    indices, is_max = [], []
+    hi = lo = values[0]
+    hi_index = lo_index = candidates[0]
+    direction = 0
+    for index, value in zip(candidates.tolist(), values.tolist()):
+        if value > hi:
+            hi, hi_index = value, index
+        if value < lo:
+            lo, lo_index = value, index
+        if direction >= 0 and value < hi - min_change:
+            indices.append(hi_index)
+            is_max.append(True)
+            lo, lo_index, direction = value, index, -1
+        elif direction <= 0 and value > lo + min_change:
+            indices.append(lo_index)
+            is_max.append(False)
+            hi, hi_index, direction = value, index, 1
+    # the last extremum has not been confirmed by a later change
+    if direction > 0:
+        indices.append(hi_index)
+        is_max.append(True)
+    elif direction < 0:
+        indices.append(lo_index)
+        is_max.append(False)
+    return np.array(indices, dtype=int), np.array(is_max, dtype=bool)
+
+
+def segment_reps(signal, active='min', window=5, min_fraction=0.3):
+    """Find repetition boundaries in a primary joint signal.
+
+    Args:
+        signal: per-frame primary signal.
+        active: 'min' or 'max', the end of the signal reached at the top of a rep.
+        window: moving average window used for smoothing.
+        min_fraction: turning points must differ by this fraction of the signal's
+            5th to 95th percentile range.
+
+    Returns:
+        bounds: k + 1 frame indices; rep i spans frames bounds[i] to bounds[i + 1] - 1.
+    """
+    if len(signal) == 0:
+        return np.array([0])
+    smoothed = smooth(np.asarray(signal, dtype=np.float64), window)
+    low, high = np.percentile(smoothed, [5, 95])
+    indices, is_max = turning_points(smoothed, min_fraction * (high - low))
+
+    is_active = is_max if active == 'max' else ~is_max
+    active_points = np.flatnonzero(is_active)
+    if len(active_points) == 0:
+        return np.array([0, len(signal)])
+
+    # reps start at the rest point before their active point, or the first frame
+    starts = np.where(active_points > 0, indices[np.maximum(active_points - 1, 0)], 0)
+    last = active_points[-1]
+    end = indices[last + 1] + 1 if last + 1 < len(indices) else len(signal)
+    return np.append(starts, end)
+
+
+def evaluate_reps(pose_seq, exercise, window=5, min_fraction=0.3):
+    """Evaluate each repetition of a pose sequence separately.
+
+    Args:
+        pose_seq: PoseSequence object.
+        exercise: String name of the exercise to evaluate.
+        window, min_fraction: as passed to segment_reps.
+
+    Returns:
+        List of one dict per repetition with its 'start' and 'end' frame, the
+        value of every metric, 'correct' and the 'feedback' string.
+    """
+    frames, plan, features = exercise_series(pose_seq, exercise)
+    metric, active = rep_signal(plan.exercise)
+    signal = features[:, plan.columns[metric.feature]]
+    signal = np.mean(signal, axis=1) if signal.shape[1] > 1 else signal[:, 0]
+    bounds = segment_reps(signal, active, window, min_fraction)
+    if len(frames) == 0 or len(bounds) < 2:
+        return []
+
+    starts = bounds[:-1]
+    truncated = features[:bounds[-1]]
+    maxs = np.maximum.reduceat(truncated, starts, axis=0)
+    mins = np.minimum.reduceat(truncated, starts, axis=0)
+
+    reps = []
+    for i in range(len(starts)):
+        metrics = plan.reduce(maxs[i], mins[i])
+        failed = [metric for metric in plan.exercise.metrics
+                  if (metrics[metric.name] > metric.threshold if metric.rule == '>'
+                      else metrics[metric.name] < metric.threshold)]
+        row = {'rep': i + 1, 'start': int(frames[bounds[i]]), 'end': int(frames[bounds[i + 1] - 1])}
+        row.update({name: float(value) for name, value in metrics.items()})
+        row['correct'] = not failed
+        row['feedback'] = ''.join(metric.feedback for metric in failed)
+        reps.append(row)
+    return reps
+
+
+def format_reps(reps):
+    """Format per-repetition results as a text table."""
+    if not reps:
+        return 'No repetitions detected.\n'
+    metrics = [name for name in reps[0] if name not in ('rep', 'start', 'end', 'correct', 'feedback')]
+    header = ['rep', 'frames'] + metrics + ['verdict']
+    rows = [[str(rep['rep']), '{}-{}'.format(rep['start'], rep['end'])] +
+            ['{:.3f}'.format(rep[metric]) for metric in metrics] +
+            ['correct' if rep['correct'] else 'could be improved'] for rep in reps]
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    return ''.join('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() + '\n'
+                   for row in [header] + rows)
@@ -0,0 +1,400 @@
+"""Local HTTP scoring service with micro-batching, and a load generator for it.
+
+The service keeps one warm process, with NumPy imported and exercise plans and
+the template index loaded once, and scores keypoint sequences posted to it:
+
+    POST /score?exercise=bicep_curl
+
+with a .npy file of (N, 18, 3) keypoints in pixels as the body, or a JSON body
+of {"exercise": ..., "keypoints": [...]} or {"exercise": ..., "frames": [...]}
+with OpenPose JSON frames. The exercise defaults to auto, which detects it. The
+response is a JSON verdict with the metrics of the sequence, or an error.
+
+Requests arriving together are scored as one batch: every sequence of the same
+exercise and side is evaluated in one vectorized pass over their concatenated
+frames. Batches run on a pool of worker processes; while every worker is busy
+new requests queue up, so batches grow with the load.
+
+GET /health answers {"status": "ok"}, and GET /metrics the instrument spans
+and counters of the service process as Prometheus text.
+
+Run this module to measure the latency and throughput of a running service:
+
+    py service.py --port 8000 --concurrency 16 --requests 2000
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import io
+import json
+import math
+import multiprocessing
+import os
+import signal
+import time
+import urllib.parse
+
+import numpy as np
+
+import instrument
+from batch import find_files, folder_exercise
+from classifier import detect_exercise
+from evaluate import EXERCISES, check_metrics, register_exercise
+from exercises import compute_metrics_batch
+from parse import frame_keypoints
+from pose import PoseSequence
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+def _json_float(value):
+    value = float(value)
+    return None if math.isnan(value) else value
+
+
+def score_batch(requests, template_folder='poses_compressed'):
+    """Score a batch of requests, evaluating those of the same exercise together.
+
+    Args:
+        requests: list of (exercise name or 'auto', (N, 18, 3) keypoints in pixels).
+        template_folder: labelled template clips for detecting the exercise.
+
+    Returns:
+        List of one result dict per request, with the 'exercise', 'frames',
+        'side', 'correct', 'feedback' and 'metrics', plus the 'confidence' of
+        detected exercises, or with an 'error'.
+    """
+    results = [None] * len(requests)
+    groups = {}
+    for i, (exercise, keypoints) in enumerate(requests):
+        try:
+            pose_seq = PoseSequence(keypoints)
+            confidence = None
+            if exercise == 'auto':
+                exercise, confidence = detect_exercise(pose_seq, template_folder)
+            if exercise not in EXERCISES:
+                raise ValueError('Unknown exercise: {}'.format(exercise))
+            result = {'exercise': exercise, 'frames': len(pose_seq)}
+            if confidence is not None:
+                result['confidence'] = confidence
+            groups.setdefault(exercise, []).append((i, pose_seq, result))
+        except Exception as e:
+            results[i] = {'error': str(e)}
+
+    for exercise, members in groups.items():
+        with instrument.span('score_batch', exercise=exercise):
+            scored = compute_metrics_batch([pose_seq for _, pose_seq, _ in members], EXERCISES[exercise])
+        for (i, _, result), (side, metrics) in zip(members, scored):
+            if metrics is None:
+                result['error'] = 'No frame in which every part needed by {} exists.'.format(exercise)
+            else:
+                correct, feedback = check_metrics(exercise, metrics)
+                result.update(side=side, correct=bool(correct), feedback=feedback,
+                              metrics={name: _json_float(value) for name, value in metrics.items()})
+            results[i] = result
+    return results
+
+
+def _init_worker(exercises):
+    # exercises registered in the service process, such as those of --exercise_file
+    for exercise in exercises:
+        register_exercise(exercise)
+
+
+def parse_request(target, content_type, body):
+    """Return the (exercise, keypoints) of a /score request."""
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(target).query)
+    exercise = query.get('exercise', ['auto'])[0]
+    if content_type.startswith('application/json'):
+        data = orjson.loads(body) if orjson is not None else json.loads(body)
+        exercise = data.get('exercise', exercise)
+        if 'frames' in data:
+            keypoints = np.array([frame_keypoints(frame) for frame in data['frames']]).reshape((-1, 18, 3))
+        else:
+            keypoints = np.array(data['keypoints'], dtype=np.float64).reshape((-1, 18, 3))
+    else:
+        keypoints = np.load(io.BytesIO(body), allow_pickle=False)
+        if keypoints.ndim != 3 or keypoints.shape[1:] != (18, 3):
+            raise ValueError('Expected (N, 18, 3) keypoints, got shape {}'.format(keypoints.shape))
+    return exercise, keypoints
+
+
+class ScoringService:
+    """Micro-batching scoring service.
+
+    Args:
+        workers: number of scoring processes, None for one per CPU, or 0 to
+            score on a thread of the service process.
+        max_batch: largest number of requests scored together.
+        batch_window: seconds to wait for more requests once one has arrived.
+        template_folder: labelled template clips for detecting the exercise.
+    """
+
+    def __init__(self, workers=None, max_batch=64, batch_window=0.002, template_folder='poses_compressed'):
+        self.workers = os.cpu_count() if workers is None else workers
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.template_folder = template_folder
+        self.queue = None
+        self.executor = None
+        self.slots = None
+        self.batches = 0
+        self.requests = 0
+
+    async def start(self, host='127.0.0.1', port=8000, unix_socket=None):
+        """Start serving, returning the asyncio server."""
+        self.executor = self._new_executor()
+        if self.workers:
+            # start the workers now rather than on the first requests
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*[loop.run_in_executor(self.executor, os.getpid) for _ in range(self.workers)])
+        self.queue = asyncio.Queue()
+        # batches being scored at once, one per worker
+        self.slots = asyncio.Semaphore(max(self.workers, 1))
+        self._batcher_task = asyncio.ensure_future(self._batcher())
+        if unix_socket:
+            return await asyncio.start_unix_server(self._handle, unix_socket)
+        return await asyncio.start_server(self._handle, host, port)
+
+    def _new_executor(self):
+        if self.workers:
+            # forked workers would inherit the listening socket, and keep it open if the service is killed
+            return concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker, initargs=(list(EXERCISES.values()),))
+        return concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def close(self):
+        self._batcher_task.cancel()
+        self.executor.shutdown(cancel_futures=True)
+
+    async def score(self, exercise, keypoints):
+        """Score one keypoint sequence along with the other requests waiting, returning its result dict."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((exercise, keypoints, future))
+        return await future
+
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            # wait for a worker before collecting the rest, so the batch takes in everything queued meanwhile
+            await self.slots.acquire()
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            asyncio.ensure_future(self._run_batch(batch))
+
+    async def _run_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        self.batches += 1
+        self.requests += len(batch)
+        instrument.count('service_requests', len(batch))
+        instrument.count('service_batches')
+        try:
+            with instrument.span('service_batch'):
+                results = await loop.run_in_executor(self.executor, score_batch,
+                                                     [(exercise, keypoints) for exercise, keypoints, _ in batch],
+                                                     self.template_folder)
+        except concurrent.futures.BrokenExecutor as e:
+            # a worker died, so later batches go to a new pool
+            self.executor = self._new_executor()
+            results = [{'error': 'Scoring failed: {}'.format(e)}] * len(batch)
+        except Exception as e:
+            results = [{'error': 'Scoring failed: {}'.format(e)}] * len(batch)
+        finally:
+            self.slots.release()
+        for (_, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _route(self, method, target, headers, body):
+        path = urllib.parse.urlsplit(target).path
+        if path == '/health':
+            return 200, 'application/json', json.dumps({'status': 'ok', 'batches': self.batches,
+                                                        'requests': self.requests}).encode()
+        if path == '/metrics':
+            return 200, 'text/plain; version=0.0.4', instrument.to_prometheus().encode()
+        if path != '/score':
+            return 404, 'application/json', json.dumps({'error': 'Unknown path: {}'.format(path)}).encode()
+        if method != 'POST':
+            return 405, 'application/json', json.dumps({'error': 'Use POST for /score.'}).encode()
+        try:
+            exercise, keypoints = parse_request(target, headers.get('content-type', ''), body)
+        except Exception as e:
+            return 400, 'application/json', json.dumps({'error': 'Bad request: {}'.format(e)}).encode()
+        result = await self.score(exercise, keypoints)
+        return (400 if 'error' in result else 200), 'application/json', json.dumps(result).encode()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                try:
+                    status, content_type, payload = await self._route(method, target, headers, body)
+                except Exception as e:
+                    status, content_type, payload = 500, 'application/json', json.dumps({'error': str(e)}).encode()
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                    status, STATUS_TEXT[status], content_type, len(payload), 'keep-alive' if keep_alive else 'close'
+                ).encode('latin-1') + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def serve(host='127.0.0.1', port=8000, unix_socket=None, workers=None, max_batch=64, batch_window=0.002,
+          template_folder='poses_compressed'):
+    """Run a ScoringService until interrupted."""
+    async def run():
+        try:
+            # stop on SIGTERM as on Ctrl+C, shutting down the worker processes
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        except NotImplementedError:
+            pass
+        service = ScoringService(workers, max_batch, batch_window, template_folder)
+        server = await service.start(host, port, unix_socket)
+        print('Serving on {}'.format(unix_socket or 'http://{}:{}'.format(host, port)), flush=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            service.close()
+
+    instrument.enable()
+    try:
+        asyncio.run(run())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+async def _request(reader, writer, target, body, content_type):
+    writer.write('POST {} HTTP/1.1\r\nHost: localhost\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n'.format(
+        target, content_type, len(body)).encode('latin-1') + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+async def load_test(requests, num_requests, concurrency, host='127.0.0.1', port=8000, unix_socket=None):
+    """Send requests to a running service from concurrent keep-alive connections.
+
+    Args:
+        requests: list of (target, body, content type) to cycle through.
+        num_requests: total number of requests to send.
+        concurrency: number of connections, each sending one request at a time.
+        host, port, unix_socket: address of the service.
+
+    Returns:
+        Dict of the 'requests', 'errors', 'seconds', 'rps' and the 'p50' and
+        'p99' latencies in seconds.
+    """
+    latencies = []
+    errors = []
+    sent = iter(range(num_requests))
+
+    async def client():
+        if unix_socket:
+            reader, writer = await asyncio.open_unix_connection(unix_socket)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for i in sent:
+                target, body, content_type = requests[i % len(requests)]
+                start = time.perf_counter()
+                status, _ = await _request(reader, writer, target, body, content_type)
+                latencies.append(time.perf_counter() - start)
+                if status != 200:
+                    errors.append(status)
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    seconds = time.perf_counter() - start
+    p50, p99 = np.percentile(latencies, [50, 99])
+    return {'requests': len(latencies), 'errors': len(errors), 'seconds': seconds, 'rps': len(latencies) / seconds,
+            'p50': p50, 'p99': p99}
+
+
+def fixture_requests(folder='poses_compressed', fmt='npy'):
+    """One /score request per fixture file under folder, as (target, body, content type)."""
+    requests = []
+    for path in find_files(folder):
+        exercise = folder_exercise(path) or 'auto'
+        keypoints = np.load(path)
+        if fmt == 'json':
+            body = json.dumps({'exercise': exercise, 'keypoints': keypoints.tolist()}).encode()
+            requests.append(('/score', body, 'application/json'))
+        else:
+            buffer = io.BytesIO()
+            np.save(buffer, keypoints)
+            requests.append(('/score?exercise={}'.format(exercise), buffer.getvalue(), 'application/x-npy'))
+    return requests
+
+
+def format_load(label, stats):
+    return '{:<28} {:>8.1f} req/s, p50 {:>7.2f} ms, p99 {:>7.2f} ms, {} errors'.format(
+        label, stats['rps'], stats['p50'] * 1000, stats['p99'] * 1000, stats['errors'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pose Trainer scoring service load generator')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='service host')
+    parser.add_argument('--port', type=int, default=8000, help='service port')
+    parser.add_argument('--socket', type=str, default=None, help='service Unix socket, instead of host and port')
+    parser.add_argument('--fixtures', type=str, default='poses_compressed', help='folder of .npy files to send')
+    parser.add_argument('--format', type=str, default='npy', help='request body format, npy or json')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16], help='numbers of concurrent connections')
+    parser.add_argument('--requests', type=int, default=1000, help='number of requests per concurrency level')
+
+    args = parser.parse_args()
+
+    requests = fixture_requests(args.fixtures, args.format)
+    for concurrency in args.concurrency:
+        stats = asyncio.run(load_test(requests, args.requests, concurrency, args.host, args.port, args.socket))
+        print(format_load('{} connections'.format(concurrency), stats))
+
+
+if __name__ == '__main__':
+    main()
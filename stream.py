@@ -0,0 +1,249 @@
+"""Streaming evaluation of pose keypoints, one frame at a time.
+
+Frames are raw OpenPose keypoints in pixels. Each frame updates running min/max
+statistics of the features of the exercise's compiled Plan in O(1), and
+feedback is emitted as soon as a threshold is crossed, once the arm evaluated
+and the torso length have settled. Torso normalization uses
+a running estimate of the mean torso length instead of the mean over the whole
+sequence, which is applied to the metrics when they are checked; angles do not
+need it.
+"""
+
+import json
+import os
+import re
+import sys
+import time
+
+import numpy as np
+
+from evaluate import EXERCISES
+from exercises import compile_plan
+from kinematics import part_index, side_parts
+from parse import frame_keypoints, read_json
+
+# Feature kinds in pixels, whose metrics are divided by the running torso length.
+SCALED_KINDS = ('vector', 'coordinate')
+
+# Frames, one second at 30 frames/s, by which the arm evaluated must lead the
+# other, and torso lengths measured, before metrics are reported as they cross.
+SETTLE_FRAMES = 30
+
+# File names of the frames OpenPose writes with --write_json, by video name and frame index.
+FRAME_NAME = '{}_{:012d}_keypoints.json'
+FRAME_PATTERN = re.compile(r'^(.*)_(\d{12})_keypoints\.json$')
+
+
+def _immediate(metric):
+    # metrics that can only be crossed further as frames arrive
+    return (metric.reduce == 'range' and metric.rule == '>') or (metric.reduce == 'max' and metric.rule == '>') or \
+        (metric.reduce == 'min' and metric.rule == '<')
+
+
+class StreamEvaluator:
+    """Running evaluation of one exercise.
+
+    Metrics that can only be crossed further as frames arrive, ranges and
+    maxima that fail above their threshold and minima that fail below it, are
+    reported right away; the others are checked at the end of the stream.
+
+    Reporting right away waits until the arm evaluated has been seen in
+    settle_frames more frames than the other, and, for metrics divided by the
+    torso length, until that many torso lengths have been measured. Both can
+    still change afterwards, so finish() gives the verdict, which in rare cases
+    does not include feedback reported earlier.
+
+    Args:
+        exercise: String name of the exercise to evaluate.
+        settle_frames: frames to wait for, as above.
+
+    Raises:
+        ValueError: if the exercise is not registered.
+    """
+
+    def __init__(self, exercise, settle_frames=SETTLE_FRAMES):
+        if exercise not in EXERCISES:
+            raise ValueError('Unknown exercise: {}'.format(exercise))
+        self.exercise = exercise
+        self.spec = EXERCISES[exercise]
+        self.plans = {side: compile_plan(self.spec, side)
+                      for side in (('right', 'left') if self.spec.sided else (None,))}
+        self.immediate = [metric for metric in self.spec.metrics if _immediate(metric)]
+        self.settle_frames = settle_frames
+        self.num_frames = 0
+        self.torso_sum = 0.0
+        self.torso_count = 0
+        self.side_counts = {'right': 0, 'left': 0}
+        # running per-column feature extremes, by side
+        self.mins = {}
+        self.maxs = {}
+        self.reported = set()
+
+    @property
+    def mean_torso(self):
+        return self.torso_sum / self.torso_count if self.torso_count else np.nan
+
+    @property
+    def side(self):
+        return 'right' if self.side_counts['right'] > self.side_counts['left'] else 'left'
+
+    def update(self, keypoints):
+        """Add one frame of 18 * 3 keypoints and return any new feedback strings."""
+        exists = keypoints[:, 2] != 0.0
+        self.num_frames += 1
+
+        for hip in ('lhip', 'rhip'):
+            if exists[part_index('neck')] and exists[part_index(hip)]:
+                self.torso_sum += np.hypot(*(keypoints[part_index('neck'), :2] - keypoints[part_index(hip), :2]))
+                self.torso_count += 1
+
+        for side, plan in self.plans.items():
+            if side is not None and all(exists[part_index(part)] for part in side_parts(side, 'shoulder', 'elbow', 'wrist')):
+                self.side_counts[side] += 1
+            if not exists[plan.required].all():
+                continue
+            features = plan.features(keypoints[np.newaxis])[0]
+            # NaN features propagate, as they do in Plan.evaluate
+            if side in self.mins:
+                np.minimum(self.mins[side], features, out=self.mins[side])
+                np.maximum(self.maxs[side], features, out=self.maxs[side])
+            else:
+                self.mins[side] = features
+                self.maxs[side] = features.copy()
+
+        feedback = []
+        side_settled = not self.spec.sided or \
+            abs(self.side_counts['right'] - self.side_counts['left']) >= self.settle_frames
+        if self.immediate and side_settled:
+            metrics = self.metrics()
+            torso_settled = self.torso_count >= self.settle_frames
+            for metric in self.immediate:
+                if metric.feature.kind in SCALED_KINDS and not torso_settled:
+                    continue
+                if metric.name not in self.reported and _crossed(metric, metrics):
+                    self.reported.add(metric.name)
+                    feedback.append(metric.feedback)
+        return feedback
+
+    def finish(self):
+        """Return the final (correct, feedback) for the frames seen so far."""
+        metrics = self.metrics()
+        feedback = ''.join(metric.feedback for metric in self.spec.metrics if _crossed(metric, metrics))
+        if feedback:
+            return (False, feedback)
+        return (True, self.spec.success)
+
+    def metrics(self):
+        """Return the current metric values, normalized by the running torso length."""
+        side = self.side if self.spec.sided else None
+        if side not in self.mins:
+            return {}
+        metrics = self.plans[side].reduce(self.maxs[side], self.mins[side])
+        for metric in self.spec.metrics:
+            if metric.feature.kind in SCALED_KINDS:
+                metrics[metric.name] = metrics[metric.name] / self.mean_torso
+        return metrics
+
+
+def _crossed(metric, metrics):
+    value = metrics.get(metric.name)
+    if value is None or np.isnan(value):
+        return False
+    if metric.rule == '>':
+        return value > metric.threshold
+    return value < metric.threshold
+
+
+def tail_folder(folder, poll_interval=0.05, idle_timeout=5.0, done=None):
+    """Yield (arrival time, keypoints) for OpenPose JSON frames as they are written.
+
+    Frames are read in frame index order from OpenPose's
+    <video>_<frame index>_keypoints.json files. The folder is only listed until
+    the first frame appears; after that each poll checks for the file of the
+    next frame index alone.
+
+    Stops once no new frame has appeared for idle_timeout seconds, or, if done is
+    given, once done() returns True and every frame written before has been read.
+    """
+    prefix, next_index = None, 0
+    last_frame = time.monotonic()
+    while True:
+        finished = done is not None and done()
+        if prefix is None:
+            prefix, next_index = _first_frame(folder)
+        written = prefix is not None
+        while written:
+            arrival = time.perf_counter()
+            try:
+                json_obj = read_json(os.path.join(folder, FRAME_NAME.format(prefix, next_index)))
+            except FileNotFoundError:
+                written = False
+                break
+            except json.JSONDecodeError:
+                # still being written, read it again on the next poll
+                break
+            next_index += 1
+            last_frame = time.monotonic()
+            yield arrival, frame_keypoints(json_obj)
+        if finished and not written:
+            return
+        if time.monotonic() - last_frame > idle_timeout:
+            return
+        time.sleep(poll_interval)
+
+
+def _first_frame(folder):
+    # video name and index of the earliest frame written so far, or (None, 0)
+    names = os.listdir(folder) if os.path.isdir(folder) else []
+    frames = sorted((int(match.group(2)), match.group(1)) for match in map(FRAME_PATTERN.match, names) if match)
+    if not frames:
+        return None, 0
+    return frames[0][1], frames[0][0]
+
+
+def read_ndjson(lines):
+    """Yield (arrival time, keypoints) for NDJSON lines.
+
+    Each line is either an OpenPose JSON frame or a flat list of 54 keypoint values.
+    """
+    for line in lines:
+        arrival = time.perf_counter()
+        if not line.strip():
+            continue
+        json_obj = json.loads(line)
+        if isinstance(json_obj, list):
+            yield arrival, np.array(json_obj, dtype=np.float64).reshape((18, 3))
+        else:
+            yield arrival, frame_keypoints(json_obj)
+
+
+def evaluate_stream(frames, exercise, out=sys.stdout):
+    """Evaluate a stream of frames, printing feedback as soon as it is available.
+
+    Args:
+        frames: iterable of (arrival time, keypoints) from tail_folder or read_ndjson.
+        exercise: String name of the exercise to evaluate.
+        out: file to print feedback and the latency report to.
+
+    Returns:
+        correct: Bool whether exercise was performed correctly.
+        feedback: Feedback string.
+        latencies: array of seconds from each frame arriving to its feedback.
+
+    Raises:
+        ValueError: if the exercise is not registered.
+    """
+    evaluator = StreamEvaluator(exercise)
+    latencies = []
+    for arrival, keypoints in frames:
+        feedback = evaluator.update(keypoints)
+        latencies.append(time.perf_counter() - arrival)
+        for message in feedback:
+            print('[frame {}, {:.2f} ms] {}'.format(evaluator.num_frames, latencies[-1] * 1000, message), end='', file=out)
+
+    latencies = np.array(latencies)
+    if len(latencies):
+        print('{} frames, frame-to-feedback latency: p50 {:.3f} ms, p99 {:.3f} ms, max {:.3f} ms'.format(
+            len(latencies), *(np.percentile(latencies, [50, 99, 100]) * 1000)), file=out)
+    correct, feedback = evaluator.finish()
+    return correct, feedback, latencies
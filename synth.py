@@ -0,0 +1,393 @@
+"""Synthetic COCO keypoint sequences of the supported exercises, without video or OpenPose.
+
+Each exercise is described by a Motion: the joint values of the performer at
+rest and at the peak of a repetition, and at the peak of each form fault. A
+repetition moves every joint from rest to peak, holds it, and returns along a
+raised cosine, with the duration and extent varying from rep to rep. Joint
+values become keypoints by forward kinematics of a stick figure, seen from the
+side with the far arm mostly hidden, as in the fixtures, or from the front for
+shoulder shrugs. Pixel noise, random confidences and dropped parts are added
+last, and other people doing other exercises can share the frames.
+
+Clips are written as .npy or .kps files of the first person, in one folder per
+exercise with good or bad in the file names, as batch_evaluate and calibrate.py
+expect; as folders of OpenPose JSON frames of every person, as
+parse.parse_sequence ingests; or as NDJSON frames to stdout, for the stream mode:
+
+    py synth.py --output synthetic --clips 1000
+    py main.py --mode batch_evaluate --pose_folder synthetic
+    py synth.py --exercise bicep_curl --fault partial_curl --format ndjson | py main.py --mode stream --json_folder - --exercise bicep_curl
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from parse import create_kps
+from pose import Pose
+
+
+@dataclass(frozen=True)
+class Motion:
+    """Joint trajectory of one exercise.
+
+    Joints are 'shoulder', the angle in degrees of the upper arm forward from
+    hanging down; 'elbow', the flexion of the elbow in degrees; 'lean', the
+    backward lean of the torso in degrees; 'roll', the backward shift of the
+    shoulders in torso lengths; and 'shrug', the lift of the shoulders in torso
+    lengths. Joints not given stay at 0.
+
+    Attributes:
+        view: 'side' for a figure facing left or right, or 'front'.
+        rest: joint values at rest, by joint name.
+        peak: joint values at the peak of a correct repetition.
+        faults: joint values at the peak of each form fault, by fault name,
+            replacing those of peak.
+    """
+    view: str
+    rest: dict
+    peak: dict
+    faults: dict
+
+
+MOTIONS = {
+    'bicep_curl': Motion('side', {'shoulder': 5, 'elbow': 10}, {'shoulder': 10, 'elbow': 140}, {
+        'swinging_arm': {'shoulder': 55},
+        'partial_curl': {'elbow': 85},
+    }),
+    'front_raise': Motion('side', {'shoulder': 5, 'elbow': 8}, {'shoulder': 100, 'elbow': 8}, {
+        'partial_raise': {'shoulder': 65},
+        'back_swing': {'lean': 22},
+    }),
+    'shoulder_press': Motion('side', {'shoulder': 70, 'elbow': 110}, {'shoulder': 180, 'elbow': 0}, {
+        'partial_press': {'shoulder': 150, 'elbow': 35},
+        'shoulder_roll': {'roll': 0.4},
+        'back_arch': {'lean': 15},
+    }),
+    'shoulder_shrug': Motion('front', {'elbow': 5}, {'shrug': 0.2, 'elbow': 5}, {
+        'small_shrug': {'shrug': 0.02},
+        'bent_arms': {'elbow': 50},
+    }),
+}
+
+JOINTS = ('shoulder', 'elbow', 'lean', 'roll', 'shrug')
+
+# Upper arm and forearm lengths, in torso lengths.
+UPPER_ARM = 0.5
+FOREARM = 0.45
+
+# Positions of the parts that do not depend on the joints, in torso lengths
+# from the hips, x forward (side view) or to the right of the image (front
+# view) and y down. 'near' and 'far' parts are those of the side facing the
+# camera and the other side.
+SIDE_PARTS = {
+    'neck': (0.0, -1.0), 'nose': (0.2, -1.25), 'near_eye': (0.16, -1.31), 'far_eye': (0.18, -1.32),
+    'near_ear': (-0.04, -1.27), 'far_ear': (-0.02, -1.28), 'near_hip': (0.02, 0.0), 'far_hip': (-0.01, 0.01),
+    'near_knee': (0.05, 0.72), 'far_knee': (0.0, 0.73), 'near_ankle': (0.02, 1.42), 'far_ankle': (-0.02, 1.43),
+}
+FRONT_PARTS = {
+    'neck': (0.0, -1.0), 'nose': (0.0, -1.25), 'reye': (-0.05, -1.3), 'leye': (0.05, -1.3),
+    'rear': (-0.1, -1.27), 'lear': (0.1, -1.27), 'rhip': (-0.15, 0.0), 'lhip': (0.15, 0.0),
+    'rknee': (-0.16, 0.72), 'lknee': (0.16, 0.72), 'rankle': (-0.17, 1.42), 'lankle': (0.17, 1.42),
+}
+
+# Fraction of frames each part of the far side is hidden in, in the side view.
+HIDDEN = {'shoulder': 0.05, 'elbow': 0.8, 'wrist': 0.98, 'eye': 0.5, 'ear': 1.0, 'hip': 0.0, 'knee': 0.6, 'ankle': 0.9}
+
+
+def activation(reps, num_frames, fps, rng):
+    """(frames,) extent of the motion from rest (0) to peak (1), one repetition after another.
+
+    Each repetition rises along a raised cosine for 40% of its duration, holds
+    for 20% and returns. Durations and extents vary from rep to rep, with at
+    least one rep reaching the peak. Half a second of rest starts and ends the
+    clip.
+
+    Args:
+        reps: number of repetitions.
+        num_frames: length of the clip, or None for about 2 s per repetition.
+        fps: frame rate.
+        rng: np.random.Generator.
+    """
+    durations = rng.uniform(1.6, 2.4, size=reps) * fps
+    rest = int(0.5 * fps)
+    if num_frames is None:
+        num_frames = int(durations.sum()) + 2 * rest
+    rest = min(rest, num_frames // 4)
+    # start of each repetition, in frames, as a fraction of the frames between the rests
+    bounds = np.concatenate([[0.0], np.cumsum(durations)]) / durations.sum() * (num_frames - 2 * rest)
+    t = np.arange(num_frames) - rest
+    rep = np.clip(np.searchsorted(bounds, t, side='right') - 1, 0, reps - 1)
+    progress = np.clip((t - bounds[rep]) / (bounds[rep + 1] - bounds[rep]), 0.0, 1.0)
+    extents = rng.uniform(0.9, 1.0, size=reps)
+    extents[rng.integers(reps)] = 1.0
+    away = np.minimum(progress, 1.0 - progress)
+    values = (0.5 - 0.5 * np.cos(np.pi * np.minimum(away / 0.4, 1.0))) * extents[rep]
+    return np.where((t >= 0) & (t < bounds[-1]), values, 0.0)
+
+
+def trajectory(motion, fault, amount, fps, rng):
+    """Joint values by joint name for an activation array, adding a slow sway to the torso lean."""
+    if fault is not None and fault not in motion.faults:
+        raise ValueError('Unknown fault: {}. One of {}'.format(fault, ', '.join(sorted(motion.faults))))
+    peak = dict(motion.peak, **(motion.faults[fault] if fault else {}))
+    joints = {}
+    for joint in JOINTS:
+        rest = motion.rest.get(joint, 0.0)
+        joints[joint] = rest + (peak.get(joint, 0.0) - rest) * amount
+    # a degree or so of sway with a period of a few seconds
+    t = np.arange(len(amount)) / fps
+    joints['lean'] = joints['lean'] + rng.uniform(0.5, 1.0) * np.sin(2 * np.pi * t / rng.uniform(2.0, 4.0) +
+                                                                       rng.uniform(0, 2 * np.pi))
+    return joints
+
+
+def _direction(degrees):
+    # unit vector of an angle forward from straight down
+    radians = np.radians(degrees)
+    return np.stack([np.sin(radians), np.cos(radians)], axis=-1)
+
+
+def figure(motion, joints, facing=1):
+    """(frames, 18, 2) positions of the parts, in torso lengths from the hips, y down.
+
+    Args:
+        motion: Motion of the joints.
+        joints: joint value arrays by joint name, as returned by trajectory.
+        facing: 1 to face the right of the image, showing the right side, or
+            -1 to face left, showing the left side. Ignored in the front view.
+    """
+    num_frames = len(joints['elbow'])
+    positions = np.zeros((num_frames, 18, 2))
+
+    def put(name, xy):
+        positions[:, Pose.PART_INDEX[name]] = xy
+
+    if motion.view == 'side':
+        near, far = ('r', 'l') if facing == 1 else ('l', 'r')
+        for name, xy in SIDE_PARTS.items():
+            put(name.replace('near_', near).replace('far_', far), xy)
+        for prefix, offset in ((near, 0.03), (far, -0.05)):
+            shoulder = np.stack([offset - joints['roll'], -0.96 - joints['shrug']], axis=-1)
+            elbow = shoulder + UPPER_ARM * _direction(joints['shoulder'])
+            put(prefix + 'shoulder', shoulder)
+            put(prefix + 'elbow', elbow)
+            put(prefix + 'wrist', elbow + FOREARM * _direction(joints['shoulder'] + joints['elbow']))
+
+        # lean the upper body back around the hips
+        lean = np.radians(joints['lean'])[:, np.newaxis]
+        upper = np.array([name not in ('rhip', 'lhip', 'rknee', 'lknee', 'rankle', 'lankle')
+                          for name in Pose.PART_NAMES])
+        x, y = positions[:, upper, 0].copy(), positions[:, upper, 1].copy()
+        positions[:, upper, 0] = x * np.cos(lean) + y * np.sin(lean)
+        positions[:, upper, 1] = -x * np.sin(lean) + y * np.cos(lean)
+        positions[:, :, 0] *= facing
+    else:
+        for name, xy in FRONT_PARTS.items():
+            put(name, xy)
+        for prefix, outward in (('r', -1), ('l', 1)):
+            shoulder = np.stack([np.full(num_frames, 0.28 * outward), -0.95 - joints['shrug']], axis=-1)
+            # arms hang slightly away from the body and bend outward
+            elbow = shoulder + UPPER_ARM * _direction(np.full(num_frames, 8.0)) * [outward, 1]
+            put(prefix + 'shoulder', shoulder)
+            put(prefix + 'elbow', elbow)
+            put(prefix + 'wrist', elbow + FOREARM * _direction(8.0 + joints['elbow']) * [outward, 1])
+    return positions
+
+
+def synthesize(exercise, fault=None, reps=5, num_frames=None, fps=30.0, noise=1.0, drop=0.02, people=1, seed=None):
+    """Synthesize a clip of people doing exercises.
+
+    Args:
+        exercise: name of the exercise of the first person, a key of MOTIONS.
+        fault: form fault of the first person, a key of its Motion faults, or
+            None for correct form.
+        reps: number of repetitions.
+        num_frames: length of the clip, or None for about 2 s per repetition.
+        fps: frame rate.
+        noise: standard deviation of the pixel noise of every part.
+        drop: fraction of parts missing in each frame, besides those hidden.
+        people: number of people; the others do random exercises, with random
+            faults, beside the first one.
+        seed: seed or np.random.Generator.
+
+    Returns:
+        (people, frames, 18, 3) keypoints in pixels of a 640 x 480 image, with
+        missing parts zeroed as OpenPose does.
+    """
+    if exercise not in MOTIONS:
+        raise ValueError('Unknown exercise: {}. One of {}'.format(exercise, ', '.join(sorted(MOTIONS))))
+    rng = np.random.default_rng(seed)
+    amount = activation(reps, num_frames, fps, rng)
+    num_frames = len(amount)
+    keypoints = np.zeros((people, num_frames, 18, 3))
+    for person in range(people):
+        if person > 0:
+            exercise = rng.choice(sorted(MOTIONS))
+            fault = rng.choice([None] + sorted(MOTIONS[exercise].faults))
+            amount = activation(int(rng.integers(3, 8)), num_frames, fps, rng)
+        motion = MOTIONS[exercise]
+        facing = rng.choice([-1, 1])
+        torso = rng.uniform(90.0, 130.0)
+        # the first person in the middle, the others to alternate sides, closer together in a crowd
+        spacing = min(200.0, 560.0 / people)
+        center = 320.0 + spacing * ((person + 1) // 2) * (-1) ** person + rng.normal(0.0, 20.0)
+        positions = figure(motion, trajectory(motion, fault, amount, fps, rng), facing)
+        keypoints[person, :, :, :2] = positions * torso + [center, 280.0] + rng.normal(0.0, noise, (num_frames, 18, 2))
+        keypoints[person, :, :, 2] = rng.uniform(0.4, 0.95, size=(num_frames, 18))
+
+        missing = rng.random((num_frames, 18)) < drop
+        if motion.view == 'side':
+            far = 'l' if facing == 1 else 'r'
+            for part, fraction in HIDDEN.items():
+                missing[:, Pose.PART_INDEX[far + part]] |= rng.random(num_frames) < fraction
+        keypoints[person][missing] = 0.0
+    return keypoints
+
+
+def json_frame(people_keypoints):
+    """OpenPose JSON frame of the (people, 18, 3) keypoints of one frame, leaving out people with no part."""
+    return {'version': 1.3, 'people': [{'pose_keypoints_2d': keypoints.ravel().tolist()}
+                                       for keypoints in people_keypoints if keypoints[:, 2].any()]}
+
+
+def write_clip(path, keypoints, fmt='npy', fps=30.0):
+    """Write a synthesized clip.
+
+    Args:
+        path: output path without extension; a folder for JSON frames.
+        keypoints: (people, frames, 18, 3) keypoints, as returned by synthesize.
+        fmt: 'npy' or 'kps' for a file of the first person, or 'json' for a
+            folder of OpenPose JSON frames of every person.
+        fps: frame rate stored in kps headers.
+
+    Returns:
+        Path written.
+    """
+    if fmt == 'npy':
+        np.save(path + '.npy', keypoints[0])
+        return path + '.npy'
+    if fmt == 'kps':
+        output = create_kps(path + '.kps', keypoints.shape[1], np.float32, {'fps': fps, 'source': 'synth'})
+        output[:] = keypoints[0]
+        if isinstance(output, np.memmap):
+            output.flush()
+        return path + '.kps'
+    if fmt == 'json':
+        os.makedirs(path, exist_ok=True)
+        name = os.path.basename(path)
+        for i in range(keypoints.shape[1]):
+            with open(os.path.join(path, '{}_{:012d}_keypoints.json'.format(name, i)), 'w') as f:
+                json.dump(json_frame(keypoints[:, i]), f)
+        return path
+    raise ValueError('Unknown clip format: {}'.format(fmt))
+
+
+def _clip_task(task):
+    path, exercise, fault, fmt, options = task
+    keypoints = synthesize(exercise, fault, **options)
+    return write_clip(path, keypoints, fmt, options.get('fps', 30.0)), keypoints.shape[1]
+
+
+def generate(root, clips=100, exercises=None, fault_rate=0.5, fmt='npy', workers=None, seed=0, **options):
+    """Write labelled clips of each exercise under root/<exercise>/.
+
+    Clips are named <exercise>_good_<i> or <exercise>_bad_<i>, the bad ones
+    with a random fault of the exercise, and listed in root/manifest.jsonl.
+
+    Args:
+        root: output folder.
+        clips: number of clips per exercise.
+        exercises: exercise names, or None for every exercise in MOTIONS.
+        fault_rate: fraction of the clips with a form fault.
+        fmt: clip format, as passed to write_clip.
+        workers: number of processes, None for one per CPU.
+        seed: seed of the whole dataset; each clip has its own derived seed.
+        **options: other arguments of synthesize, such as reps or noise.
+
+    Returns:
+        List of manifest rows, dicts of the file (relative to root), exercise,
+        fault and frames of each clip.
+    """
+    tasks = []
+    rows = []
+    for exercise_index, exercise in enumerate(exercises or sorted(MOTIONS)):
+        os.makedirs(os.path.join(root, exercise), exist_ok=True)
+        for i in range(clips):
+            rng = np.random.default_rng([seed, exercise_index, i])
+            fault = rng.choice(sorted(MOTIONS[exercise].faults)) if rng.random() < fault_rate else None
+            name = '{}_{}_{}'.format(exercise, 'bad' if fault else 'good', i + 1)
+            tasks.append((os.path.join(root, exercise, name), exercise, fault, fmt, dict(options, seed=rng)))
+            rows.append({'exercise': exercise, 'fault': fault})
+
+    workers = workers or os.cpu_count()
+    if workers == 1 or len(tasks) <= 1:
+        written = [_clip_task(task) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            written = list(executor.map(_clip_task, tasks, chunksize=max(1, len(tasks) // (4 * workers))))
+
+    with open(os.path.join(root, 'manifest.jsonl'), 'w') as f:
+        for row, (path, num_frames) in zip(rows, written):
+            row.update(file=os.path.relpath(path, root), frames=num_frames)
+            f.write(json.dumps(row) + '\n')
+    return rows
+
+
+def write_ndjson(keypoints, out=sys.stdout, fps=30.0, realtime=False):
+    """Write a clip as NDJSON OpenPose frames, as read by stream.read_ndjson, optionally at its frame rate."""
+    for i in range(keypoints.shape[1]):
+        out.write(json.dumps(json_frame(keypoints[:, i])) + '\n')
+        out.flush()
+        if realtime:
+            time.sleep(1.0 / fps)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pose Trainer Synthetic Clips')
+    parser.add_argument('--output', type=str, default='synthetic', help='Output folder, with one folder per exercise.')
+    parser.add_argument('--format', type=str, default='npy', help='npy, kps, json for folders of OpenPose JSON frames, '
+            'or ndjson to write one clip to stdout for the stream mode.')
+    parser.add_argument('--clips', type=int, default=100, help='Number of clips per exercise.')
+    parser.add_argument('--exercise', type=str, nargs='*', default=None, help='Exercises to synthesize. Defaults to all of '
+            'them: ' + ', '.join(sorted(MOTIONS)))
+    parser.add_argument('--fault', type=str, default=None, help='(ndjson only) Form fault of the clip. Defaults to none.')
+    parser.add_argument('--fault_rate', type=float, default=0.5, help='Fraction of the clips with a random form fault.')
+    parser.add_argument('--reps', type=int, default=5, help='Number of repetitions per clip.')
+    parser.add_argument('--frames', type=int, default=None, help='Frames per clip. Defaults to about 2 s per repetition.')
+    parser.add_argument('--fps', type=float, default=30.0, help='Frame rate.')
+    parser.add_argument('--noise', type=float, default=1.0, help='Standard deviation of the keypoint noise, in pixels.')
+    parser.add_argument('--drop', type=float, default=0.02, help='Fraction of parts dropped from each frame.')
+    parser.add_argument('--people', type=int, default=1, help='People per clip; only the first one is written to npy '
+            'and kps files.')
+    parser.add_argument('--realtime', action='store_true', help='(ndjson only) Write frames at the frame rate.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes. Defaults to one per CPU.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+
+    args = parser.parse_args()
+
+    options = dict(reps=args.reps, num_frames=args.frames, fps=args.fps, noise=args.noise, drop=args.drop,
+                   people=args.people)
+    if args.format == 'ndjson':
+        exercise = args.exercise[0] if args.exercise else 'bicep_curl'
+        write_ndjson(synthesize(exercise, args.fault, seed=args.seed, **options), fps=args.fps,
+                     realtime=args.realtime)
+        return
+
+    start = time.perf_counter()
+    rows = generate(args.output, args.clips, args.exercise, args.fault_rate, args.format, args.workers, args.seed,
+                    **options)
+    seconds = time.perf_counter() - start
+    frames = sum(row['frames'] for row in rows)
+    print('{} clips, {} frames in {:.2f} s: {:.1f} clips/s, {:.0f} frames/s'.format(
+        len(rows), frames, seconds, len(rows) / seconds, frames / seconds))
+
+
+if __name__ == '__main__':
+    main()
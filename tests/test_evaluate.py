@@ -0,0 +1,85 @@
+"""Regression tests of the exercise evaluation against the original implementation.
+
+golden_baseline.json holds, for every fixture in poses_compressed and every
+built-in exercise, the verdict, feedback, arm and metric values printed by the
+original per-exercise evaluate.py, before exercises.py replaced it, or the
+exception it raised. Metrics are now computed from float32 keypoints, so they
+are compared within a tolerance: angles near 0 or 180 degrees lose up to about
+0.02 degrees in float32 arccos.
+"""
+
+import contextlib
+import glob
+import io
+import json
+import math
+import os
+
+import pytest
+
+from evaluate import EXERCISES, evaluate_pose, score_pose
+from parse import load_ps
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'poses_compressed')
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden_baseline.json')) as f:
+    GOLDEN = json.load(f)
+
+# Largest differences from the float64 baseline, in degrees for angle metrics
+# and in torso lengths for the others.
+ANGLE_TOLERANCE = 0.05
+LENGTH_TOLERANCE = 1e-5
+
+
+def _load(key):
+    filename, exercise = key.split(':')
+    return load_ps(os.path.join(FIXTURES, filename)), exercise
+
+
+def test_golden_covers_fixtures():
+    filenames = [os.path.relpath(path, FIXTURES) for path in glob.glob(os.path.join(FIXTURES, '*', '*.npy'))]
+    expected = {'{}:{}'.format(filename, exercise) for filename in filenames
+                for exercise in ('bicep_curl', 'front_raise', 'shoulder_press', 'shoulder_shrug')}
+    assert set(GOLDEN) == expected
+
+
+@pytest.mark.filterwarnings('ignore::RuntimeWarning')
+@pytest.mark.parametrize('key', sorted(GOLDEN))
+def test_score_pose(key):
+    pose_seq, exercise = _load(key)
+    golden = GOLDEN[key]
+    if 'error' in golden:
+        with pytest.raises(ValueError):
+            score_pose(pose_seq, exercise)
+        return
+
+    correct, feedback, side, metrics = score_pose(pose_seq, exercise)
+    assert (correct, feedback, side) == (golden['correct'], golden['feedback'], golden['side'])
+    for metric in EXERCISES[exercise].metrics:
+        expected = golden['metrics'][metric.name]
+        value = float(metrics[metric.name])
+        if expected is None:
+            assert math.isnan(value), metric.name
+            continue
+        tolerance = ANGLE_TOLERANCE if metric.feature.kind == 'angle' else LENGTH_TOLERANCE
+        assert value == pytest.approx(expected, abs=tolerance), metric.name
+
+
+@pytest.mark.filterwarnings('ignore::RuntimeWarning')
+@pytest.mark.parametrize('key', sorted(GOLDEN))
+def test_evaluate_pose(key):
+    pose_seq, exercise = _load(key)
+    golden = GOLDEN[key]
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        if 'error' in golden:
+            with pytest.raises(ValueError):
+                evaluate_pose(pose_seq, exercise)
+            return
+        result = evaluate_pose(pose_seq, exercise)
+
+    assert result == (golden['correct'], golden['feedback'])
+    lines = out.getvalue().splitlines()
+    if golden['side'] is not None:
+        assert lines.pop(0) == 'Exercise arm detected as: {}.'.format(golden['side'])
+    assert len(lines) == len(EXERCISES[exercise].metrics)
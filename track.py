@@ -0,0 +1,174 @@
+"""Multi-person tracking across OpenPose frames.
+
+Detections in each frame are linked to existing tracks by assignment on the mean
+distance between the keypoints they have in common, scaled by the size of the
+track's pose. Detections too far from every track start a new one, and tracks
+that go unmatched for too long are closed.
+"""
+
+import numpy as np
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+# Fewest frames a track must be detected in to be kept, half a second at 30
+# frames/s, so that flickering false detections do not make tracks of their own.
+MIN_TRACK_FRAMES = 15
+
+
+def pose_scale(keypoints):
+    """Diagonal of the bounding box of the parts of one pose that exist."""
+    points = keypoints[keypoints[:, 2] != 0.0, :2]
+    if len(points) < 2:
+        return np.nan
+    return np.hypot(*(points.max(axis=0) - points.min(axis=0)))
+
+
+def assignment_costs(tracks, people):
+    """Mean distance between the common keypoints of every track and detection.
+
+    Args:
+        tracks: (T, 18, 3) last known keypoints of the tracks.
+        people: (P, 18, 3) keypoints of the detections in one frame.
+
+    Returns:
+        (T, P) costs in units of track pose size, inf where no parts are shared.
+    """
+    common = (tracks[:, np.newaxis, :, 2] != 0.0) & (people[np.newaxis, :, :, 2] != 0.0)
+    dists = np.linalg.norm(tracks[:, np.newaxis, :, :2] - people[np.newaxis, :, :, :2], axis=-1)
+    counts = np.count_nonzero(common, axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        costs = np.sum(np.where(common, dists, 0.0), axis=-1) / counts
+        costs = costs / np.array([pose_scale(track) for track in tracks])[:, np.newaxis]
+    costs[(counts == 0) | np.isnan(costs)] = np.inf
+    return costs
+
+
+def assign(costs, max_cost, method='hungarian'):
+    """Match tracks to detections with cost at most max_cost.
+
+    Args:
+        costs: (T, P) assignment costs.
+        max_cost: largest cost allowed for a match.
+        method: 'hungarian' for the optimal assignment (needs scipy, otherwise
+            falls back to greedy), or 'greedy' for cheapest pairs first.
+
+    Returns:
+        List of (track index, detection index) pairs.
+    """
+    if costs.size == 0:
+        return []
+    if method == 'hungarian' and linear_sum_assignment is not None:
+        rows, cols = linear_sum_assignment(np.where(np.isfinite(costs), costs, 1e9))
+        return [(r, c) for r, c in zip(rows.tolist(), cols.tolist()) if costs[r, c] <= max_cost]
+
+    pairs = []
+    used_tracks, used_people = set(), set()
+    order = np.argsort(costs, axis=None)
+    for flat in order.tolist():
+        r, c = divmod(flat, costs.shape[1])
+        if costs[r, c] > max_cost:
+            break
+        if r not in used_tracks and c not in used_people:
+            pairs.append((r, c))
+            used_tracks.add(r)
+            used_people.add(c)
+    return pairs
+
+
+class Tracker:
+    """Link per-frame detections into tracks, one frame at a time.
+
+    Args:
+        max_cost: largest mean keypoint distance, as a fraction of pose size,
+            for a detection to continue a track.
+        max_missed: frames a track may go unmatched before it is closed.
+        method: 'hungarian' or 'greedy', as passed to assign.
+    """
+
+    def __init__(self, max_cost=0.5, max_missed=15, method='hungarian'):
+        self.max_cost = max_cost
+        self.max_missed = max_missed
+        self.method = method
+        self.num_frames = 0
+        self.next_id = 0
+        # open tracks: id -> last known keypoints and frame last seen
+        self.last = {}
+        self.last_seen = {}
+        # frames and keypoints of every track
+        self.frames = {}
+        self.keypoints = {}
+
+    def update(self, people):
+        """Add the (P, 18, 3) detections of the next frame and return their track ids."""
+        frame = self.num_frames
+        self.num_frames += 1
+
+        for track_id in [t for t, seen in self.last_seen.items() if frame - seen > self.max_missed]:
+            del self.last[track_id]
+            del self.last_seen[track_id]
+
+        track_ids = list(self.last)
+        people = np.asarray(people, dtype=np.float64).reshape((-1, 18, 3))
+        # ignore detections with no parts at all
+        people = people[np.any(people[:, :, 2] != 0.0, axis=1)]
+        tracks = np.array([self.last[t] for t in track_ids]).reshape((-1, 18, 3))
+        pairs = assign(assignment_costs(tracks, people), self.max_cost, self.method)
+
+        ids = [None] * len(people)
+        for r, c in pairs:
+            ids[c] = track_ids[r]
+        for c in range(len(people)):
+            if ids[c] is None:
+                ids[c] = self.next_id
+                self.next_id += 1
+                self.frames[ids[c]] = []
+                self.keypoints[ids[c]] = []
+                self.last[ids[c]] = np.zeros((18, 3))
+
+            # remember the last position of every part, even if missing now
+            present = people[c, :, 2] != 0.0
+            self.last[ids[c]] = np.where(present[:, np.newaxis], people[c], self.last[ids[c]])
+            self.last_seen[ids[c]] = frame
+            self.frames[ids[c]].append(frame)
+            self.keypoints[ids[c]].append(people[c])
+        return ids
+
+    def sequences(self, min_frames=MIN_TRACK_FRAMES):
+        """Return a dict of track id to (start, keypoints) over the frames each track spans.
+
+        keypoints is (frames, 18, 3), from the first frame the track was
+        detected in, frame start, to the last one. Frames in between in which
+        it was not detected have all-zero (missing) keypoints.
+
+        Args:
+            min_frames: drop tracks detected in fewer frames than this.
+        """
+        output = {}
+        for track_id, frames in self.frames.items():
+            if len(frames) < min_frames:
+                continue
+            start = frames[0]
+            sequence = np.zeros((frames[-1] - start + 1, 18, 3))
+            sequence[np.array(frames) - start] = self.keypoints[track_id]
+            output[track_id] = (start, sequence)
+        return output
+
+
+def track_people(frames, max_cost=0.5, max_missed=15, method='hungarian', min_frames=MIN_TRACK_FRAMES):
+    """Track people over a sequence of frames.
+
+    Args:
+        frames: iterable of (P, 18, 3) detections per frame.
+        max_cost, max_missed, method: as passed to Tracker.
+        min_frames: drop tracks detected in fewer frames than this.
+
+    Returns:
+        Dict of track id to (start, keypoints), as returned by Tracker.sequences.
+    """
+    tracker = Tracker(max_cost, max_missed, method)
+    for people in frames:
+        tracker.update(people)
+    return tracker.sequences(min_frames)
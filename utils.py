@@ -1,8 +1,11 @@
+import hashlib
 import os
 import sys
 
 import numpy as np
 
+from dtw import dtw
+
 def split_num(s):
     head = s.rstrip('0123456789')
     tail = s[len(head):]
@@ -27,20 +30,16 @@ def get_labels(array):
     labels = [1 if "good" in i else 0 for i in array]
     return np.array(labels)
 
+# Content hash of a file, used as a cache key that survives renames
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
 # Compute Dynamic Time Warp Distance of two sequences
 # http://alexminnaar.com/time-series-classification-and-clustering-with-python.html
+# See dtw.dtw for banded and Itakura-constrained variants and early abandoning.
 def DTWDistance(s1, s2):
-    DTW={}
-
-    for i in range(len(s1)):
-        DTW[(i, -1)] = float('inf')
-    for i in range(len(s2)):
-        DTW[(-1, i)] = float('inf')
-    DTW[(-1, -1)] = 0
-
-    for i in range(len(s1)):
-        for j in range(len(s2)):
-            dist= (s1[i]-s2[j])**2
-            DTW[(i, j)] = dist + min(DTW[(i-1, j)],DTW[(i, j-1)], DTW[(i-1, j-1)])
-
-    return np.sqrt(DTW[len(s1)-1, len(s2)-1])
\ No newline at end of file
+    return dtw(s1, s2)